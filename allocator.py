@@ -0,0 +1,255 @@
+from bisect import bisect_right, insort
+from time import perf_counter_ns
+
+from util import NUM_FRAMES
+
+
+class PageAllocator:
+    '''
+    Free-extent allocator for the physical frames
+    bitmap: one byte per frame; 0 -> free / 1 -> occupied
+    Free frames are also kept as maximal runs of consecutive frames (extents):
+        _starts: first frame of extent -> length of extent
+        _ends: frame after the extent -> first frame of extent
+        _sorted: extent starts in order, to find the extent holding a frame
+        _classes: size class -> set of extent starts
+    The size class of an extent is the bit length of its length,
+    so class c holds extents with 2^(c-1) <= length < 2^c
+    owners: frame -> object the frame was allocated to (reverse page map)
+    '''
+
+    # members of the exact size class probed before moving to a larger class
+    PROBE = 8
+
+    def __init__(self, num_frames=NUM_FRAMES, bitmap=None):
+        '''
+        num_frames: number of frames managed by this allocator
+        bitmap: existing frame map to adopt (e.g. loaded from a volume)
+        '''
+        self.num_frames = num_frames
+        self.bitmap = bytearray(num_frames) if bitmap is None else bitmap
+        self.owners = [None] * num_frames
+        # latency counters (nanoseconds)
+        self.stats = {
+            'alloc_calls': 0,
+            'alloc_frames': 0,
+            'alloc_ns': 0,
+            'alloc_max_ns': 0,
+            'free_calls': 0,
+            'free_frames': 0,
+            'free_ns': 0,
+            'free_max_ns': 0,
+        }
+        self._rebuild()
+
+    def _rebuild(self):
+        '''build the extent index and free count from the bitmap'''
+        self._starts = {}
+        self._ends = {}
+        self._sorted = []
+        self._classes = {}
+        self.free_count = 0
+        bitmap = self.bitmap
+        frame = 0
+        while frame < self.num_frames:
+            if bitmap[frame]:
+                frame += 1
+                continue
+            start = frame
+            while frame < self.num_frames and not bitmap[frame]:
+                frame += 1
+            self._add_extent(start, frame - start)
+            self.free_count += frame - start
+
+    def _add_extent(self, start, length):
+        self._starts[start] = length
+        self._ends[start + length] = start
+        insort(self._sorted, start)
+        self._classes.setdefault(length.bit_length(), set()).add(start)
+
+    def _remove_extent(self, start):
+        length = self._starts.pop(start)
+        del self._ends[start + length]
+        del self._sorted[bisect_right(self._sorted, start) - 1]
+        size_class = self._classes[length.bit_length()]
+        size_class.discard(start)
+        if not size_class:
+            del self._classes[length.bit_length()]
+        return length
+
+    def _find_extent(self, count):
+        '''
+        Return the start of a free extent with at least count frames
+        or None if no single extent is large enough
+        '''
+        size_class = count.bit_length()
+        # extents in the exact class may be shorter than count
+        members = self._classes.get(size_class, ())
+        for i, start in enumerate(members):
+            if self._starts[start] >= count:
+                return start
+            if i >= self.PROBE:
+                break
+        # every extent in a larger class is long enough
+        for c in sorted(self._classes):
+            if c > size_class:
+                return next(iter(self._classes[c]))
+        # fall back to a full scan of the exact class
+        for start in members:
+            if self._starts[start] >= count:
+                return start
+        return None
+
+    def _largest_extent(self):
+        return next(iter(self._classes[max(self._classes)]))
+
+    def _take(self, start, count):
+        '''carve count frames from the front of the extent at start'''
+        length = self._remove_extent(start)
+        if length > count:
+            self._add_extent(start + count, length - count)
+        self.bitmap[start:start + count] = b'\x01' * count
+        return range(start, start + count)
+
+    def allocate(self, count, owner=None):
+        '''
+        Allocate count frames to owner
+        Frames come from a single extent whenever one is large enough,
+        otherwise from the largest extents available
+        Returns a list of frame numbers, or None if not enough frames are free
+        '''
+        if count <= 0:
+            return []
+        if count > self.free_count:
+            return None
+        t0 = perf_counter_ns()
+        start = self._find_extent(count)
+        if start is not None:
+            frames = list(self._take(start, count))
+        else:
+            frames = []
+            needed = count
+            while needed > 0:
+                start = self._largest_extent()
+                taken = self._take(start, min(needed, self._starts[start]))
+                frames.extend(taken)
+                needed -= len(taken)
+        self.set_owner(frames, owner)
+        self.free_count -= count
+        self._record('alloc', count, perf_counter_ns() - t0)
+        return frames
+
+    def free(self, frames):
+        '''
+        Return frames to the free pool
+        Consecutive frames are released as one run and merged with
+        neighbouring free extents; frames that are already free are ignored
+        '''
+        t0 = perf_counter_ns()
+        bitmap = self.bitmap
+        owners = self.owners
+        released = 0
+        run_start = run_end = None
+        for frame in sorted(frames):
+            if not bitmap[frame]:
+                continue
+            bitmap[frame] = 0
+            owners[frame] = None
+            released += 1
+            if frame == run_end:
+                run_end += 1
+                continue
+            if run_start is not None:
+                self._release_run(run_start, run_end)
+            run_start, run_end = frame, frame + 1
+        if run_start is not None:
+            self._release_run(run_start, run_end)
+        self.free_count += released
+        self._record('free', released, perf_counter_ns() - t0)
+        return released
+
+    def reserve(self, frames, owner=None):
+        '''
+        Mark specific free frames as occupied by owner
+        Used when a page table is restored (e.g. journal replay),
+        where the frames are dictated by the record instead of chosen here
+        '''
+        bitmap = self.bitmap
+        for frame in frames:
+            self.owners[frame] = owner
+            if bitmap[frame]:
+                continue
+            # the free extent holding frame is the last one starting at or before it
+            start = self._sorted[bisect_right(self._sorted, frame) - 1]
+            length = self._remove_extent(start)
+            if frame > start:
+                self._add_extent(start, frame - start)
+            if start + length > frame + 1:
+                self._add_extent(frame + 1, start + length - frame - 1)
+            bitmap[frame] = 1
+            self.free_count -= 1
+
+    def _release_run(self, start, end):
+        '''insert the free run [start, end) and coalesce with its neighbours'''
+        # extent that ends where this run starts
+        if start in self._ends:
+            prev_start = self._ends[start]
+            self._remove_extent(prev_start)
+            start = prev_start
+        # extent that starts where this run ends
+        if end in self._starts:
+            end += self._remove_extent(end)
+        self._add_extent(start, end - start)
+
+    def _record(self, op, frames, elapsed):
+        stats = self.stats
+        stats[op + '_calls'] += 1
+        stats[op + '_frames'] += frames
+        stats[op + '_ns'] += elapsed
+        if elapsed > stats[op + '_max_ns']:
+            stats[op + '_max_ns'] = elapsed
+
+    def set_owner(self, frames, owner):
+        owners = self.owners
+        for frame in frames:
+            owners[frame] = owner
+
+    def get_owner(self, frame):
+        '''object frame was allocated to; None if free or unowned'''
+        return self.owners[frame]
+
+    def get_owners(self, start, count):
+        '''owners of the frames start till start + count'''
+        return self.owners[start:start + count]
+
+    def get_free_count(self):
+        return self.free_count
+
+    def get_used_count(self):
+        return self.num_frames - self.free_count
+
+    def is_free(self, frame):
+        return not self.bitmap[frame]
+
+    def get_extents(self):
+        '''free extents as sorted (start, length) pairs'''
+        return sorted(self._starts.items())
+
+    def get_stats(self):
+        '''
+        Occupancy, fragmentation and latency of the allocator
+        Average latencies are per call, in nanoseconds
+        '''
+        stats = dict(self.stats)
+        for op in ('alloc', 'free'):
+            calls = stats[op + '_calls']
+            stats[op + '_avg_ns'] = stats[op + '_ns'] / calls if calls else 0
+        stats['free_count'] = self.free_count
+        stats['used_count'] = self.get_used_count()
+        stats['free_extents'] = len(self._starts)
+        largest = max((self._starts[start] for start in
+                       self._classes[max(self._classes)]), default=0) if self._classes else 0
+        stats['largest_free_extent'] = largest
+        # 0 when every free frame is in one run
+        stats['fragmentation'] = 1 - largest / self.free_count if self.free_count else 0
+        return stats
@@ -1,26 +1,238 @@
-from fastapi import FastAPI
-from filesystem import FileSystem
-app = FastAPI()
-fs = FileSystem()
-
-@app.get("/mkdir")
-def makedir(command:str):
-    x = fs.mkdir(command)
-    return {"output": x}
-
-
-@app.get("/print")
-def print():
-    x = fs.print()
-    return x
-
-@app.get("/showmm")
-def showmm():
-    x = fs.show_mm()
-    return x
-
-
-@app.get("/createFile")
-def createFile(name:str):
-    x = fs.create(name)
-    return x
+from time import monotonic
+from typing import Optional
+from uuid import uuid4
+
+from fastapi import Body, FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+from filesystem import FileSystem
+from metrics import prometheus
+from session import FileLocks, Session
+
+app = FastAPI()
+fs = FileSystem()
+# writers of the same file queue here, whichever session they come from
+locks = FileLocks()
+# session id -> Session
+sessions = {}
+# seconds a session may stay idle before it is ended; its open files are
+# closed without saving, which releases their locks
+SESSION_TTL = 600
+# when idle sessions were last looked for
+last_sweep = monotonic()
+# media type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+@app.get("/mkdir")
+async def makedir(command:str):
+    x = fs.mkdir(command)
+    return {"output": x}
+
+
+@app.get("/print")
+async def print():
+    x = fs.print()
+    return x
+
+@app.get("/showmm")
+async def showmm(offset: int = 0, limit: int = None):
+    x = fs.memory_map(offset, limit)
+    return x
+
+
+@app.get("/framemap")
+async def framemap(start: int = 0, count: int = 256):
+    x = fs.frame_map(start, count)
+    return x
+
+
+@app.get("/owner")
+async def owner(frame: int):
+    x = fs.owner(frame)
+    return {"output": x}
+
+
+@app.get("/du")
+async def du(path: str):
+    x = fs.du(path)
+    return {"output": x}
+
+
+@app.get("/createFile")
+async def createFile(name:str):
+    x = fs.create(name)
+    return x
+
+
+def all_stats():
+    stats = fs.stats()
+    stats['session_locks'] = locks.get_stats()
+    return stats
+
+
+@app.get("/stats")
+async def stats():
+    return all_stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    '''counters in the Prometheus text format'''
+    return PlainTextResponse(prometheus(all_stats()), media_type=CONTENT_TYPE)
+
+
+@app.post("/profile")
+async def profile(enabled: bool = True, interval: float = 0.005):
+    '''start or stop the sampling profiler'''
+    profiler = fs.profile(enabled, interval)
+    return {"output": profiler is not None and profiler.is_running()}
+
+
+@app.get("/profile")
+async def profile_samples(top: int = None):
+    '''
+    samples of the last profile as folded stacks (for flame graphs),
+    or the top functions with ?top=n
+    '''
+    if fs.profiler is None:
+        return PlainTextResponse("")
+    if top is not None:
+        return fs.profiler.top(top)
+    return PlainTextResponse(fs.profiler.folded())
+
+
+@app.post("/batch")
+async def batch(commands: list[str] = Body(embed=True), session: str = None):
+    '''
+    Run a script of commands in one session and return every output
+    Without a session id, a new session is used for this request only
+    '''
+    if session is not None:
+        return {"results": await get_session(session).run(commands)}
+    # its own lock owner, so concurrent batches don't share their locks
+    temporary = Session(uuid4().hex, fs, locks)
+    try:
+        return {"results": await temporary.run(commands)}
+    finally:
+        temporary.close_all()
+
+
+# Sessions: each client keeps its own directory and open files
+
+def get_session(sid):
+    expire_sessions()
+    session = sessions.get(sid)
+    if session is None:
+        raise HTTPException(status_code=404, detail="No such session")
+    session.last_used = monotonic()
+    return session
+
+
+def expire_sessions():
+    '''end the sessions idle for longer than SESSION_TTL (checked every SESSION_TTL / 10 seconds)'''
+    global last_sweep
+    now = monotonic()
+    if now - last_sweep < SESSION_TTL / 10:
+        return
+    last_sweep = now
+    for sid, session in list(sessions.items()):
+        if now - session.last_used > SESSION_TTL:
+            session.close_all()
+            del sessions[sid]
+
+
+@app.post("/sessions")
+async def create_session():
+    expire_sessions()
+    sid = uuid4().hex
+    sessions[sid] = Session(sid, fs, locks)
+    return {"session": sid}
+
+
+@app.delete("/sessions/{sid}")
+async def end_session(sid: str):
+    '''files still open are closed without saving their changes'''
+    get_session(sid).close_all()
+    del sessions[sid]
+    return {"output": f"Session {sid} ended"}
+
+
+@app.post("/sessions/{sid}/cd")
+async def cd(sid: str, path: str):
+    return {"output": get_session(sid).cd(path)}
+
+
+@app.get("/sessions/{sid}/pwd")
+async def pwd(sid: str):
+    return {"output": get_session(sid).pwd()}
+
+
+@app.post("/sessions/{sid}/mkdir")
+async def session_mkdir(sid: str, path: str, parents: bool = False):
+    return {"output": await get_session(sid).mkdir(path, parents)}
+
+
+@app.post("/sessions/{sid}/mv")
+async def mv(sid: str, src: str, dst: str):
+    return {"output": await get_session(sid).mv(src, dst)}
+
+
+@app.post("/sessions/{sid}/cp")
+async def cp(sid: str, src: str, dst: str):
+    return {"output": await get_session(sid).cp(src, dst)}
+
+
+@app.post("/sessions/{sid}/create")
+async def create(sid: str, name: str):
+    return {"output": await get_session(sid).create(name)}
+
+
+@app.post("/sessions/{sid}/delete")
+async def delete(sid: str, name: str, recursive: bool = False):
+    return {"output": await get_session(sid).delete(name, recursive)}
+
+
+@app.post("/sessions/{sid}/open")
+async def open_file(sid: str, name: str, mode: str,
+                    start: Optional[int] = None, end: Optional[int] = None):
+    '''mode w with start (and end) locks bytes [start, end) of the file'''
+    return {"output": await get_session(sid).open(name, mode, start, end)}
+
+
+@app.post("/sessions/{sid}/close")
+async def close(sid: str, name: str):
+    return {"output": await get_session(sid).close(name)}
+
+
+@app.get("/sessions/{sid}/read")
+async def read(sid: str, name: str, chunk_size: int = 1 << 16):
+    '''the committed contents, streamed in chunks of chunk_size bytes'''
+    chunks = get_session(sid).read_chunks(name, chunk_size)
+    if isinstance(chunks, str):
+        return {"output": chunks}
+    return StreamingResponse(chunks, media_type="text/plain")
+
+
+@app.get("/sessions/{sid}/read_from")
+async def read_from(sid: str, name: str, start: int, size: int):
+    return {"output": get_session(sid).read_from(name, start, size)}
+
+
+@app.post("/sessions/{sid}/append")
+async def append(sid: str, name: str, text: str = Body(embed=True)):
+    return {"output": await get_session(sid).append(name, text)}
+
+
+@app.post("/sessions/{sid}/write_at")
+async def write_at(sid: str, name: str, pos: int, text: str = Body(embed=True)):
+    return {"output": await get_session(sid).write_at(name, text, pos)}
+
+
+@app.post("/sessions/{sid}/move")
+async def move(sid: str, name: str, start: int, size: int, target: int):
+    return {"output": await get_session(sid).move(name, start, size, target)}
+
+
+@app.post("/sessions/{sid}/truncate")
+async def truncate(sid: str, name: str, size: int):
+    return {"output": await get_session(sid).truncate(name, size)}
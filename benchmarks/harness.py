@@ -0,0 +1,265 @@
+'''
+Benchmark harness for FileSystem and thread_runner
+
+Two phases run on a workload from benchmarks.workload:
+    filesystem -> the FileSystem API called directly from one thread
+    runner     -> the thread scripts run concurrently by Runner threads,
+                  exactly as thread_runner runs them
+Each reports ops/sec and p50/p99 latency per command; the runner phase
+also reports the time threads waited for file locks. Peak memory is the
+process's peak RSS, plus the peak of Python allocations with --tracemalloc
+(which slows every allocation down, so latencies are not comparable).
+
+Results are written as JSON, so runs of different versions can be compared:
+    python -m benchmarks.harness --threads 8 --output new.json
+    python -m benchmarks.harness --compare old.json new.json
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from time import perf_counter_ns
+
+from benchmarks.workload import DEFAULTS, generate
+from commands import INVALID, compile_script
+from edit_buffer import EditBuffer
+from filesystem import FileSystem
+from output import OutputSink
+from thread_runner import DISPATCH, Runner, thread_runner
+from util import lock_manager
+
+
+def summarize(latencies, elapsed):
+    '''
+    latencies: nanoseconds per call
+    elapsed: wall time of all the calls in seconds
+    '''
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if n == 0:
+        return {'count': 0}
+    return {
+        'count': n,
+        'ops_per_sec': round(n / elapsed, 1) if elapsed else None,
+        'mean_us': round(sum(latencies) / n / 1e3, 2),
+        'p50_us': round(latencies[(n - 1) // 2] / 1e3, 2),
+        'p99_us': round(latencies[(n - 1) * 99 // 100] / 1e3, 2),
+        'max_us': round(latencies[-1] / 1e3, 2),
+    }
+
+
+def _report(latencies, elapsed):
+    '''summary of every op and of all ops together'''
+    every = [latency for values in latencies.values() for latency in values]
+    return {
+        'elapsed_s': round(elapsed, 4),
+        'total': summarize(every, elapsed),
+        # per op: ops_per_sec is calls of that op per second of the phase
+        'ops': {op: summarize(values, elapsed)
+                for op, values in sorted(latencies.items())},
+    }
+
+
+# op -> the EditBuffer edit a Runner makes for it
+EDITS = {
+    'append': EditBuffer.append,
+    'write_at': lambda contents, text, pos: contents.write_at(pos, text),
+    'tr': EditBuffer.truncate,
+}
+
+
+def bench_filesystem(setup, scripts):
+    '''
+    Replay the workload against the FileSystem API from one thread:
+    the setup as mkdir/create/close calls, then every thread script in
+    turn, where a session is open, then read or an edit, then close
+    '''
+    fs = FileSystem()
+    latencies = {}
+
+    def timed(op, method, *args):
+        t0 = perf_counter_ns()
+        result = method(*args)
+        latencies.setdefault(op, []).append(perf_counter_ns() - t0)
+        return result
+
+    start = time.perf_counter()
+    for op in compile_script(setup):
+        if op[0] == 'mkdir':
+            timed('mkdir', fs.mkdir, op[1])
+        elif op[0] == 'create':
+            timed('create', fs.create, op[1])
+        elif op[0] == 'append':
+            timed('close', fs.close, op[1], op[2])
+    for script in scripts:
+        for op in compile_script(script):
+            if op[0] in ('create', 'delete'):
+                timed(op[0], getattr(fs, op[0]), op[1])
+            elif op[0] == 'read':
+                file = timed('open', fs.open, op[1])
+                timed('read', file.read)
+            elif op[0] in ('append', 'write_at', 'tr'):
+                file = timed('open', fs.open, op[1])
+                contents = EditBuffer(file.get_contents())
+                EDITS[op[0]](contents, *op[2:])
+                timed('close', fs.close, op[1], contents)
+    timed('memory_map', fs.memory_map)
+    timed('render', fs.render)
+    return _report(latencies, time.perf_counter() - start)
+
+
+def _lock_waits():
+    '''(waits, wait_ns, max_wait_ns) of the lock manager since it was created'''
+    stats = lock_manager.get_stats().values()
+    return (sum(s['waits'] for s in stats), sum(s['wait_ns'] for s in stats),
+            max((s['max_wait_ns'] for s in stats), default=0))
+
+
+def _timed_runner(name, outfile, fs, commands, latencies):
+    '''thread_runner, timing every command into latencies[op]'''
+    out = OutputSink(outfile)
+    runner = Runner(name, fs, out, 'full')
+    try:
+        for op in compile_script(commands):
+            if op[0] == INVALID:
+                break
+            t0 = perf_counter_ns()
+            DISPATCH[op[0]](runner, *op[1:])
+            latencies.setdefault(op[0], []).append(perf_counter_ns() - t0)
+    finally:
+        out.close()
+
+
+def bench_runner(setup, scripts, output_dir):
+    '''
+    Run the setup with thread_runner, then every thread script on its
+    own thread against the same FileSystem
+    '''
+    fs = FileSystem()
+    thread_runner('setup', os.path.join(output_dir, 'setup.txt'), fs, setup)
+    waits_before = _lock_waits()
+    per_thread = [{} for _ in scripts]
+    threads = [threading.Thread(
+        target=_timed_runner,
+        args=(i, os.path.join(output_dir, f'output_thread{i + 1}.txt'),
+              fs, script, per_thread[i]))
+        for i, script in enumerate(scripts)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = {}
+    for thread_latencies in per_thread:
+        for op, values in thread_latencies.items():
+            latencies.setdefault(op, []).extend(values)
+    report = _report(latencies, elapsed)
+    waits, wait_ns, max_wait_ns = _lock_waits()
+    waits -= waits_before[0]
+    wait_ns -= waits_before[1]
+    report['lock_wait'] = {
+        'waits': waits,
+        'total_ms': round(wait_ns / 1e6, 3),
+        'max_ms': round(max_wait_ns / 1e6, 3),
+        'share_of_thread_time': round(wait_ns / 1e9 / (elapsed * len(scripts)), 4)
+        if scripts and elapsed else 0,
+    }
+    return report
+
+
+def _version():
+    '''git commit of the tree being benchmarked, if it is a git checkout'''
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params, phases=('filesystem', 'runner'), trace_memory=False):
+    '''results of the benchmark of the workload generated from params'''
+    setup, scripts, _ = generate(**params)
+    results = {
+        'version': _version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'params': dict(DEFAULTS, **params),
+        'tracemalloc': trace_memory,
+    }
+    for phase in phases:
+        if trace_memory:
+            tracemalloc.start()
+        if phase == 'filesystem':
+            report = bench_filesystem(setup, scripts)
+        else:
+            with tempfile.TemporaryDirectory() as output_dir:
+                report = bench_runner(setup, scripts, output_dir)
+        if trace_memory:
+            report['python_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report['peak_rss_kb'] = rss // 1024 if sys.platform == 'darwin' else rss
+        results[phase] = report
+    return results
+
+
+def compare(old, new):
+    '''print the change of ops/sec and p99 of every phase and op'''
+    print(f'{old["version"]} -> {new["version"]}')
+    print(f'{"phase/op":<24}{"ops/s old":>12}{"ops/s new":>12}{"change":>9}'
+          f'{"p99 old":>10}{"p99 new":>10}')
+    for phase in ('filesystem', 'runner'):
+        if phase not in old or phase not in new:
+            continue
+        rows = [('total', old[phase]['total'], new[phase]['total'])]
+        rows += [(op, old[phase]['ops'][op], new[phase]['ops'][op])
+                 for op in new[phase]['ops'] if op in old[phase]['ops']]
+        for op, before, after in rows:
+            if not before.get('count') or not after.get('count'):
+                continue
+            change = after['ops_per_sec'] / before['ops_per_sec'] - 1
+            print(f'{phase + "/" + op:<24}{before["ops_per_sec"]:>12}'
+                  f'{after["ops_per_sec"]:>12}{change:>+9.1%}'
+                  f'{before["p99_us"]:>10}{after["p99_us"]:>10}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for name, default in DEFAULTS.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default),
+                            default=default)
+    parser.add_argument('--phases', nargs='+', choices=('filesystem', 'runner'),
+                        default=['filesystem', 'runner'])
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also report the peak of Python allocations')
+    parser.add_argument('--output', help='JSON file of the results (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        return
+    params = {name: getattr(args, name) for name in DEFAULTS}
+    results = run(params, args.phases, args.tracemalloc)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Microbenchmark: PathResolver against the previous pathlib-based
+FileSystem._get_components
+
+Run from the repository root:
+    python -m benchmarks.resolver [depth] [iterations]
+'''
+import os
+import sys
+from pathlib import Path
+from timeit import timeit
+
+from path_resolver import PathResolver
+from util import SEP, get_name, get_parent
+
+
+def legacy_components(cwd, path):
+    '''FileSystem._get_components before the resolver, with cwd passed in'''
+    if path == SEP:
+        return (SEP,) * 3
+    p = Path(path)
+    name = get_name(path)
+    parent_path = str(p.parent)
+    if p.is_absolute():
+        return (name, parent_path, str(p.absolute()))
+    nodes = path.split('/')
+    if nodes[-1] == '':
+        nodes = nodes[:-1]
+    current_dir = cwd
+    for node in nodes:
+        if node == '..':
+            current_dir = get_parent(current_dir)
+        elif node == '.':
+            continue
+        else:
+            current_dir = os.path.join(current_dir, node)
+    name = Path(current_dir).name
+    current_dir = get_parent(current_dir)
+    return (name, current_dir, os.path.join(current_dir, name))
+
+
+def main(depth=16, iterations=20000):
+    cwd = SEP + SEP.join(f'dir{i}' for i in range(depth))
+    paths = [
+        cwd + SEP + 'file.txt',
+        'file.txt',
+        '../sibling/file.txt',
+        './a/b/c/file.txt',
+    ]
+    resolver = PathResolver()
+    for path in paths:
+        assert resolver.normalize(cwd, path) == legacy_components(cwd, path), path
+    print(f'depth={depth} iterations={iterations}')
+    print(f'{"path":<40}{"legacy us":>12}{"cold us":>12}{"cached us":>12}')
+    for path in paths:
+        legacy = timeit(lambda: legacy_components(cwd, path), number=iterations)
+        cold = timeit(lambda: resolver.normalize(cwd, path), number=iterations)
+        cached = timeit(lambda: resolver.components(cwd, path), number=iterations)
+        print(f'{path[-40:]:<40}'
+              f'{legacy / iterations * 1e6:>12.2f}'
+              f'{cold / iterations * 1e6:>12.2f}'
+              f'{cached / iterations * 1e6:>12.2f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,124 @@
+'''
+Generator of command scripts for benchmarking
+
+A workload is a setup script, which builds the directory tree and gives
+every file its initial contents, and one script per thread. Thread
+scripts are sequences of open/.../close sessions on one file at a time
+(so they never deadlock), mixed with create/delete of files of their own.
+All paths are absolute, because the current directory is shared by the
+threads of a FileSystem.
+
+Print a workload from the repository root:
+    python -m benchmarks.workload [files] [depth] [threads] [commands]
+'''
+import random
+import sys
+
+from util import SEP
+
+# parameters of generate and their defaults
+DEFAULTS = {
+    'files': 64,            # files created by the setup script
+    'depth': 3,             # depth of the directory tree they are spread over
+    'fanout': 4,            # subdirectories per directory
+    'threads': 4,           # thread scripts
+    'commands': 500,        # commands per thread script (approximately)
+    'read_ratio': 0.7,      # sessions that open a file for reading
+    'contention': 0.2,      # write sessions that go to the hot files
+    'hot_files': 2,         # files every thread competes for
+    'metadata_ratio': 0.1,  # sessions that create and delete a file instead
+    'size': 256,            # mean bytes written to a file
+    'size_dist': 'exponential',  # 'fixed', 'uniform' or 'exponential'
+    'seed': 0,
+}
+
+
+def _size(rng, params):
+    mean = params['size']
+    dist = params['size_dist']
+    if dist == 'fixed':
+        return mean
+    if dist == 'uniform':
+        return rng.randint(1, 2 * mean)
+    if dist == 'exponential':
+        return max(1, int(rng.expovariate(1 / mean)))
+    raise ValueError(f'unknown size distribution {dist}')
+
+
+def _text(rng, size):
+    '''size bytes of text without spaces (append joins tokens with one)'''
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+                   for _ in range(size))
+
+
+def _directories(depth, fanout):
+    '''paths of a tree of fanout subdirectories per level, parents first'''
+    paths = []
+    level = [SEP]
+    for _ in range(depth):
+        level = [parent.rstrip(SEP) + SEP + f'd{i}'
+                 for parent in level for i in range(fanout)]
+        paths.extend(level)
+    return paths
+
+
+def generate(**params):
+    '''
+    (setup, scripts, files) of a workload; see DEFAULTS for the parameters
+    setup and every script are lists of command lines, files the paths of
+    the files the setup script creates (the hot ones first)
+    '''
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise TypeError(f'unknown workload parameters {sorted(unknown)}')
+    params = dict(DEFAULTS, **params)
+    rng = random.Random(params['seed'])
+
+    directories = _directories(params['depth'], params['fanout'])
+    parents = directories or [SEP]
+    files = [rng.choice(parents).rstrip(SEP) + SEP + f'f{i}.txt'
+             for i in range(params['files'])]
+    setup = [f'mkdir {path}' for path in directories]
+    for path in files:
+        setup += [f'create {path}', f'open {path} w',
+                  f'append {path} {_text(rng, _size(rng, params))}',
+                  f'close {path}']
+
+    hot = files[:params['hot_files']] or files
+    scripts = []
+    for thread in range(params['threads']):
+        script = []
+        created = 0
+        while len(script) < params['commands']:
+            if not files or rng.random() < params['metadata_ratio']:
+                path = f'{rng.choice(parents).rstrip(SEP)}{SEP}t{thread}_{created}.txt'
+                created += 1
+                script += [f'create {path}', f'delete {path}']
+            elif rng.random() < params['read_ratio']:
+                path = rng.choice(files)
+                script += [f'open {path} r', f'read {path}',
+                           f'read_from {path} {rng.randint(0, params["size"])} 64',
+                           f'close {path}']
+            else:
+                pool = hot if rng.random() < params['contention'] else files
+                path = rng.choice(pool)
+                size = _size(rng, params)
+                edit = rng.random()
+                if edit < 0.6:
+                    command = f'append {path} {_text(rng, size)}'
+                elif edit < 0.9:
+                    command = f'write_at {path} {_text(rng, size)} {rng.randint(0, size)}'
+                else:
+                    command = f'tr {path} {size}'
+                script += [f'open {path} w', command, f'close {path}']
+        scripts.append(script)
+    return setup, scripts, files
+
+
+if __name__ == '__main__':
+    names = ('files', 'depth', 'threads', 'commands')
+    setup, scripts, _ = generate(**dict(zip(names, map(int, sys.argv[1:]))))
+    print('\n'.join(setup))
+    for i, script in enumerate(scripts):
+        print(f'# thread {i + 1}')
+        print('\n'.join(script))
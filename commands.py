@@ -0,0 +1,137 @@
+'''
+Compiler for the command language of the input scripts
+
+Every line is parsed once into an opcode tuple (op, *arguments): text
+arguments are joined and integer arguments converted here, so executors
+only look op up in their dispatch table. A line that cannot be compiled
+becomes (INVALID, line); executors stop there, as they stop at any
+command they don't know.
+'''
+
+INVALID = 'invalid'
+
+# op -> argument kinds
+#   'name' -> the last token
+#   'str'  -> one token
+#   'int'  -> one integer token
+#   'text' -> the tokens left, joined by spaces
+# a kind ending in '?' is an optional trailing argument (None if missing)
+SIGNATURES = {
+    'mkdir': ('name',),
+    'mkdirs': ('name',),
+    'cd': ('name',),
+    'mv': ('str', 'str'),
+    'cp': ('str', 'str'),
+    'pwd': (),
+    'print': (),
+    'show_memory_map': (),
+    'save': ('name',),
+    'create': ('name',),
+    'delete': ('name',),
+    'rmtree': ('name',),
+    'open': ('str', 'str', 'int?', 'int?'),
+    'close': ('name',),
+    'read': ('str',),
+    'read_from': ('str', 'int', 'int'),
+    'append': ('str', 'text'),
+    'write_at': ('str', 'text', 'int'),
+    'move': ('str', 'int', 'int', 'int'),
+    'tr': ('str', 'int'),
+}
+
+# other spellings of an op
+ALIASES = {
+    'chdir': 'cd',
+    'clone': 'cp',
+    'rm': 'delete',
+}
+
+# op -> {flag: op it selects}; a flag is the token right after the op
+FLAGS = {
+    # make the missing parent directories too
+    'mkdir': {'-p': 'mkdirs'},
+    # delete a directory with everything below it
+    'delete': {'-r': 'rmtree'},
+}
+
+
+def compile_command(line):
+    '''
+    Opcode tuple of one command line
+    Returns None for an empty line and (INVALID, line) if the command is
+    unknown or its arguments don't match its signature
+    '''
+    tokens = line.split()
+    if not tokens:
+        return None
+    op = ALIASES.get(tokens[0], tokens[0])
+    args = tokens[1:]
+    if args and args[0] in FLAGS.get(op, ()):
+        op = FLAGS[op][args.pop(0)]
+    signature = SIGNATURES.get(op)
+    if signature is None:
+        return (INVALID, line)
+    if signature == ('name',):
+        return (op, args[-1]) if args else (INVALID, line)
+    if 'text' in signature:
+        # text takes whatever the other arguments leave
+        if len(args) < len(signature) - 1:
+            return (INVALID, line)
+        fixed_after = len(signature) - 1 - signature.index('text')
+        split = len(args) - fixed_after
+        head = args[:signature.index('text')]
+        text = ' '.join(args[len(head):split])
+        args = head + [text] + args[split:]
+    else:
+        required = sum(not kind.endswith('?') for kind in signature)
+        if not required <= len(args) <= len(signature):
+            return (INVALID, line)
+        args = args + [None] * (len(signature) - len(args))
+    compiled = [op]
+    for kind, arg in zip(signature, args):
+        if arg is None:
+            pass
+        elif kind.rstrip('?') == 'int':
+            try:
+                arg = int(arg)
+            except ValueError:
+                return (INVALID, line)
+        compiled.append(arg)
+    return tuple(compiled)
+
+
+def compile_script(lines):
+    '''
+    Opcode tuples of an iterable of command lines, skipping empty lines
+    Lines are compiled as they are consumed, so a script read from a file
+    is never held in memory; tuples that are already compiled pass through
+    '''
+    for line in lines:
+        if isinstance(line, tuple):
+            yield line
+            continue
+        compiled = compile_command(line)
+        if compiled is not None:
+            yield compiled
+
+
+def read_script(path, block=1024):
+    '''
+    the lines of the script at path, read block lines at a time
+    The file is closed between blocks, so thousands of scripts can be
+    read from at once
+    '''
+    offset = 0
+    while True:
+        with open(path) as f:
+            f.seek(offset)
+            lines = []
+            for _ in range(block):
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line)
+            offset = f.tell()
+        yield from lines
+        if len(lines) < block:
+            return
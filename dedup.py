@@ -0,0 +1,116 @@
+'''
+Page deduplication: frames shared by several page table entries
+
+Every page a commit writes is looked up by its contents in an index of
+the frames written before it; if an identical frame exists, the page
+table points to that frame and the new one is freed. cp shares all the
+pages of a file the same way.
+
+A frame referenced by more than one page table entry is owned by the
+PageIndex (like the frames of packed tails) and has a reference count;
+when a single entry is left, the file it belongs to owns the frame
+again, and it is freed when its last entry is released. Shared frames are never
+written in place: a commit copies a changed page to a new frame first.
+'''
+
+
+class PageIndex:
+    '''
+    Reference counts of shared frames and a content -> frame index
+    Frames missing from refs are referenced once (by the file owning them)
+    '''
+
+    def __init__(self, allocator, memory):
+        self.allocator = allocator
+        self.memory = memory
+        # frame -> number of page table entries pointing to it, when > 1
+        self.refs = {}
+        # frame -> owner of each of those entries (a File; an old version
+        # kept for a snapshot counts as the file it belonged to)
+        self.users = {}
+        # page contents -> frame, and back
+        self.frames = {}
+        self.contents = {}
+        self.hits = 0
+
+    def __str__(self):
+        return 'shared pages'
+
+    def is_shared(self, frame):
+        return frame in self.refs
+
+    def share(self, frames, owner):
+        '''
+        add a reference of owner to each of frames (a frame may be listed twice)
+        The reference a frame had before it was shared is its owner's
+        '''
+        for frame in frames:
+            if frame not in self.refs:
+                self.users[frame] = [self.allocator.get_owner(frame)]
+            self.refs[frame] = self.refs.get(frame, 1) + 1
+            self.users[frame].append(owner)
+        if frames:
+            self.allocator.set_owner(frames, self)
+
+    def release(self, frames, owner):
+        '''
+        Drop a reference of owner to each of frames
+        A frame left with one reference goes back to the owner of that one
+        Returns the frames nothing refers to anymore (for the caller to free)
+        '''
+        dropped = []
+        for frame in frames:
+            count = self.refs.get(frame, 1) - 1
+            if count >= 1:
+                users = self.users[frame]
+                # by identity: Files compare equal by path
+                del users[next((i for i, user in enumerate(users) if user is owner), 0)]
+            if count > 1:
+                self.refs[frame] = count
+            elif count == 1:
+                del self.refs[frame]
+                self.allocator.set_owner([frame], self.users.pop(frame)[0])
+            else:
+                self.forget(frame)
+                dropped.append(frame)
+        return dropped
+
+    def lookup(self, data, exclude=()):
+        '''an indexed frame holding data (a whole page) that isn't in exclude, or None'''
+        frame = self.frames.get(bytes(data))
+        if frame is None or frame in exclude:
+            return None
+        self.hits += 1
+        return frame
+
+    def insert(self, frame, owner):
+        '''
+        Index a frame owner just wrote
+        Returns an identical frame that is now shared instead of it
+        (the caller frees frame), or frame itself
+        '''
+        ps = self.memory.page_size
+        key = bytes(self.memory.view[frame * ps:(frame + 1) * ps])
+        existing = self.frames.get(key)
+        if existing is not None and existing != frame:
+            self.share([existing], owner)
+            self.hits += 1
+            return existing
+        self.frames[key] = frame
+        self.contents[frame] = key
+        return frame
+
+    def forget(self, frame):
+        '''drop frame from the index before its contents change or it is freed'''
+        key = self.contents.pop(frame, None)
+        if key is not None and self.frames.get(key) == frame:
+            del self.frames[key]
+
+    def get_stats(self):
+        '''frames shared, references saved by sharing, frames indexed and dedup hits'''
+        return {
+            'shared_frames': len(self.refs),
+            'shared_refs': sum(self.refs.values()) - len(self.refs),
+            'indexed_frames': len(self.contents),
+            'hits': self.hits,
+        }
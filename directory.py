@@ -23,16 +23,63 @@ class Directory:
             else:
                 # name is root directory
                 self.name = SEP
+        # containing Directory; None for the root or a detached directory
+        self.parent = None
+        # name -> Directory or File
+        self.children = {}
+        # cached rendering of the children (see tree_view.TreeView)
+        self.view = None
+        # size and pages of every file below this directory
+        self.used_bytes = 0
+        self.used_pages = 0
 
     def get_path(self):
-        return self.path
+        '''
+        Paths are derived from the parent pointers, so moving a directory
+        never has to touch its descendants
+        '''
+        if self.parent is None:
+            return self.path
+        return os.path.join(self.parent.get_path(), self.name)
+
+    def get_name(self):
+        return self.name
+
+    def set_name(self, name):
+        self.name = name
+
+    def get_usage(self):
+        '''(bytes, pages) used by the files below this directory'''
+        return self.used_bytes, self.used_pages
+
+    def get_child(self, name):
+        return self.children.get(name)
+
+    def add_child(self, node):
+        '''node: Directory or File; replaces a child with the same name'''
+        node.parent = self
+        self.children[node.get_name()] = node
+
+    def remove_child(self, name):
+        node = self.children.pop(name)
+        node.parent = None
+        node.path = os.path.join(self.get_path(), name)
+        return node
+
+    def is_ancestor_of(self, node):
+        '''check if node is this directory or lies below it'''
+        while node is not None:
+            if node is self:
+                return True
+            node = node.parent
+        return False
 
     def __str__(self):
         return self.name
 
     def __hash__(self):
-        return hash(self.path)
+        return hash(self.get_path())
 
     def __eq__(self, directory):
         return isinstance(directory, Directory) and \
-            self.path == directory.get_path()
+            self.get_path() == directory.get_path()
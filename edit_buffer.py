@@ -0,0 +1,243 @@
+'''
+Edit buffer for the contents of a file opened for writing
+
+The contents are a sequence of pieces, each a slice of either the contents
+the file had when it was opened (the base) or of a piece of inserted text.
+Pieces are kept in a persistent treap ordered by position, so an edit is a
+few splits and merges: O(log p) for p pieces, however long the contents are.
+Nothing is copied until the buffer is committed.
+
+Every edit has the same result as the matching helper in util
+(append, write_at, move, truncate) applied to the materialized string.
+'''
+import random
+
+
+class _Piece:
+    '''treap node; holds text[start:start + length]'''
+    __slots__ = ('text', 'start', 'length', 'prio', 'left', 'right', 'total')
+
+    def __init__(self, text, start, length, prio, left=None, right=None):
+        self.text = text
+        self.start = start
+        self.length = length
+        self.prio = prio
+        self.left = left
+        self.right = right
+        # characters in this subtree
+        self.total = length + _total(left) + _total(right)
+
+
+def _total(node):
+    return node.total if node is not None else 0
+
+
+def _leaf(text, start=0, length=None):
+    if length is None:
+        length = len(text) - start
+    if length <= 0:
+        return None
+    return _Piece(text, start, length, random.random())
+
+
+def _with(node, left, right):
+    '''copy of node with new children; nodes are never modified in place'''
+    return _Piece(node.text, node.start, node.length, node.prio, left, right)
+
+
+def _merge(a, b):
+    '''the pieces of a followed by the pieces of b'''
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.prio > b.prio:
+        return _with(a, a.left, _merge(a.right, b))
+    return _with(b, _merge(a, b.left), b.right)
+
+
+def _split(node, pos):
+    '''(first pos characters, the rest)'''
+    if node is None:
+        return None, None
+    left_total = _total(node.left)
+    if pos <= left_total:
+        left, right = _split(node.left, pos)
+        return left, _with(node, right, node.right)
+    end = left_total + node.length
+    if pos >= end:
+        left, right = _split(node.right, pos - end)
+        return _with(node, node.left, left), right
+    # pos falls inside this node's piece
+    k = pos - left_total
+    head = _Piece(node.text, node.start, k, node.prio, node.left, None)
+    tail = _leaf(node.text, node.start + k, node.length - k)
+    return head, _merge(tail, node.right)
+
+
+def _pieces(node):
+    '''(text, start, length) of every piece in order'''
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node.text, node.start, node.length
+        node = node.right
+
+
+def span(length, op, *args):
+    '''
+    Characters [start, end) an edit touches in contents of length
+    characters; the end is None if the edit can change the length
+    op: 'append', 'write_at', 'move' or 'tr', with the arguments of
+    the matching command (without the file name)
+    '''
+    if op == 'append':
+        return length, None
+    if op == 'write_at':
+        text, pos = args
+        start, end = pos, pos + len(text)
+    elif op == 'move':
+        start, size, target = args
+        start, end = min(start, target), max(start, target) + size
+    else:
+        return args[0], None
+    return start, None if end > length else end
+
+
+class EditBuffer:
+    def __init__(self, base):
+        '''base: contents of the file when it was opened'''
+        self.base = base
+        self.root = _leaf(base)
+        # every character is ASCII, so character and byte offsets agree
+        self.ascii = base.isascii()
+
+    def __len__(self):
+        return _total(self.root)
+
+    def _slice(self, start, stop):
+        '''pieces of contents[start:stop], with python's slice semantics'''
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return None
+        _, rest = _split(self.root, start)
+        middle, _ = _split(rest, stop - start)
+        return middle
+
+    def _join(self, *parts):
+        root = None
+        for part in parts:
+            root = _merge(root, part)
+        self.root = root
+
+    def append(self, text):
+        '''append text to end of contents'''
+        self.ascii = self.ascii and text.isascii()
+        self._join(self.root, _leaf(text))
+
+    def write_at(self, pos, text):
+        '''overwrite text at pos'''
+        self.ascii = self.ascii and text.isascii()
+        self._join(self._slice(None, pos), _leaf(text),
+                   self._slice(pos + len(text), None))
+
+    def move(self, start, size, target):
+        '''
+        move contents between [start, start + size] to target
+        Returns False (and leaves the contents as they are) if start is
+        past the end
+        '''
+        if start > len(self):
+            print("Start larger than contents")
+            return False
+        self._join(self._slice(None, start),
+                   self._slice(start + size, target),
+                   self._slice(start, start + size),
+                   self._slice(target + size, None))
+        return True
+
+    def reload(self, file, start, end):
+        '''
+        Replace contents[start:end] (end None: up to the end) with the
+        bytes of file committed there; a writer that locks more bytes
+        after it opened the file may find them (or the length) changed
+        '''
+        length = file.get_length()
+        last = length if end is None else min(end, length)
+        text = str(file.read_from(start, max(0, last - start)), 'utf-8', 'replace')
+        self.ascii = self.ascii and text.isascii()
+        self._join(self._slice(None, start), _leaf(text),
+                   None if end is None else self._slice(end, None))
+
+    def truncate(self, size):
+        '''trim content to fit the size'''
+        self._join(self._slice(None, size))
+
+    def getvalue(self):
+        '''the contents as one string'''
+        return ''.join(text[start:start + length]
+                       for text, start, length in _pieces(self.root))
+
+    def edits(self):
+        '''
+        Changes made to the base as (length, [(offset, data), ...])
+        length: number of bytes of the new contents
+        data: encoded bytes that replace the bytes at offset
+        Only pieces that moved or were inserted are encoded, so the
+        cost depends on the size of the change and not of the file
+        Returns None if the contents are not ASCII (byte offsets would
+        have to be computed from the whole contents)
+        '''
+        if not self.ascii:
+            return None
+        ranges = []
+        run_start = None
+        run = []
+        pos = 0
+        for text, start, length in _pieces(self.root):
+            if text is self.base and start == pos:
+                # still at its original offset
+                if run:
+                    ranges.append((run_start, ''.join(run).encode()))
+                    run = []
+            else:
+                if not run:
+                    run_start = pos
+                run.append(text[start:start + length])
+            pos += length
+        if run:
+            ranges.append((run_start, ''.join(run).encode()))
+        return pos, ranges
+
+    def edits_in(self, ranges):
+        '''
+        edits() limited to the byte ranges a writer holds
+        ranges: sorted, disjoint [(start, end), ...]; an end of None
+                reaches past the end of the contents
+        The length is None (keep the committed one) unless a range
+        reaches the end, so the bytes other writers committed outside
+        the ranges are left as they are
+        '''
+        edits = self.edits()
+        if edits is None:
+            value = self.getvalue()
+            data = value.encode()
+            # character offsets -> byte offsets of the new contents
+            ranges = [(len(value[:start].encode()),
+                       None if end is None else len(value[:end].encode()))
+                      for start, end in ranges]
+            edits = (len(data), [(0, data)])
+        length, changes = edits
+        kept = []
+        for offset, data in changes:
+            for start, end in ranges:
+                first = max(start, offset)
+                last = offset + len(data) if end is None else min(end, offset + len(data))
+                if first < last:
+                    kept.append((first, data[first - offset:last - offset]))
+        if all(end is not None for _, end in ranges):
+            length = None
+        return length, sorted(kept)
@@ -1,12 +1,12 @@
 import os
-import sys
 
 
 class File:
-    def __init__(self, name, working_dir=None):
+    def __init__(self, name, working_dir=None, memory=None):
         '''
         name: the name of the file
         working_dir: the parent directory path
+        memory: PhysicalMemory object that holds the file's pages
         '''
         # relative path
         if working_dir:
@@ -16,29 +16,32 @@ class File:
         else:
             self.path = name
             self.name = os.path.basename(name)
-        # contents of the file
-        self.contents = ''
-        # file size in bytes
-        self.adjust_size()
+        # containing Directory; None while the file is detached
+        self.parent = None
+        self.memory = memory
+        # size of the contents in bytes (utf-8)
+        self.length = 0
         # the pages that this file is occupying
         self.occupied_pages = []
+        # contents after the pages (see FileSystem._layout):
+        #   None          -> the pages hold everything
+        #   bytes         -> kept here (inline)
+        #   (frame, offset) -> packed in a slot of a shared frame
+        self.tail = None
+        # runs of consecutive pages; rebuilt after the page table changes
+        self.extents = None
+        # number of the committed version (see versions.py) and the older
+        # versions snapshots still read: [(version, layout)], oldest first
+        self.version = 0
+        self.history = []
 
     def __str__(self):
         return self.name
 
     def get_path(self):
-        return self.path
-
-    def set_path(self, path):
-        dirname = os.path.dirname(path)
-        fname = os.path.basename(path)
-        # path contains filename too
-        if fname:
-            self.path = os.path.join(dirname, fname)
-            self.set_name(fname)
-        # keep original name; just change directory
-        else:
-            self.path = os.path.join(dirname, self.name)
+        if self.parent is None:
+            return self.path
+        return os.path.join(self.parent.get_path(), self.name)
 
     def get_name(self):
         return self.name
@@ -47,40 +50,104 @@ class File:
         self.name = name
 
     def get_contents(self):
-        return self.contents
+        return str(self.read(), 'utf-8')
 
-    def set_contents(self, content):
-        self.contents = content
-        self.adjust_size()
+    def read_page(self, index):
+        '''contents of the index-th page, up to the end of the file'''
+        ps = self.memory.page_size
+        start = index * ps
+        return self.memory.read(self.occupied_pages, start,
+                                min(ps, self.length - start))
 
     def get_pages(self):
         return self.occupied_pages
 
     def set_pages(self, pages):
         self.occupied_pages = pages
+        self.extents = None
+
+    def get_extents(self):
+        '''the page table as (first frame, number of frames) runs'''
+        if self.extents is None:
+            extents = []
+            for page in self.occupied_pages:
+                if extents and extents[-1][0] + extents[-1][1] == page:
+                    extents[-1][1] += 1
+                else:
+                    extents.append([page, 1])
+            self.extents = [tuple(extent) for extent in extents]
+        return self.extents
 
     def get_size(self):
-        return self.size
+        '''size in bytes; the same as the length'''
+        return self.length
+
+    def get_length(self):
+        return self.length
+
+    def set_length(self, length):
+        self.length = length
 
-    def adjust_size(self):
-        self.size = sys.getsizeof(self.contents)
+    def get_tail(self):
+        return self.tail
+
+    def set_tail(self, tail):
+        self.tail = tail
+
+    def get_frames(self):
+        '''the frames the contents are in: the pages, then the slot's frame'''
+        if isinstance(self.tail, tuple):
+            return self.occupied_pages + [self.tail[0]]
+        return self.occupied_pages
+
+    def get_layout(self):
+        '''
+        (pages, tail contents, length); reading through a layout taken
+        before a commit keeps returning the contents from before it
+        '''
+        pages = self.occupied_pages
+        return pages, bytes(self._tail_view(pages, self.tail, self.length)), self.length
+
+    def _tail_view(self, pages, tail, length):
+        if tail is None:
+            return memoryview(b'')
+        if isinstance(tail, bytes):
+            return memoryview(tail)
+        frame, offset = tail
+        start = frame * self.memory.page_size + offset
+        return self.memory.view[start:start + length - len(pages) * self.memory.page_size]
 
     def read(self):
-        '''read all contents'''
-        return self.contents
+        '''read all contents as a memoryview'''
+        return self.read_from(0, self.length)
 
-    def read_from(self, start, size):
-        '''read text between start till start + size'''
-        if start < len(self.content):
-            return self.content[start:start + size]
+    def read_from(self, start, size, layout=None):
+        '''
+        read bytes between start till start + size as a memoryview
+        layout: what get_layout returned, to read the contents it saw
+        '''
+        if layout is None:
+            pages, tail, length = self.occupied_pages, self.tail, self.length
+            tail = self._tail_view(pages, tail, length)
         else:
-            return ''
+            pages, tail, length = layout
+            tail = memoryview(tail)
+        end = min(start + size, length)
+        if start >= end:
+            return memoryview(b'')
+        head = min(length, len(pages) * self.memory.page_size)
+        if end <= head:
+            return self.memory.read(pages, start, end - start)
+        if start >= head:
+            return tail[start - head:end - head]
+        return memoryview(bytes(self.memory.read(pages, start, head - start))
+                          + tail[:end - head])
 
     def __eval__(self):
-        return self.path
+        return self.get_path()
 
     def __hash__(self):
-        return hash(self.path)
+        return hash(self.get_path())
 
     def __eq__(self, file):
-        return isinstance(file, File) and self.path == file.get_path()
+        return isinstance(file, File) and self.get_path() == file.get_path()
@@ -1,52 +1,121 @@
+import asyncio
 import os
-import pickle
-import sys
-from math import ceil
-from pathlib import Path
-
-from treelib import Tree
+import threading
+from collections import Counter
+from itertools import islice
+from uuid import uuid4
 
+from allocator import PageAllocator
+from dedup import PageIndex
 from directory import Directory
+from edit_buffer import EditBuffer
 from file import File
+from memory import PhysicalMemory
+from metrics import Metrics, SamplingProfiler, timed
+from packing import INLINE_SIZE, TAIL_SIZE, TailPacker
+from path_resolver import PathResolver
+from session import Session, ThreadLocks
+from swap import POLICIES, Pager
 from util import *
+from versions import Snapshot, VersionManager
+import journal
+import tree_view
+import volume
 
 
 class FileSystem:
     def __init__(self):
-        # tree that represents the file system
-        self.fs = Tree()
+        # the directory tree is made of Directory objects that hold their
+        # children by name; each node points back to its parent
         if os.name == 'nt':
             # root directory
-            self.root = Directory("c:")
             # only allow 1 mountable drive (C drive)
-            self.fs.create_node("C:", "c:", data=self.root)
+            self.root = Directory("c:")
         else:
             # posix paths
             # initial directory is root
             self.root = Directory(SEP)
-            # arg1: name to display; arg2: internel tag; arg3: contents of node
-            self.fs.create_node(SEP, SEP, data=self.root)
         # self.curr_pointer always points to a Directory object
         self.curr_pointer = self.root
-        # free frames list; 0 -> free / 1 -> occupied
-        self.free_frames = [0] * 10000
+        # path of self.curr_pointer; refreshed by cd and mv
+        self.cwd = self.root.get_path()
+        # memoized path normalization and lookups
+        self.resolver = PathResolver(self.cwd)
+        # incrementally maintained text/JSON rendering of the tree
+        self.view = tree_view.TreeView(self.root)
+        # incremented by every change to the tree
+        self.version = 0
+        # (version, JSON) of the last print
+        self._printed = (-1, None)
+        # physical frames; keeps a running count of free frames
+        self.allocator = PageAllocator(NUM_FRAMES)
+        # contents of the frames
+        self.memory = PhysicalMemory(NUM_FRAMES, PAGE_SIZE)
+        # slots of the frames shared by the tails of files
+        self.tails = TailPacker(self.allocator, self.memory)
+        # reference counts of shared frames and the contents of written pages
+        self.dedup = PageIndex(self.allocator, self.memory)
+        # version numbers and the old versions snapshots still read
+        self.versions = VersionManager()
+        # id -> file for the files that occupy pages, in the order they
+        # got them (memory map); files hash by path, which mv changes
+        self.mapped = {}
+        # held while the tree or the frames are modified
+        self.lock = threading.RLock()
+        # write-ahead journal and the volume image it is checkpointed into
+        self.journal = None
+        self.checkpointer = None
+        self.image = None
+        self.checkpoint_lsn = 0
+        # Pager standing in for self.memory once swap is enabled
+        self.pager = None
+        # latency of every public method and sizes of committed closes
+        self.metrics = Metrics()
+        # SamplingProfiler while profiling is on (see profile)
+        self.profiler = None
 
-    def mkdir(self, dirname):
+    @timed
+    def mkdir(self, dirname, parents=False):
         '''
         Ignore duplicate directory
-        Ignore non-existent parent directory
+        Ignore non-existent parent directory, unless parents is set
+        (mkdir -p): then the missing ancestors are made as well, in the
+        same operation
         '''
         dirname, dirpath, full_path = self._get_components(dirname)
-        if self._exists(full_path):
-            print("Duplicate directory. Operation ignored.")
-            return 0
-        if not self._exists(dirpath):
-            print("No such parent directory exists!")
-            return 1
-        directory = Directory(dirname, dirpath)
-        self.fs.create_node(dirname, full_path, parent=dirpath, data=directory)
+        with self.lock:
+            if self._exists(full_path):
+                print("Duplicate directory. Operation ignored.")
+                return 0
+            if parents:
+                parent = self._make_dirs(dirpath)
+            else:
+                parent = self._lookup_dir(dirpath)
+            if parent is None:
+                print("No such parent directory exists!")
+                return 1
+            self._link(parent, Directory(dirname, dirpath))
+            lsn = self._log(('mkdir', full_path, True) if parents else ('mkdir', full_path))
+        self._sync(lsn)
         return full_path
 
+    def _make_dirs(self, path):
+        '''
+        The directory at an absolute path, made with its missing ancestors
+        Returns None (and makes nothing) if a file is in the way
+        '''
+        node = self._lookup(path)
+        if node is not None:
+            return node if isinstance(node, Directory) else None
+        name, parent_path, _ = self._get_components(path)
+        parent = self._make_dirs(parent_path)
+        if parent is None:
+            return None
+        directory = Directory(name, parent_path)
+        self._link(parent, directory)
+        return directory
+
+    @timed
     def cd(self, dirname):
         '''
         Check for path type
@@ -54,167 +123,889 @@ class FileSystem:
         Change pointer
         '''
         _, _, full_path = self._get_components(dirname)
-        if self._exists(full_path):
-            self.curr_pointer = self.fs.get_node(full_path).data
+        directory = self._lookup_dir(full_path)
+        if directory is not None:
+            self.curr_pointer = directory
+            self.cwd = directory.get_path()
         else:
             return 0
         return self.pwd()
 
+    @timed
     def mv(self, src_fname, dst_fname):
         _, _, src_full_path = self._get_components(
             src_fname)
         dst_filename, dst_dirname, dst_full_path = self._get_components(
             dst_fname)
-        if not self._exists(src_full_path):
-            print("Source file doesn't exist!")
-            return 0
-        if not self._exists(dst_dirname):
-            print("Destination directory doesn't exist!")
-            return 1
+        with self.lock:
+            src_node = self._lookup(src_full_path)
+            if src_node is None or src_node is self.root:
+                print("Source file doesn't exist!")
+                return 0
+            dst_dir = self._lookup_dir(dst_dirname)
+            if dst_dir is None:
+                print("Destination directory doesn't exist!")
+                return 1
+            # a directory cannot be moved below itself
+            if isinstance(src_node, Directory) and src_node.is_ancestor_of(dst_dir):
+                print("Cannot move a directory into itself.")
+                return 1
 
-        # we will overwrite destination file
-        # so delete it for now
-        if self._exists(dst_full_path):
-            self.delete(dst_full_path)
+            # relinking the node moves its whole subtree
+            self._unlink(src_node)
 
-        src_node = self.fs.get_node(src_full_path)
-        src_file = src_node.data
-        src_file.set_path(dst_full_path)
+            # we will overwrite destination file
+            # so delete it for now (src_node may have been below it)
+            dst_node = dst_dir.get_child(dst_filename)
+            if dst_node is not None:
+                self._unlink(dst_node)
+                self._discard(dst_node)
 
-        self.fs.move_node(src_full_path, dst_dirname)
-        self.fs.update_node(src_full_path, tag=dst_filename,
-                            identifier=dst_full_path)
-        return True
+            src_node.set_name(dst_filename)
+            self._link(dst_dir, src_node)
+            # cached nodes and the current directory may have new paths
+            self.resolver.invalidate()
+            self.cwd = self.curr_pointer.get_path()
+            lsn = self._log(('mv', src_full_path, dst_full_path))
+        self._sync(lsn)
+        return dst_full_path
+
+    @timed
+    def cp(self, src_fname, dst_fname):
+        '''
+        Copy a file to dst_fname, overwriting a file that is there
+        The copy shares the frames of the source and takes none of its own
+        until either file changes them; a packed tail is copied to a new slot
+        Returns 0 if the source file doesn't exist, 1 if the destination
+        directory doesn't exist, 2 if the destination is a directory and
+        3 if no frame is free for the tail
+        '''
+        _, _, src_full_path = self._get_components(src_fname)
+        dst_filename, dst_dirname, dst_full_path = self._get_components(dst_fname)
+        with self.lock:
+            src = self._lookup_file(src_full_path)
+            if src is None:
+                print("Source file doesn't exist!")
+                return 0
+            dst_dir = self._lookup_dir(dst_dirname)
+            if dst_dir is None:
+                print("Destination directory doesn't exist!")
+                return 1
+            dst_node = dst_dir.get_child(dst_filename)
+            if isinstance(dst_node, Directory):
+                print("Destination is a directory.")
+                return 2
+            if dst_node is src:
+                return dst_full_path
+            pages = src.get_pages()
+            # swapped out pages can't be shared
+            if self.pager is not None and not self.pager.fault_all(pages):
+                print("Not enough frames available to copy this file.")
+                return 3
+            tail = src.get_tail()
+            if isinstance(tail, tuple):
+                tail_length = src.get_length() - len(pages) * PAGE_SIZE
+                contents = bytes(self.tails.read(tail, tail_length))
+                if self.pager is not None and self.tails.needs_frame(tail_length):
+                    self.pager.make_room(1, pages)
+                tail = self.tails.allocate(tail_length)
+                if tail is None:
+                    print("Not enough frames available to copy this file.")
+                    return 3
+                self.tails.write(tail, contents)
+            if dst_node is not None:
+                self._unlink(dst_node)
+                self._discard(dst_node)
+                self.resolver.invalidate()
+            file = File(dst_filename, dst_dirname, self.memory)
+            file.set_pages(list(pages))
+            file.set_tail(tail)
+            file.set_length(src.get_length())
+            self.dedup.share(file.get_pages(), file)
+            self._link(dst_dir, file)
+            self._update_usage(file, self._usage(file))
+            if self.pager is not None:
+                self.pager.touch(pages)
+            if isinstance(tail, tuple):
+                tail = tail + (contents,)
+            lsn = self._log(('cp', src_full_path, dst_full_path, tail))
+        self._sync(lsn)
+        return dst_full_path
 
+    @timed
     def pwd(self):
-        return self.curr_pointer.get_path()
+        return self.cwd
 
+    def abspath(self, path):
+        '''absolute path of path; relative paths start at the current directory'''
+        return self._get_components(path)[2]
+
+    @timed
+    def isdir(self, path):
+        '''check if path is an existing directory'''
+        _, _, full_path = self._get_components(path)
+        return self._lookup_dir(full_path) is not None
+
+    @timed
+    def render(self):
+        '''the tree as text'''
+        return self.view.render()
+
+    @timed
+    def show(self):
+        '''print the tree'''
+        print(self.render())
+
+    @timed
     def print(self):
-        self.fs.show()
-        return self.fs.to_json()
+        '''
+        Print the tree and return it as JSON
+        The JSON is reused until the tree changes
+        '''
+        self.show()
+        version, printed = self._printed
+        if version != self.version:
+            printed = self.view.to_json()
+            self._printed = (self.version, printed)
+        return printed
 
 
-    def show_mm(self):
+    @timed
+    def show_mm(self, offset=0, limit=None):
         '''
         Show memory map
         If file occupies > 0 pages then print
         filepath, pages, size
         '''
-        output = []
-        for node in self.fs.all_nodes_itr():
-            file = node.data
-            if isinstance(file, File):
-                size = file.get_size()
-                pages = file.get_pages()
-                if len(pages) > 0:
-                    output.append([file.get_path(), pages, size])
-                    print(file.get_path(), pages, size)
+        output = self.memory_map(offset, limit)
+        for path, pages, size in output:
+            print(path, pages, size)
         return output
 
+    @timed
+    def memory_map(self, offset=0, limit=None):
+        '''
+        [filepath, frames, size] of every file that occupies > 0 frames
+        The last frame is shared with other files if the file's tail is
+        packed; files kept inline occupy no frames. Pages that are swapped
+        out are listed as 'swap:<slot>'
+        offset, limit: return only limit files starting from the offset-th
+        '''
+        stop = None if limit is None else offset + limit
+        with self.lock:
+            files = list(islice(self.mapped.values(), offset, stop))
+            return [[file.get_path(), [_frame_name(frame) for frame in file.get_frames()],
+                     file.get_size()]
+                    for file in files]
+
+    @timed
+    def frame_map(self, start=0, count=None):
+        '''
+        [frame, filepath] of the frames start till start + count
+        filepath is None for a free frame
+        '''
+        if count is None:
+            count = self.allocator.num_frames - start
+        with self.lock:
+            owners = self.allocator.get_owners(start, count)
+            return [[start + i, _owner_name(owner)]
+                    for i, owner in enumerate(owners)]
+
+    @timed
+    def owner(self, frame):
+        '''
+        path of the file that occupies frame; None if nobody does
+        Frames shared by packed tails are owned by 'packed tails'
+        '''
+        with self.lock:
+            return _owner_name(self.allocator.get_owner(frame))
+
+    @timed
+    def du(self, path):
+        '''
+        (bytes, pages) used by the file or by every file below the directory
+        Returns 0 if path doesn't exist
+        '''
+        _, _, full_path = self._get_components(path)
+        with self.lock:
+            node = self._lookup(full_path)
+            if node is None:
+                return 0
+            return self._usage(node)
+
+    def stats(self):
+        '''
+        Counters of the file system (see metrics.prometheus):
+            ops          -> latency histogram (ns) of every public method
+            transactions -> histograms of the bytes and pages of each close
+            allocator    -> occupancy, fragmentation and latency of frames
+            tails        -> frames and slots holding packed tails
+            dedup        -> frames shared by deduplication and cp
+            versions     -> snapshots and the old versions kept for them
+            swap         -> page faults and evictions, when swap is enabled
+            thread_locks -> wait and hold times per file of thread_runner
+            journal      -> journal counters, when one is attached
+        '''
+        stats = self.metrics.get_stats()
+        with self.lock:
+            stats['allocator'] = self.allocator.get_stats()
+            stats['tails'] = self.tails.get_stats()
+            stats['dedup'] = self.dedup.get_stats()
+            stats['versions'] = self.versions.get_stats()
+            if self.pager is not None:
+                stats['swap'] = self.pager.get_stats()
+        stats['thread_locks'] = lock_manager.get_stats()
+        if self.journal is not None:
+            stats['journal'] = dict(self.journal.stats)
+        return stats
+
+    def profile(self, enabled=True, interval=0.005):
+        '''
+        Start or stop sampling the stacks of every thread
+        Returns the SamplingProfiler, whose samples are kept after it
+        stops (until profiling is started again)
+        '''
+        if enabled:
+            if self.profiler is None or not self.profiler.is_running():
+                self.profiler = SamplingProfiler(interval)
+                self.profiler.start()
+        elif self.profiler is not None:
+            self.profiler.stop()
+        return self.profiler
+
+    def enable_swap(self, path, policy='lru'):
+        '''
+        Back the frames with a swap file at path (see swap.py): when a
+        change needs more frames than are free, the least recently used
+        pages of files are moved to it, and read back on access
+        policy: 'lru' or 'clock'
+        The swap file is not part of the volume: a journaled file system
+        can't swap, and save fails while pages are swapped out
+        Returns 1 if swap can't be enabled
+        '''
+        with self.lock:
+            if self.pager is not None:
+                print("Swap is already enabled.")
+                return 1
+            if self.journal is not None:
+                print("Swap can't be enabled on a journaled file system.")
+                return 1
+            if policy not in POLICIES:
+                print("Unknown page replacement policy.")
+                return 1
+            self.pager = Pager(self.memory, self.allocator, self.lock, path, policy,
+                               self.dedup)
+            self.memory = self.tails.memory = self.dedup.memory = self.pager
+            for node in self._walk():
+                if isinstance(node, File):
+                    node.memory = self.pager
+                    self.pager.touch(node.get_pages())
+        return self.pager
+
+    @timed
     def save(self, name):
-        with open(name, "wb") as outp:
-            pickle.dump(self, outp, pickle.HIGHEST_PROTOCOL)
+        '''
+        write the file system as a volume image
+        Returns 1 if pages are swapped out
+        '''
+        with self.lock:
+            if self.pager is not None and self.pager.get_swapped_count():
+                print("Cannot save while pages are swapped out.")
+                return 1
+            lsn = self.journal.last_lsn() if self.journal else 0
+            volume.save(self, name, lsn)
+
+    @classmethod
+    def load(cls, name):
+        '''
+        Mount a volume image written by save()
+        File contents are read from the image when first accessed
+        Returns 1 if name is not a supported volume image
+        '''
+        return volume.mount(cls(), name)
 
+    @classmethod
+    def recover(cls, volume_path, journal_path, **kwargs):
+        '''
+        Open a journaled file system
+        Replays the journal written since the last checkpoint of the volume
+        image, then keeps journaling every change (see journal.recover)
+        '''
+        return journal.recover(cls, volume_path, journal_path, **kwargs)
+
+    @timed
+    def batch(self, commands):
+        '''
+        Run a list of commands in the thread_runner command language
+        in a new session (its own current directory and open files)
+        Files left open at the end are closed without saving
+        Returns [command, output] for every command that was run
+        Writers take their locks from the lock manager of thread_runner,
+        so they exclude thread_runner threads and other batches; a writer
+        that has to wait blocks the calling thread
+        Raises RuntimeError if called from a running event loop (await
+        Session.run there instead)
+        '''
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError(
+                "FileSystem.batch can't run inside an event loop; await Session.run instead")
+        session = Session(uuid4().hex, self, ThreadLocks(lock_manager))
+        try:
+            return asyncio.run(session.run(commands))
+        finally:
+            session.close_all()
+
+    def attach_journal(self, journal):
+        '''log every following change to journal before it returns'''
+        self.journal = journal
+
+    @timed
     def create(self, fname):
         '''
         Get filename, directory of parent, and full_path
         Ignore operation if directory of parent does not exist or file already exists
         Create File object and then add to tree
         '''
-        mess = ''
         filename, dirname, full_path = self._get_components(fname)
-        if not self._exists(dirname):
-            mess = "No such directory exists!"
-            print("No such directory exists!")
-            return mess
-        if self._exists(full_path):
-            mess = "Duplicate file. Operation ignored."
-            print("Duplicate file. Operation ignored.")
-            return mess
-        file = File(filename, dirname)
-        self.fs.create_node(filename, full_path, parent=dirname, data=file)
-        self._allocate_pages(file)
+        with self.lock:
+            parent = self._lookup_dir(dirname)
+            if parent is None:
+                print("No such directory exists!")
+                return 0
+            if self._exists(full_path):
+                print("Duplicate file. Operation ignored.")
+                return 1
+            # an empty file is inline and takes no frames
+            file = File(filename, dirname, self.memory)
+            self._link(parent, file)
+            lsn = self._log(('create', full_path, list(file.get_pages())))
+        self._sync(lsn)
         return full_path
 
-    def delete(self, fname):
+    @timed
+    def delete(self, fname, recursive=False):
         '''
         Check if file doesn't exist
         Otherwise delete it
+        A directory that isn't empty is only deleted with recursive=True,
+        together with everything below it
+        Returns 0 if it doesn't exist, 1 if it is a directory that isn't empty
         '''
         _, _, full_path = self._get_components(fname)
-        if not self._exists(full_path):
-            print("No such file exists!")
-            return False
-        self.fs.remove_node(full_path)
-        return True
+        with self.lock:
+            node = self._lookup(full_path)
+            if node is None or node is self.root:
+                print("No such file exists!")
+                return 0
+            if isinstance(node, Directory) and node.children and not recursive:
+                print("Directory not empty. Operation ignored.")
+                return 1
+            self._unlink(node)
+            self._discard(node)
+            self.resolver.invalidate()
+            lsn = self._log(('delete', full_path))
+        self._sync(lsn)
+        return full_path
 
+    @timed
     def open(self, fname):
         _, _, full_path = self._get_components(fname)
-        if not self._exists(full_path):
+        file = self._lookup_file(full_path)
+        if file is None:
             print("File doesn't exist!")
             return False
-        file = self.fs.get_node(full_path).data
         return file
 
+    @timed
+    def snapshot(self, tree=False):
+        '''
+        Pin the committed contents of every file (see versions.py)
+        Reads through the Snapshot never wait for writers and don't see
+        their later commits; tree=True also pins the paths (O(files))
+        Release it with close() (or use it in a with block)
+        '''
+        with self.lock:
+            files = None
+            if tree:
+                files = {node.get_path(): node for node in self._walk()
+                         if isinstance(node, File)}
+            return Snapshot(self, self.versions.pin(), files)
+
+    def release_snapshot(self, snapshot):
+        '''unpin snapshot and free the versions nothing else reads'''
+        with self.lock:
+            self.versions.unpin(snapshot.version)
+            garbage = []
+            for file, frames in self.versions.collect():
+                garbage.extend(self.dedup.release(frames, file))
+            self.allocator.free(garbage)
+
+    @timed
     def close(self, fname, new_contents):
         '''
         If the contents of the file changed, 
         then save the new contents in 'new_contents'
-        It is assumed that file hasn't changed if old_contents == new_contents
-        Modify the page table/free frame list
+        new_contents: a string, or the EditBuffer the file was edited in,
+        or the (length, ranges) its edits() returned;
+        only the ranges an EditBuffer changed are compared and written.
+        A length of None keeps the length the file has when the change is
+        committed: writers of byte ranges (EditBuffer.edits_in) merge their
+        ranges into whatever the other writers committed
+        Pages are copied on write: changed pages get new frames and the
+        page table is swapped in one step (see _commit_pages), which
+        publishes a new version of the file
         '''
         _, _, full_path = self._get_components(fname)
-        if not self._exists(full_path):
-            print("File doesn't exist!")
-            return 0
-        file = self.fs.get_node(full_path).data
-        old_contents = file.get_contents()
-        if new_contents != old_contents:
-            if self._are_frames_available(file, new_contents):
-                file.set_contents(new_contents)
-                self._allocate_pages(file)
-            else:
+        edits = new_contents if isinstance(new_contents, tuple) else None
+        if isinstance(new_contents, EditBuffer):
+            edits = new_contents.edits()
+            if edits is None:
+                new_contents = new_contents.getvalue()
+        if edits is not None:
+            length, ranges = edits
+        else:
+            data = new_contents.encode()
+            length, ranges = len(data), [(0, data)]
+        result, lsn = self._commit(full_path, length, ranges)
+        self._sync(lsn)
+        return result
+
+    @timed
+    def append(self, fname, data):
+        '''
+        Atomically add data (a string or bytes) to the end of the file
+        The end is the one the file has when the data is committed, so
+        appends never conflict with each other or with writers of ranges
+        before the end
+        Returns 0 if the file doesn't exist, 1 if there are not enough frames
+        '''
+        _, _, full_path = self._get_components(fname)
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            file = self._lookup_file(full_path)
+            end = 0 if file is None else file.get_length()
+            result, lsn = self._commit(full_path, end + len(data), [(end, data)])
+        self._sync(lsn)
+        return result
+
+    def _commit(self, full_path, length, ranges):
+        '''
+        Commit (offset, data) ranges to the file at full_path (see close)
+        Returns (result of close, lsn of the journal record or None)
+        '''
+        lsn = None
+        with self.lock:
+            file = self._lookup_file(full_path)
+            if file is None:
+                print("File doesn't exist!")
+                return 0, None
+            if length is None:
+                length = file.get_length()
+                ranges = [(offset, data[:length - offset])
+                          for offset, data in ranges if offset < length]
+            usage = self._usage(file)
+            changed = self._commit_pages(file, length, ranges)
+            if changed is None:
                 print("Not enough frames available to save this change.")
-                return 1
-        return True
+                return 1, None
+            if changed is not False:
+                self.metrics.transaction(
+                    sum(len(data) for _, data in ranges), len(changed))
+                self._update_usage(file, usage)
+                pages = list(file.get_pages())
+                # page-level delta: only the frames that were rewritten
+                frames = {pages[i]: bytes(file.read_page(i)) for i in changed}
+                tail = file.get_tail()
+                if isinstance(tail, tuple):
+                    tail = tail + (bytes(file.read_from(len(pages) * PAGE_SIZE, TAIL_SIZE)),)
+                lsn = self._log(('close', full_path, length, pages, frames, tail))
+        return True, lsn
+
+    def _layout(self, length):
+        '''
+        (pages, tail length) of a file of length bytes: the contents of a
+        small file are kept inline; otherwise they fill whole pages, and
+        a tail that is short enough is packed with the tails of other files
+        '''
+        if length <= INLINE_SIZE:
+            return 0, length
+        pages, tail = divmod(length, PAGE_SIZE)
+        if tail > TAIL_SIZE:
+            return pages + 1, 0
+        return pages, tail
+
+    def _commit_pages(self, file, length, ranges):
+        '''
+        Write (offset, data) ranges to file, whose new length is length
+        Only pages whose bytes differ are written. Each of them is copied
+        to a new frame first, so the old page table stays intact until
+        the new one replaces it; unchanged pages are shared by both.
+        If there are not enough free frames for the copies, the pages are
+        written in place instead (unless they are shared or a snapshot is
+        pinned). The old frames are kept while snapshots read them. A written page
+        identical to a frame in the index shares that frame instead.
+        A changed tail always gets a new slot
+        Returns the indexes of the pages that were written,
+        False if nothing changed, or None if the contents don't fit
+        '''
+        ps = PAGE_SIZE
+        pages = file.get_pages()
+        if self.pager is not None and not self.pager.fault_all(pages):
+            return None
+        old_length = file.get_length()
+        required, tail_length = self._layout(length)
+        head = required * ps
+        # page-aligned chunks that differ from the stored bytes
+        writes = []
+        tail_writes = []
+        for offset, data in ranges:
+            data = memoryview(data)
+            pos = 0
+            while pos < len(data):
+                start = offset + pos
+                chunk = data[pos:pos + ps - start % ps]
+                if start + len(chunk) > old_length or \
+                        file.read_from(start, len(chunk)) != chunk:
+                    (writes if start < head else tail_writes).append((start, chunk))
+                pos += len(chunk)
+        # new pages whose old bytes were in the old tail
+        carried = [i for i in range(len(pages), required) if i * ps < old_length]
+        tail = bytearray(file.read_from(head, tail_length))
+        tail.extend(bytes(tail_length - len(tail)))
+        for start, chunk in tail_writes:
+            tail[start - head:start - head + len(chunk)] = chunk
+        old_tail = file.get_tail()
+        tail_changed = len(pages) != required or \
+            bytes(file.read_from(head, TAIL_SIZE + 1)) != tail
+        if not writes and not carried and not tail_changed and length == old_length:
+            return False
+
+        dirty = sorted({start // ps for start, _ in writes}.union(carried))
+        hits = self._find_shared(file, dirty, writes, length)
+        copied = [i for i in dirty if i < min(len(pages), required) and i not in hits]
+        replaced = [i for i in hits if i < min(len(pages), required)]
+        added = [i for i in range(len(pages), required) if i not in hits]
+        slot_frames = int(tail_changed and required > 0 and tail_length > 0
+                          and self.tails.needs_frame(tail_length))
+        if self.pager is not None:
+            self.pager.make_room(len(added) + slot_frames + len(copied),
+                                 protect=pages + list(hits.values()))
+        # truncated pages give their frames back unless they are shared
+        # or the old version is pinned
+        pinned = self.versions.is_pinned()
+        available = self.allocator.get_free_count()
+        if not pinned:
+            available += sum(not self.dedup.is_shared(frame) for frame in pages[required:])
+        if len(added) + slot_frames > available:
+            return None
+        if len(added) + slot_frames + len(copied) > available:
+            if pinned or any(self.dedup.is_shared(pages[i]) for i in copied):
+                return None
+            for i in copied:
+                self.dedup.forget(pages[i])
+            copied = []
+
+        old = file.get_layout() if pinned else None
+        new_pages = pages[:required] + [None] * max(0, required - len(pages))
+        self.dedup.share(list(hits.values()), file)
+        if not pinned:
+            self.allocator.free(self.dedup.release(pages[required:], file))
+        frames = self.allocator.allocate(len(copied) + len(added), file)
+        for i, frame in zip(copied, frames):
+            self.memory.copy(new_pages[i], frame)
+            new_pages[i] = frame
+        for i, frame in zip(added, frames[len(copied):]):
+            new_pages[i] = frame
+        for i, frame in hits.items():
+            new_pages[i] = frame
+        for i in carried:
+            if i not in hits:
+                self.memory.write(new_pages, file.read_from(i * ps, ps), i * ps)
+        for start, chunk in writes:
+            if start // ps not in hits:
+                self.memory.write(new_pages, chunk, start)
+        new_tail = old_tail
+        if tail_changed:
+            new_tail = None
+            if tail_length and required == 0:
+                new_tail = bytes(tail)
+            elif tail_length:
+                new_tail = self.tails.allocate(tail_length)
+                self.tails.write(new_tail, tail)
+        # written pages identical to one another share a frame too
+        duplicates = []
+        for i in dirty:
+            if i in hits:
+                continue
+            frame = self.dedup.insert(new_pages[i], file)
+            if frame != new_pages[i]:
+                duplicates.append(new_pages[i])
+                new_pages[i] = frame
+        # readers see either the old or the new page table
+        file.set_pages(new_pages)
+        file.set_tail(new_tail)
+        file.set_length(length)
+        if self.pager is not None:
+            self.pager.touch(new_pages)
+        self.allocator.free(duplicates)
+        # frames of the old version that the new one doesn't use
+        garbage = [pages[i] for i in copied + replaced]
+        if pinned:
+            garbage += pages[required:]
+        garbage = self.versions.commit(file, old, garbage)
+        self.allocator.free(self.dedup.release(garbage, file))
+        if tail_changed and isinstance(old_tail, tuple):
+            self.tails.free(old_tail)
+        return dirty
+
+    def _find_shared(self, file, dirty, writes, length):
+        '''
+        {index: frame} of the dirty full pages whose new contents are
+        already in an indexed frame, which they can share without being
+        written. Frames of the file's own dirty pages are skipped, as
+        they may be written in place
+        '''
+        ps = PAGE_SIZE
+        pages = file.get_pages()
+        contents = {i: bytearray(file.read_from(i * ps, ps)).ljust(ps, b'\0')
+                    for i in dirty if (i + 1) * ps <= length}
+        if not contents:
+            return {}
+        for start, chunk in writes:
+            page = contents.get(start // ps)
+            if page is not None:
+                page[start % ps:start % ps + len(chunk)] = chunk
+        rewritten = {pages[i] for i in dirty if i < len(pages)}
+        hits = {}
+        for i, page in contents.items():
+            frame = self.dedup.lookup(page, rewritten)
+            if frame is not None:
+                hits[i] = frame
+        return hits
+
+    def _log(self, record):
+        '''append record to the journal; returns its lsn or None'''
+        if self.journal is None:
+            return None
+        return self.journal.append(record)
+
+    def _sync(self, lsn):
+        '''wait until the journal record lsn is durable'''
+        if lsn is not None:
+            self.journal.wait(lsn)
+
+    def _replay(self, record):
+        '''apply a journal record written by one of the operations above'''
+        op = record[0]
+        if op == 'mkdir':
+            self.mkdir(*record[1:])
+        elif op == 'create':
+            self.create(record[1])
+            file = self._lookup(record[1])
+            usage = self._usage(file)
+            self._restore_pages(file, record[2])
+            self._update_usage(file, usage)
+        elif op == 'mv':
+            self.mv(record[1], record[2])
+        elif op == 'cp':
+            self.cp(record[1], record[2])
+            self._restore_tail(self._lookup(record[2]), record[3])
+        elif op == 'delete':
+            self.delete(record[1], True)
+        elif op == 'close':
+            _, full_path, length, pages, frames, tail = record
+            file = self._lookup(full_path)
+            usage = self._usage(file)
+            self._restore_pages(file, pages)
+            self._restore_tail(file, tail)
+            file.set_length(length)
+            self._update_usage(file, usage)
+            for frame, contents in frames.items():
+                self.memory.write([frame], contents)
+
+    def _restore_pages(self, file, pages):
+        '''give file exactly the frames in pages; frames in use are shared'''
+        old = Counter(file.get_pages())
+        new = Counter(pages)
+        self.allocator.free(self.dedup.release(list((old - new).elements()), file))
+        for frame in (new - old).elements():
+            if self.allocator.is_free(frame):
+                self.allocator.reserve([frame], file)
+            else:
+                self.dedup.share([frame], file)
+        file.set_pages(list(pages))
+
+    def _restore_tail(self, file, tail):
+        '''give file the tail of a close record (see close)'''
+        old = file.get_tail()
+        if isinstance(tail, tuple):
+            frame, offset, contents = tail
+            if old != (frame, offset):
+                self.tails.reserve((frame, offset), len(contents))
+            self.tails.write((frame, offset), contents)
+            tail = (frame, offset)
+        if isinstance(old, tuple) and old != tail:
+            self.tails.free(old)
+        file.set_tail(tail)
 
     def _exists(self, path):
         '''
         Provide a path to directory or file
         and check if it exists in this data structure
         '''
-        return self.fs.contains(path)
+        return self._lookup(path) is not None
+
+    def _link(self, directory, node):
+        '''add node to directory, to the rendered tree and to the usage'''
+        directory.add_child(node)
+        self.view.added(directory, node)
+        self._account(directory, *self._usage(node))
+        self.version += 1
+
+    def _unlink(self, node):
+        '''detach node from its parent, from the rendered tree and from the usage'''
+        directory = node.parent
+        directory.remove_child(node.get_name())
+        self.view.removed(directory, node.get_name())
+        size, pages = self._usage(node)
+        self._account(directory, -size, -pages)
+        self.version += 1
+
+    def _usage(self, node):
+        '''(bytes, pages) of a file, or of every file below a directory'''
+        if isinstance(node, Directory):
+            return node.get_usage()
+        return node.get_size(), len(node.get_pages())
 
-    def _are_frames_available(self, file, content):
-        '''check if the new content can be allocated to the file'''
-        num_frames_required = ceil(sys.getsizeof(content) / 64)
-        num_frames_released = len(file.get_pages())
-        # number of 0s -> number of free frames + the number of pages that are released
-        num_free_frames = len(self.free_frames) - \
-            sum(self.free_frames) + num_frames_released
-        return num_free_frames >= num_frames_required
+    def _account(self, directory, size, pages):
+        '''add size and pages to directory and to all of its ancestors'''
+        while directory is not None:
+            directory.used_bytes += size
+            directory.used_pages += pages
+            directory = directory.parent
 
-    def _allocate_pages(self, file):
+    def _update_usage(self, file, old):
         '''
-        file -> File object in tree
+        Roll the change of file's size and pages since its usage was old
+        up to its ancestors and the memory map
         '''
-        size = file.get_size()
-        pages = file.get_pages()
+        size, pages = self._usage(file)
+        if file.parent is not None:
+            self._account(file.parent, size - old[0], pages - old[1])
+        if file.get_frames():
+            self.mapped[id(file)] = file
+        else:
+            self.mapped.pop(id(file), None)
+
+    def _discard(self, node):
+        '''
+        Reclaim the frames and tail slots of the files below a detached node
+        Each file commits an empty version (see versions.py), so snapshots
+        taken before keep reading it; the frames of all the files are then
+        freed in one allocator call, or retired until those snapshots are
+        released. Shared frames only lose a reference, and swapped out
+        pages leave the swap file
+        '''
+        pinned = self.versions.is_pinned()
+        garbage = []
+        # frames of packed tails left without a slot
+        emptied = []
+        for file in self._walk(node):
+            if not isinstance(file, File):
+                continue
+            self.mapped.pop(id(file), None)
+            pages = file.get_pages()
+            if self.pager is not None:
+                # versions kept for snapshots are resident
+                if pinned:
+                    self.pager.fault_all(pages)
+                pages = self.pager.release(pages)
+            old = file.get_layout() if pinned else None
+            tail = file.get_tail()
+            if isinstance(tail, tuple):
+                self.tails.free(tail, emptied)
+            file.set_pages([])
+            file.set_tail(None)
+            file.set_length(0)
+            garbage.extend(self.dedup.release(self.versions.commit(file, old, pages), file))
+        self.allocator.free(garbage + emptied)
+
+    def _index(self):
+        '''
+        Rebuild the usage of every directory, the memory map, the frame
+        owners, the reference counts of shared frames and the packed tails
+        from the tree (e.g. after mounting a volume). The contents of the
+        frames aren't indexed again
+        '''
+        self.mapped = {}
+        self.tails = TailPacker(self.allocator, self.memory)
+        self.dedup = PageIndex(self.allocator, self.memory)
+        # frames referenced by a file so far
+        references = set()
+        for node in self._walk():
+            if isinstance(node, Directory):
+                node.used_bytes = node.used_pages = 0
+        for node in self._walk():
+            if isinstance(node, File):
+                self._account(node.parent, *self._usage(node))
+                if node.get_frames():
+                    self.mapped[id(node)] = node
+                for page in node.get_pages():
+                    # every reference after the first of a frame shares it
+                    if page in references:
+                        self.dedup.share([page], node)
+                    else:
+                        references.add(page)
+                        self.allocator.set_owner([page], node)
+                tail = node.get_tail()
+                if isinstance(tail, tuple):
+                    self.tails.reserve(
+                        tail, node.get_length() - len(node.get_pages()) * PAGE_SIZE)
+
+    def _lookup(self, path):
+        '''
+        Find the Directory or File at an absolute path
+        Returns None if missing
+        '''
+        return self.resolver.lookup(path, self._walk_path)
 
-        # under-allocated file
-        while len(pages) < ceil(size / 64):
-            # find a free page
-            page = self.free_frames.index(0)
-            self.free_frames[page] = 1
-            pages.append(page)
-        # over-allocated file
-        if len(pages) > ceil(size / 64):
-            required = ceil(size / 64)
-            for i, pg_num in enumerate(pages):
-                if i > required:
-                    self.free_frames[pg_num] = 0
-            pages = pages[:required]
-        file.set_pages(pages)
+    def _walk_path(self, path):
+        '''walk one child dict per path component of an absolute path'''
+        node = self.root
+        root_path = self.root.get_path()
+        if not path.startswith(root_path):
+            return None
+        for name in path[len(root_path):].split(SEP):
+            if not name:
+                continue
+            if not isinstance(node, Directory):
+                return None
+            node = node.get_child(name)
+            if node is None:
+                return None
+        return node
+
+    def _lookup_dir(self, path):
+        node = self._lookup(path)
+        return node if isinstance(node, Directory) else None
+
+    def _lookup_file(self, path):
+        node = self._lookup(path)
+        return node if isinstance(node, File) else None
+
+    def _walk(self, directory=None):
+        '''every node below directory (default: root) in depth-first order'''
+        stack = [directory or self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            if isinstance(node, Directory):
+                stack.extend(reversed(list(node.children.values())))
 
     def _get_components(self, path):
         '''
@@ -222,43 +1013,22 @@ class FileSystem:
             1. Name of node
             2. Path to node's parent
             3. The absolute node path
+        Relative paths are resolved against the current directory
         '''
-        # special case
-        if path == SEP:
-            return (SEP,) * 3
-        elif path.lower() == "c:" + SEP:
-            return ("c:") * 3
-
-        p = Path(path)
-        # node name
-        name = get_name(path)
-        # directory path of parent
-        parent_path = str(p.parent)
-        # absolute path
-        if p.is_absolute():
-            full_path = str(p.absolute())
-            return (name, parent_path, full_path)
-        # relative path
-        else:
-            # if path to directory, then nodes[-1] might be a '', so remove it
-            nodes = path.split('/')
-            if nodes[-1] == '':
-                nodes = nodes[:-1]
-            # current directory
-            current_dir = self.curr_pointer.get_path()
-            for node in nodes:
-                # parent directory
-                if node == '..':
-                    current_dir = get_parent(current_dir)
-                # current directory
-                elif node == '.':
-                    continue
-                else:
-                    current_dir = os.path.join(current_dir, node)
-            name = Path(current_dir).name
-            # exclude the base node
-            current_dir = get_parent(current_dir)
-            return (name, current_dir, os.path.join(current_dir, name))
+        return self.resolver.components(self.cwd, path)
+
+def _frame_name(frame):
+    '''a page table entry for the memory map: its frame or its swap slot'''
+    return frame if frame >= 0 else f'swap:{-1 - frame}'
+
+
+def _owner_name(owner):
+    '''path of the File owning a frame, or what else owns it'''
+    if owner is None:
+        return None
+    if isinstance(owner, File):
+        return owner.get_path()
+    return str(owner)
 
 
 if __name__ == '__main__':
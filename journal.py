@@ -0,0 +1,248 @@
+'''
+Write-ahead journal
+
+Every committed change to a FileSystem is appended to the journal before the
+operation returns. Records are tuples:
+    ('mkdir', full_path)
+    ('create', full_path, pages)
+    ('mv', src_full_path, dst_full_path)
+    ('cp', src_full_path, dst_full_path, tail)
+    ('delete', full_path)
+    ('close', full_path, length, pages, {frame: page contents}, tail)
+A close record carries the file's new page table and the contents of the
+frames written by that close, so replaying it is idempotent. tail is the
+file's tail: None, the inline bytes, or (frame, offset, bytes) of a slot.
+A frame may appear in several page tables (see dedup.py).
+
+On disk each record is HEADER (payload length, crc32 of payload, lsn)
+followed by the pickled record. A torn record at the end of the journal
+(crash in the middle of a write) fails its checksum and ends the replay.
+
+Appends are made durable in groups: a single writer thread collects every
+record appended since its last write and fsyncs them together, so threads
+committing at the same time share one fsync.
+'''
+import os
+import pickle
+import struct
+import threading
+import zlib
+from time import perf_counter_ns, sleep
+
+import volume
+
+HEADER = struct.Struct('<IIQ')
+
+
+def read_records(path):
+    '''
+    Yield (lsn, record) for every intact record in the journal at path
+    Stops at the first torn or corrupt record
+    '''
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            size, crc, lsn = HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                return
+            yield lsn, pickle.loads(payload)
+
+
+def _valid_length(path):
+    '''number of bytes taken by the intact records of the journal'''
+    length = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return length
+            size, crc, _ = HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size or zlib.crc32(payload) != crc:
+                return length
+            length += HEADER.size + size
+
+
+class Journal:
+    def __init__(self, path, next_lsn=1, group_delay=0.0):
+        '''
+        path: journal file; records are appended to it
+        next_lsn: log sequence number of the next record
+        group_delay: seconds the writer waits for more records before an fsync
+        '''
+        self.path = path
+        self.file = open(path, 'ab')
+        self.group_delay = group_delay
+        self.cond = threading.Condition()
+        # encoded records waiting to be written
+        self.pending = []
+        self.next_lsn = next_lsn
+        # every record up to durable_lsn is on disk
+        self.durable_lsn = next_lsn - 1
+        self.closed = False
+        self.stats = {
+            'records': 0,
+            'batches': 0,
+            'bytes': 0,
+            'fsync_ns': 0,
+        }
+        self.writer = threading.Thread(target=self._write_batches, daemon=True)
+        self.writer.start()
+
+    def append(self, record):
+        '''queue record for writing and return its lsn'''
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.cond:
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            self.pending.append(
+                HEADER.pack(len(payload), zlib.crc32(payload), lsn) + payload)
+            self.cond.notify_all()
+        return lsn
+
+    def wait(self, lsn):
+        '''block until the record lsn is on disk'''
+        with self.cond:
+            while self.durable_lsn < lsn and not self.closed:
+                self.cond.wait()
+
+    def commit(self, record):
+        '''append record and wait until it is durable'''
+        lsn = self.append(record)
+        self.wait(lsn)
+        return lsn
+
+    def last_lsn(self):
+        return self.next_lsn - 1
+
+    def size(self):
+        return self.file.tell()
+
+    def _write_batches(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending and self.closed:
+                    return
+            # let more committers join this batch
+            if self.group_delay:
+                sleep(self.group_delay)
+            with self.cond:
+                batch = self.pending
+                self.pending = []
+                last = self.next_lsn - 1
+            data = b''.join(batch)
+            t0 = perf_counter_ns()
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.cond:
+                self.stats['records'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['bytes'] += len(data)
+                self.stats['fsync_ns'] += perf_counter_ns() - t0
+                self.durable_lsn = last
+                self.cond.notify_all()
+
+    def reset(self):
+        '''
+        Discard every record once they are folded into the volume image
+        The caller must make sure no record is appended meanwhile
+        '''
+        self.wait(self.last_lsn())
+        with self.cond:
+            self.file.truncate(0)
+            self.file.seek(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.writer.join()
+        self.file.close()
+
+
+class Checkpointer:
+    def __init__(self, fs, interval=5.0, max_journal_size=1 << 20):
+        '''
+        fs: FileSystem with a journal and a volume image
+        interval: seconds between checkpoints
+        max_journal_size: checkpoint early once the journal grows past this
+        '''
+        self.fs = fs
+        self.interval = interval
+        self.max_journal_size = max_journal_size
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run(self):
+        waited = 0.0
+        # poll often so a fast-growing journal is folded in early
+        step = min(self.interval, 0.1)
+        while not self.stop_event.wait(step):
+            waited += step
+            journal = self.fs.journal
+            if waited >= self.interval or journal.size() >= self.max_journal_size:
+                self.checkpoint()
+                waited = 0.0
+
+    def checkpoint(self):
+        '''
+        Fold the journal into the volume image and empty the journal
+        Operations on the file system wait while the checkpoint runs
+        '''
+        fs = self.fs
+        with fs.lock:
+            lsn = fs.journal.last_lsn()
+            if lsn == fs.checkpoint_lsn:
+                return lsn
+            fs.journal.wait(lsn)
+            volume.checkpoint(fs, lsn)
+            fs.journal.reset()
+        return lsn
+
+
+def recover(fs_class, volume_path, journal_path, interval=5.0,
+            max_journal_size=1 << 20, group_delay=0.0):
+    '''
+    Open a journaled file system
+    Mounts the volume image (or creates it), replays the records written
+    after its last checkpoint, then attaches a journal and starts a
+    Checkpointer. Returns the FileSystem object, or 1 if volume_path
+    is not a supported volume image
+    '''
+    if os.path.exists(volume_path):
+        fs = fs_class.load(volume_path)
+        if fs == 1:
+            return 1
+    else:
+        fs = fs_class()
+        fs.save(volume_path)
+    lsn = fs.checkpoint_lsn
+    for record_lsn, record in read_records(journal_path):
+        if record_lsn > lsn:
+            fs._replay(record)
+            lsn = record_lsn
+    # drop a torn record left by a crash
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r+b') as f:
+            f.truncate(_valid_length(journal_path))
+    fs.attach_journal(Journal(journal_path, lsn + 1, group_delay))
+    fs.checkpointer = Checkpointer(fs, interval, max_journal_size).start()
+    return fs
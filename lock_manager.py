@@ -0,0 +1,291 @@
+import threading
+from collections import deque
+from time import monotonic, perf_counter_ns
+
+# failure status returned by LockManager.acquire()
+TIMED_OUT = 0
+DEADLOCK = 1
+
+# byte range [start, end) of a file; an end of None reaches past its end,
+# so the holder may also grow or truncate the file
+WHOLE = (0, None)
+
+
+def merge(ranges):
+    '''the byte ranges covered by ranges, sorted and disjoint'''
+    merged = []
+    for start, end in sorted(ranges, key=lambda r: r[0]):
+        if merged and (merged[-1][1] is None or start <= merged[-1][1]):
+            last = merged[-1][1]
+            merged[-1] = (merged[-1][0],
+                          None if last is None or end is None else max(last, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def covers(ranges, start, end):
+    '''whether ranges cover every byte of [start, end)'''
+    if end is not None and end <= start:
+        return True
+    for first, last in merge(ranges):
+        if first <= start and (last is None or (end is not None and end <= last)):
+            return True
+    return False
+
+
+def overlaps(a, b):
+    return (a[1] is None or b[0] < a[1]) and (b[1] is None or a[0] < b[1])
+
+
+def conflicts(mode, ranges, other, other_ranges):
+    '''
+    whether writers holding ranges in mode and other_ranges in other conflict
+    'w' writers conflict when their ranges overlap. 'a' appenders never
+    conflict with each other, and only conflict with the writers that
+    hold the end of the file: appended bytes land past every other range
+    '''
+    if mode == 'a' and other == 'a':
+        return False
+    if mode == 'a':
+        return any(end is None for _, end in other_ranges)
+    if other == 'a':
+        return any(end is None for _, end in ranges)
+    return any(overlaps(a, b) for a in ranges for b in other_ranges)
+
+
+class FileLock:
+    '''
+    Reader/writer/appender lock state of one file
+    All FileLocks of a LockManager share its mutex; each has its own
+    condition variable so a release only wakes the waiters of that file
+    '''
+
+    def __init__(self, mutex):
+        # owner -> mode
+        self.holders = {}
+        # owner -> byte ranges it holds (empty for readers and appenders)
+        self.ranges = {}
+        # waiting requests in arrival order: [owner, mode, ranges]
+        self.queue = deque()
+        self.cond = threading.Condition(mutex)
+        # owner -> when it was granted the lock (perf_counter_ns)
+        self.granted = {}
+
+
+class LockManager:
+    '''
+    Per-file reader/writer locks on byte ranges
+
+    modes:
+        'r' -> read the file
+        'w' -> write byte ranges of the file (the whole file by default);
+               writers of disjoint ranges hold the file at the same time
+        'a' -> append to the file; appenders never conflict with each
+               other, only with writers holding the end of the file
+
+    isolation:
+        'snapshot' -> readers never conflict; they read the version that
+                      was committed when they opened the file while a
+                      writer works on its own copy. Only writers exclude
+                      each other
+        'strict'   -> classic reader/writer lock; a writer excludes readers
+    policy:
+        'writer'   -> waiting writers are granted before waiting readers
+        'fifo'     -> requests are granted in arrival order
+    timeout: default seconds to wait for a lock (None waits forever)
+
+    Owners are the thread ids used by thread_runner. Before an owner blocks,
+    the wait-for graph across all files is checked; if waiting would close
+    a cycle, the request fails with DEADLOCK instead.
+    '''
+
+    def __init__(self, isolation='snapshot', policy='writer', timeout=None):
+        self.isolation = isolation
+        self.policy = policy
+        self.timeout = timeout
+        self.mutex = threading.Lock()
+        # fname -> FileLock, while it is held or waited for
+        self.locks = {}
+        # fname -> wait and hold time statistics (nanoseconds)
+        self.stats = {}
+        # owner -> fname it is waiting for
+        self.waiting = {}
+
+    def _conflicts(self, mode, ranges, other, other_ranges):
+        if 'r' in (mode, other):
+            return self.isolation == 'strict' and mode != other
+        return conflicts(mode, ranges, other, other_ranges)
+
+    def _blockers(self, lock, owner, mode, ranges):
+        '''owners that must release or be granted before owner can be granted'''
+        blockers = {holder for holder, held in lock.holders.items()
+                    if holder != owner and
+                    self._conflicts(mode, ranges, held, lock.ranges[holder])}
+        # a holder adding ranges doesn't queue behind new requests
+        if owner in lock.holders:
+            return blockers
+        earlier = True
+        for waiter, wanted, wanted_ranges in lock.queue:
+            if waiter == owner:
+                earlier = False
+                continue
+            conflict = self._conflicts(mode, ranges, wanted, wanted_ranges)
+            if self.policy == 'fifo':
+                if earlier and conflict:
+                    blockers.add(waiter)
+            # writer-preferring: readers give way to every waiting writer,
+            # writers to the writers that arrived before them
+            elif wanted != 'r' and conflict and (earlier or mode == 'r'):
+                blockers.add(waiter)
+        return blockers
+
+    def _would_deadlock(self, owner):
+        '''check if owner can reach itself in the wait-for graph'''
+        stack = [owner]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            fname = self.waiting.get(current)
+            if fname is None:
+                continue
+            lock = self.locks[fname]
+            mode, ranges = next((wanted, wanted_ranges)
+                                for waiter, wanted, wanted_ranges in lock.queue
+                                if waiter == current)
+            for blocker in self._blockers(lock, current, mode, ranges):
+                if blocker == owner:
+                    return True
+                if blocker not in seen:
+                    seen.add(blocker)
+                    stack.append(blocker)
+        return False
+
+    def acquire(self, fname, owner, mode, timeout=-1, ranges=None):
+        '''
+        Block until owner holds fname in mode ('r', 'w' or 'a')
+        timeout: seconds to wait; -1 uses the manager's default
+        ranges: byte ranges a writer locks, [(start, end), ...];
+                None locks the whole file
+        If owner already holds fname for writing, ranges are added to
+        the ones it holds
+        Returns True, TIMED_OUT or DEADLOCK
+        '''
+        if timeout == -1:
+            timeout = self.timeout
+        if ranges is None:
+            ranges = [WHOLE] if mode == 'w' else []
+        with self.mutex:
+            lock = self.locks.get(fname)
+            if lock is None:
+                lock = self.locks[fname] = FileLock(self.mutex)
+            request = [owner, mode, ranges]
+            lock.queue.append(request)
+            if not self._blockers(lock, owner, mode, ranges):
+                lock.queue.remove(request)
+                self._grant(fname, lock, owner, mode, ranges)
+                return True
+
+            stats = self._stats(fname)
+            t0 = perf_counter_ns()
+            deadline = None if timeout is None else monotonic() + timeout
+            self.waiting[owner] = fname
+            result = True
+            while self._blockers(lock, owner, mode, ranges):
+                if self._would_deadlock(owner):
+                    stats['deadlocks'] += 1
+                    result = DEADLOCK
+                    break
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    stats['timeouts'] += 1
+                    result = TIMED_OUT
+                    break
+                lock.cond.wait(remaining)
+            del self.waiting[owner]
+            lock.queue.remove(request)
+            elapsed = perf_counter_ns() - t0
+            stats['waits'] += 1
+            stats['wait_ns'] += elapsed
+            if elapsed > stats['max_wait_ns']:
+                stats['max_wait_ns'] = elapsed
+            if result is True:
+                self._grant(fname, lock, owner, mode, ranges)
+            # leaving the queue may unblock the requests behind this one
+            lock.cond.notify_all()
+            self._forget(fname, lock)
+            return result
+
+    def _grant(self, fname, lock, owner, mode, ranges):
+        if owner in lock.holders:
+            lock.ranges[owner].extend(ranges)
+        else:
+            lock.holders[owner] = mode
+            lock.ranges[owner] = list(ranges)
+            lock.granted[owner] = perf_counter_ns()
+        self._stats(fname)['acquired'] += 1
+
+    def release(self, fname, owner):
+        '''
+        Release owner's lock on fname
+        Returns False if owner did not hold it
+        '''
+        with self.mutex:
+            lock = self.locks.get(fname)
+            if lock is None or owner not in lock.holders:
+                return False
+            del lock.holders[owner]
+            del lock.ranges[owner]
+            held = perf_counter_ns() - lock.granted.pop(owner)
+            stats = self.stats[fname]
+            stats['hold_ns'] += held
+            if held > stats['max_hold_ns']:
+                stats['max_hold_ns'] = held
+            lock.cond.notify_all()
+            self._forget(fname, lock)
+            return True
+
+    def _forget(self, fname, lock):
+        '''drop the lock of fname once nobody holds or waits for it'''
+        if not lock.holders and not lock.queue:
+            del self.locks[fname]
+
+    def _stats(self, fname):
+        stats = self.stats.get(fname)
+        if stats is None:
+            stats = self.stats[fname] = {
+                'acquired': 0, 'waits': 0, 'wait_ns': 0, 'max_wait_ns': 0,
+                'timeouts': 0, 'deadlocks': 0, 'hold_ns': 0, 'max_hold_ns': 0}
+        return stats
+
+    def mode(self, fname, owner):
+        '''mode in which owner holds fname, or None'''
+        with self.mutex:
+            lock = self.locks.get(fname)
+            if lock is None:
+                return None
+            return lock.holders.get(owner)
+
+    def ranges(self, fname, owner):
+        '''byte ranges owner holds of fname'''
+        with self.mutex:
+            lock = self.locks.get(fname)
+            if lock is None:
+                return []
+            return list(lock.ranges.get(owner, ()))
+
+    def holders(self, fname):
+        '''owner -> mode for every holder of fname'''
+        with self.mutex:
+            lock = self.locks.get(fname)
+            return dict(lock.holders) if lock else {}
+
+    def get_stats(self, fname=None):
+        '''
+        Wait and hold time statistics (nanoseconds) of one file,
+        or of every file when fname is None
+        '''
+        with self.mutex:
+            if fname is not None:
+                return dict(self.stats.get(fname, {}))
+            return {name: dict(stats) for name, stats in self.stats.items()}
@@ -1,40 +1,68 @@
+import argparse
+import glob
 import os
 from concurrent.futures import ThreadPoolExecutor
 
+from commands import read_script
 from filesystem import FileSystem
+from scheduler import schedule
 from thread_runner import thread_runner
 
-# files = [
-#     "input_thread1.txt",
-#     "input_thread2.txt"
-# ]
+parser = argparse.ArgumentParser(
+    description='Run command scripts against one file system')
+parser.add_argument('scripts', nargs='*',
+                    help="script files or glob patterns (e.g. 'inputs/*.txt'); "
+                         "asks for filenames if none are given")
+parser.add_argument('--scheduler', choices=('threads', 'async'), default='threads',
+                    help="'threads': one thread per script; "
+                         "'async': every script is a coroutine on one event loop")
+parser.add_argument('--workers', type=int, default=None,
+                    help='threads (threads scheduler, default: one per script) or '
+                         'scripts running commands at once (async scheduler, default: 8)')
+parser.add_argument('--tree-output', choices=('full', 'delta'), default='full',
+                    help='write the whole tree or only the change after mkdir/create/mv/delete')
+parser.add_argument('--output-dir', default='.',
+                    help='directory of the output_thread<n>.txt files')
+parser.add_argument('--swap', metavar='PATH', default=None,
+                    help='swap file to evict pages to when the frames run out')
+parser.add_argument('--swap-policy', choices=('lru', 'clock'), default='lru',
+                    help='page replacement policy of --swap')
+args = parser.parse_args()
 
 files = []
+for pattern in args.scripts:
+    matches = sorted(glob.glob(pattern))
+    if not matches:
+        print(f"{pattern}: file not found.")
+    files.extend(name for name in matches if os.path.isfile(name))
 
-while True:
-    name = input("Enter a filename or 'x' to exit:  ")
-    if name == 'x':
-        break
-    elif os.path.exists(name) and os.path.isfile(name):
-        files.append(name)
-    else:
-        print("File not found.")
+if not args.scripts:
+    while True:
+        name = input("Enter a filename or 'x' to exit:  ")
+        if name == 'x':
+            break
+        elif os.path.exists(name) and os.path.isfile(name):
+            files.append(name)
+        else:
+            print("File not found.")
 
 fs = FileSystem()
-fs_duplicated = [fs] * len(files)
-outfiles = [f'output_thread{i+1}.txt' for i in range(len(files))]
+if args.swap:
+    fs.enable_swap(args.swap, args.swap_policy)
+outfiles = [os.path.join(args.output_dir, f'output_thread{i+1}.txt')
+            for i in range(len(files))]
 # clear contents of file
 for outfile in outfiles:
     if os.path.exists(outfile):
         open(outfile, "w").close()
-commands_per_file = list()
-for input_file in files:
-    with open(input_file) as f:
-        commands = f.readlines()
-        # remove newlines
-        commands = [command.strip() for command in commands]
-    commands_per_file.append(commands)
-args = tuple(zip(range(len(files)), outfiles,
-             fs_duplicated, commands_per_file))
-with ThreadPoolExecutor(max_workers=len(files)) as executor:
-    executor.map(lambda p: thread_runner(*p), args)
+# scripts are read and compiled line by line while they run
+commands_per_file = [read_script(input_file) for input_file in files]
+
+if args.scheduler == 'async':
+    schedule(fs, commands_per_file, outfiles, workers=args.workers or 8,
+             tree_output=args.tree_output)
+elif files:
+    with ThreadPoolExecutor(max_workers=args.workers or len(files)) as executor:
+        executor.map(lambda p: thread_runner(*p, tree_output=args.tree_output),
+                     zip(range(len(files)), outfiles, [fs] * len(files),
+                         commands_per_file))
@@ -0,0 +1,73 @@
+import mmap
+
+from util import NUM_FRAMES, PAGE_SIZE
+
+
+class PhysicalMemory:
+    '''
+    One contiguous buffer that holds the contents of every frame
+    Frame n occupies bytes [n * PAGE_SIZE, (n + 1) * PAGE_SIZE)
+    Files address it through their page table (list of frame numbers),
+    so byte i of a file lives in frame pages[i // PAGE_SIZE]
+    '''
+
+    def __init__(self, num_frames=NUM_FRAMES, page_size=PAGE_SIZE, buffer=None):
+        '''
+        num_frames: number of frames
+        page_size: size of a frame in bytes
+        buffer: existing buffer to use instead of anonymous memory
+        '''
+        self.num_frames = num_frames
+        self.page_size = page_size
+        if buffer is None:
+            buffer = mmap.mmap(-1, num_frames * page_size)
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        # frames written since the last checkpoint of the volume image
+        self.dirty = set()
+
+    def write(self, pages, data, start=0):
+        '''
+        Write data at logical offset start of the file owning pages
+        The pages must already cover start + len(data) bytes
+        '''
+        ps = self.page_size
+        data = memoryview(data)
+        written = 0
+        while written < len(data):
+            offset = start + written
+            page, in_page = divmod(offset, ps)
+            chunk = min(ps - in_page, len(data) - written)
+            addr = pages[page] * ps + in_page
+            self.view[addr:addr + chunk] = data[written:written + chunk]
+            self.dirty.add(pages[page])
+            written += chunk
+
+    def copy(self, src, dst):
+        '''copy the contents of frame src to frame dst'''
+        ps = self.page_size
+        self.view[dst * ps:(dst + 1) * ps] = self.view[src * ps:(src + 1) * ps]
+        self.dirty.add(dst)
+
+    def read(self, pages, start, size):
+        '''
+        Read size bytes from logical offset start of the file owning pages
+        Only the pages covering [start, start + size) are touched
+        If those pages are consecutive frames, the result is a slice of
+        the buffer (no copy); otherwise they are gathered into a new buffer
+        '''
+        if size <= 0:
+            return self.view[0:0]
+        ps = self.page_size
+        first = start // ps
+        last = (start + size - 1) // ps
+        base = pages[first]
+        # consecutive frames -> zero-copy view
+        if all(pages[first + i] == base + i for i in range(1, last - first + 1)):
+            addr = base * ps + start % ps
+            return self.view[addr:addr + size]
+        gathered = bytearray()
+        for frame in pages[first:last + 1]:
+            gathered += self.view[frame * ps:(frame + 1) * ps]
+        offset = start - first * ps
+        return memoryview(gathered)[offset:offset + size]
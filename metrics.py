@@ -0,0 +1,260 @@
+'''
+Instrumentation of the file system
+
+Metrics holds a latency histogram per FileSystem method (filled in by the
+timed decorator) and histograms of the transactions committed by close.
+FileSystem.stats() combines it with the counters the allocator, the lock
+manager and the journal keep themselves; prometheus() renders that dict
+in the Prometheus text format for the /metrics route of api.py.
+
+SamplingProfiler periodically records the stack of every thread; it costs
+nothing until it is started and can be started and stopped at any time.
+'''
+import functools
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter
+from time import perf_counter_ns
+
+# upper bounds of the latency buckets (nanoseconds): 1us to 67ms
+LATENCY_BUCKETS = tuple(1000 * 4 ** i for i in range(9))
+# upper bounds of the transaction size buckets (bytes / pages)
+BYTE_BUCKETS = tuple(16 * 4 ** i for i in range(9))
+PAGE_BUCKETS = (1, 2, 4, 8, 16, 64, 256, 1024)
+
+
+class Histogram:
+    '''Counts of observed values per bucket; buckets are upper bounds'''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last count is of the values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_stats(self):
+        '''count, sum and [bound, cumulative count] per bucket'''
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append([bound, total])
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Metrics:
+    '''Operation latencies and transaction sizes of one FileSystem'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # method name -> Histogram of latencies (nanoseconds)
+        self.ops = {}
+        self.close_bytes = Histogram(BYTE_BUCKETS)
+        self.close_pages = Histogram(PAGE_BUCKETS)
+
+    def observe(self, op, elapsed):
+        with self.lock:
+            histogram = self.ops.get(op)
+            if histogram is None:
+                histogram = self.ops[op] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(elapsed)
+
+    def transaction(self, written, pages):
+        '''
+        written: bytes of the ranges a close committed
+        pages: pages it rewrote
+        '''
+        with self.lock:
+            self.close_bytes.observe(written)
+            self.close_pages.observe(pages)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'ops': {op: histogram.get_stats()
+                        for op, histogram in sorted(self.ops.items())},
+                'transactions': {'bytes': self.close_bytes.get_stats(),
+                                 'pages': self.close_pages.get_stats()},
+            }
+
+
+def timed(method):
+    '''record the latency of a FileSystem method in self.metrics'''
+    op = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        t0 = perf_counter_ns()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.metrics.observe(op, perf_counter_ns() - t0)
+    return wrapper
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of every other thread each interval seconds
+    Samples are counted per stack (outermost frame first), which is the
+    input of flame graph tools (see folded)
+    '''
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = Counter()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def clear(self):
+        self.samples = Counter()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.samples[tuple(reversed(stack))] += 1
+
+    def folded(self):
+        '''one "frame;frame;... count" line per stack, most sampled first'''
+        return '\n'.join(f'{";".join(stack)} {count}'
+                         for stack, count in self.samples.most_common())
+
+    def top(self, n=20):
+        '''[function, samples] of the n functions most often on top of a stack'''
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            if stack:
+                leaves[stack[-1]] += count
+        return [list(item) for item in leaves.most_common(n)]
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in zip(labels, escaped)) + '}'
+
+
+def _histogram(lines, name, stats, scale=1, **labels):
+    '''lines of a Prometheus histogram; values are divided by scale'''
+    for bound, count in stats['buckets']:
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound / scale)} {count}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {stats["count"]}')
+    lines.append(f'{name}_sum{_labels(**labels)} {stats["sum"] / scale}')
+    lines.append(f'{name}_count{_labels(**labels)} {stats["count"]}')
+
+
+def prometheus(stats, prefix='zos'):
+    '''FileSystem.stats() in the Prometheus text exposition format'''
+    lines = []
+
+    def metric(name, kind, help):
+        lines.append(f'# HELP {prefix}_{name} {help}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        return f'{prefix}_{name}'
+
+    name = metric('operation_seconds', 'histogram', 'Latency of FileSystem methods')
+    for op, histogram in stats['ops'].items():
+        _histogram(lines, name, histogram, 1e9, op=op)
+    name = metric('close_bytes', 'histogram', 'Bytes written by each committed close')
+    _histogram(lines, name, stats['transactions']['bytes'])
+    name = metric('close_pages', 'histogram', 'Pages rewritten by each committed close')
+    _histogram(lines, name, stats['transactions']['pages'])
+
+    allocator = stats['allocator']
+    name = metric('frames', 'gauge', 'Physical frames by state')
+    lines.append(f'{name}{_labels(state="free")} {allocator["free_count"]}')
+    lines.append(f'{name}{_labels(state="used")} {allocator["used_count"]}')
+    for key, help in (('free_extents', 'Runs of consecutive free frames'),
+                      ('largest_free_extent', 'Frames in the largest free run'),
+                      ('fragmentation', 'Share of free frames outside the largest free run')):
+        name = metric(f'allocator_{key}', 'gauge', help)
+        lines.append(f'{name} {allocator[key]}')
+
+    for key, value in stats.get('tails', {}).items():
+        name = metric(f'tails_{key}', 'gauge', f'Packed tail {key.replace("_", " ")}')
+        lines.append(f'{name} {value}')
+    def section(key, fields):
+        '''a (field, kind, help) table of one dict of stats'''
+        values = stats.get(key, {})
+        for field, kind, help in fields:
+            if field in values:
+                suffix = '_total' if kind == 'counter' else ''
+                name = metric(f'{key}_{field}{suffix}', kind, help)
+                lines.append(f'{name} {values[field]}')
+
+    section('dedup', (
+        ('shared_frames', 'gauge', 'Frames referenced by more than one page'),
+        ('shared_refs', 'gauge', 'Page references served by shared frames'),
+        ('indexed_frames', 'gauge', 'Frames in the page contents index'),
+        ('hits', 'counter', 'Written pages that shared an identical frame')))
+    section('swap', (
+        ('hits', 'counter', 'Page accesses that found the page in a frame'),
+        ('misses', 'counter', 'Page accesses that faulted it in from swap'),
+        ('evictions', 'counter', 'Pages moved to swap'),
+        ('swapped_pages', 'gauge', 'Pages in swap'),
+        ('swap_slots', 'gauge', 'Page slots in the swap file')))
+    section('versions', (
+        ('version', 'gauge', 'Number of the last committed file version'),
+        ('snapshots', 'counter', 'Snapshots taken'),
+        ('pinned', 'gauge', 'Snapshots not yet released'),
+        ('kept', 'counter', 'Old file versions kept for snapshots'),
+        ('history', 'gauge', 'Old file versions still kept'),
+        ('retired', 'counter', 'Frames whose release waited for snapshots'),
+        ('retired_frames', 'gauge', 'Frames waiting for snapshots to be released')))
+
+    locks = [(manager, fname, lock) for manager in ('thread', 'session')
+             for fname, lock in stats.get(manager + '_locks', {}).items()]
+    for key, kind, help, scale in (
+            ('acquired', 'counter', 'File locks granted', 1),
+            ('waits', 'counter', 'File lock requests that had to wait', 1),
+            ('wait_ns', 'counter', 'Time spent waiting for file locks', 1e9),
+            ('hold_ns', 'counter', 'Time file locks were held', 1e9),
+            ('timeouts', 'counter', 'File lock requests that timed out', 1),
+            ('deadlocks', 'counter', 'File lock requests refused to avoid a deadlock', 1)):
+        suffix = '_seconds' if key.endswith('_ns') else ''
+        name = metric(f'lock_{key.replace("_ns", "")}{suffix}_total', kind, help)
+        for manager, fname, lock in locks:
+            if key in lock:
+                value = lock[key] / scale if scale != 1 else lock[key]
+                lines.append(f'{name}{_labels(manager=manager, file=fname)} {value}')
+
+    for key, value in stats.get('journal', {}).items():
+        name = metric(f'journal_{key}', 'counter', f'Journal {key}')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,151 @@
+'''
+Buffered output for thread_runner
+
+Each runner writes its messages to its own OutputSink. A write only appends
+to an in-memory buffer; the file is written by a background flusher thread
+according to the sink's flush policy:
+    'size' -> once the buffer holds max_bytes
+    'time' -> every interval seconds
+    'exit' -> only when the sink is closed
+Every sink is flushed when it is closed and when the interpreter exits.
+'''
+import atexit
+import threading
+from time import monotonic
+
+
+class OutputSink:
+    def __init__(self, path, policy='size', max_bytes=1 << 16, interval=1.0,
+                 keep_open=True):
+        '''
+        path: output file; opened in append mode
+        policy: 'size', 'time' or 'exit'
+        max_bytes: buffered characters that trigger a flush ('size' policy)
+        interval: seconds between flushes ('time' policy)
+        keep_open: keep the file open until the sink is closed; otherwise
+                   it is opened for each flush (for many idle sinks)
+        '''
+        self.path = path
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.keep_open = keep_open
+        self.file = open(path, 'a') if keep_open else None
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = monotonic()
+        # guards the buffer
+        self.lock = threading.Lock()
+        # keeps concurrent flushes of this sink in order
+        self.write_lock = threading.Lock()
+        self.closed = False
+        flusher.register(self)
+
+    def write(self, txt):
+        '''buffer txt followed by a newline'''
+        with self.lock:
+            self.buffer.append(txt)
+            self.buffer.append('\n')
+            self.buffered += len(txt) + 1
+            full = self.policy == 'size' and self.buffered >= self.max_bytes
+        if full:
+            flusher.request(self)
+
+    def flush(self):
+        '''write everything buffered so far to the file'''
+        with self.write_lock:
+            with self.lock:
+                data = ''.join(self.buffer)
+                self.buffer = []
+                self.buffered = 0
+                self.last_flush = monotonic()
+            if not data or self.closed:
+                return
+            if self.keep_open:
+                self.file.write(data)
+                self.file.flush()
+            else:
+                with open(self.path, 'a') as f:
+                    f.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        flusher.unregister(self)
+        if self.keep_open:
+            with self.write_lock:
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Flusher:
+    '''Background thread that flushes sinks for their writers'''
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.sinks = set()
+        # sinks that asked to be flushed
+        self.requested = []
+        self.thread = None
+
+    def register(self, sink):
+        with self.cond:
+            self.sinks.add(sink)
+            # a new 'time' sink may be due before the current deadline
+            self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def unregister(self, sink):
+        with self.cond:
+            self.sinks.discard(sink)
+
+    def request(self, sink):
+        with self.cond:
+            self.requested.append(sink)
+            self.cond.notify()
+
+    def _due(self, now):
+        '''time-policy sinks whose interval has passed, and the next deadline'''
+        due = []
+        deadline = None
+        for sink in self.sinks:
+            if sink.policy != 'time':
+                continue
+            at = sink.last_flush + sink.interval
+            if at <= now:
+                due.append(sink)
+                at = now + sink.interval
+            deadline = at if deadline is None else min(deadline, at)
+        return due, deadline
+
+    def _run(self):
+        while True:
+            with self.cond:
+                due, deadline = self._due(monotonic())
+                if not self.requested and not due:
+                    timeout = None if deadline is None else deadline - monotonic()
+                    self.cond.wait(timeout)
+                    due, _ = self._due(monotonic())
+                batch = self.requested + due
+                self.requested = []
+            for sink in batch:
+                sink.flush()
+
+    def flush_all(self):
+        with self.cond:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink.flush()
+
+
+flusher = Flusher()
+atexit.register(flusher.flush_all)
@@ -0,0 +1,128 @@
+'''
+Tail packing: the bytes after the last full page of a file (its tail) are
+stored in slots of frames shared by many files
+
+A frame holding tails is cut into slots of one size from SLOT_SIZES; a
+tail goes into a slot of the smallest size that fits it. Tails longer
+than the largest slot get a page of their own, and files of at most
+INLINE_SIZE bytes keep their contents in the File object (see
+FileSystem._layout), so small files and the ends of large files don't
+waste most of a frame each.
+'''
+from util import PAGE_SIZE
+
+# sizes of the slots tails are packed in (bytes)
+SLOT_SIZES = (8, 16, 32)
+# largest tail that is packed
+TAIL_SIZE = SLOT_SIZES[-1]
+# largest file whose contents are kept in its File object
+INLINE_SIZE = 32
+
+
+def slot_size(length):
+    '''size of the slot a tail of length bytes is packed in, or None'''
+    for size in SLOT_SIZES:
+        if length <= size:
+            return size
+    return None
+
+
+class TailPacker:
+    '''
+    Slots of the frames that hold tails
+    A slot is addressed as (frame, offset). The frames are allocated from,
+    and returned to, the allocator; their owner is the packer itself
+    '''
+
+    def __init__(self, allocator, memory):
+        self.allocator = allocator
+        self.memory = memory
+        # slot size -> frame -> free offsets, for frames with free slots
+        self.partial = {size: {} for size in SLOT_SIZES}
+        # frame -> [slot size, slots in use]
+        self.frames = {}
+
+    def __str__(self):
+        return 'packed tails'
+
+    def needs_frame(self, length):
+        '''whether packing a tail of length bytes takes a new frame'''
+        return not self.partial[slot_size(length)]
+
+    def allocate(self, length):
+        '''
+        A free slot for a tail of length bytes
+        Returns (frame, offset), or None if a new frame is needed
+        and none is free
+        '''
+        size = slot_size(length)
+        partial = self.partial[size]
+        if not partial:
+            frames = self.allocator.allocate(1, self)
+            if frames is None:
+                return None
+            self._add_frame(frames[0], size)
+        frame = next(iter(partial))
+        free = partial[frame]
+        offset = free.pop()
+        if not free:
+            del partial[frame]
+        self.frames[frame][1] += 1
+        return frame, offset
+
+    def _add_frame(self, frame, size):
+        self.frames[frame] = [size, 0]
+        self.partial[size][frame] = set(range(0, PAGE_SIZE - size + 1, size))
+
+    def reserve(self, slot, length):
+        '''
+        Mark a specific slot holding a tail of length bytes as used
+        (journal replay and mounting, where the slot is already known)
+        '''
+        frame, offset = slot
+        if frame not in self.frames:
+            self.allocator.reserve([frame], self)
+            self._add_frame(frame, slot_size(length))
+        size = self.frames[frame][0]
+        free = self.partial[size].get(frame)
+        if free is None or offset not in free:
+            return
+        free.discard(offset)
+        if not free:
+            del self.partial[size][frame]
+        self.frames[frame][1] += 1
+
+    def free(self, slot, emptied=None):
+        '''
+        release a slot; its frame is freed with its last slot
+        emptied: a list to add that frame to instead, for the caller to free
+        '''
+        frame, offset = slot
+        entry = self.frames[frame]
+        size = entry[0]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.frames[frame]
+            self.partial[size].pop(frame, None)
+            if emptied is None:
+                self.allocator.free([frame])
+            else:
+                emptied.append(frame)
+            return
+        self.partial[size].setdefault(frame, set()).add(offset)
+
+    def read(self, slot, length):
+        frame, offset = slot
+        start = frame * self.memory.page_size + offset
+        return self.memory.view[start:start + length]
+
+    def write(self, slot, data):
+        self.memory.write([slot[0]], data, slot[1])
+
+    def get_stats(self):
+        '''frames holding tails and slots in use per slot size'''
+        stats = {'frames': len(self.frames)}
+        for size in SLOT_SIZES:
+            stats[f'slots_{size}'] = sum(used for slot, used in self.frames.values()
+                                         if slot == size)
+        return stats
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+
+from util import SEP
+
+
+class PathResolver:
+    '''
+    Pure-string path normalizer with two bounded LRU caches:
+        components: (cwd, path) -> (name, parent path, absolute path)
+        nodes: absolute path -> Directory/File found at that path
+    Components only depend on the strings, so they never go stale.
+    Nodes do: FileSystem calls invalidate() whenever a node is moved
+    or removed. Missing paths are never cached.
+    '''
+
+    def __init__(self, root_path=SEP, maxsize=4096):
+        '''
+        root_path: path of the root directory ('/' or 'c:')
+        maxsize: maximum number of entries in each cache
+        '''
+        self.root_path = root_path
+        # prefix that is joined with the components of an absolute path
+        self.prefix = root_path.rstrip(SEP)
+        self.maxsize = maxsize
+        self.components_cache = OrderedDict()
+        self.nodes_cache = OrderedDict()
+        # bumped by invalidate(); a walk that overlapped one isn't cached
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'node_hits': 0, 'node_misses': 0}
+
+    def _join(self, parts):
+        if not parts:
+            return self.root_path
+        return self.prefix + SEP + SEP.join(parts)
+
+    def _is_absolute(self, path):
+        if path.startswith(SEP):
+            return True
+        return self.root_path != SEP and \
+            path.lower().startswith(self.root_path.lower())
+
+    def normalize(self, cwd, path):
+        '''
+        Resolve path against cwd without any caching
+        '.' and empty components are dropped, '..' goes up one level
+        (and stays at the root)
+        Returns (name, parent path, absolute path)
+        '''
+        if self._is_absolute(path):
+            if not path.startswith(SEP):
+                path = path[len(self.root_path):]
+            parts = path.split(SEP)
+        else:
+            parts = cwd[len(self.prefix):].split(SEP) + path.split(SEP)
+        stack = []
+        for part in parts:
+            if part == '' or part == '.':
+                continue
+            if part == '..':
+                if stack:
+                    stack.pop()
+                continue
+            stack.append(part)
+        if not stack:
+            return (self.root_path,) * 3
+        return (stack[-1], self._join(stack[:-1]), self._join(stack))
+
+    def components(self, cwd, path):
+        '''cached normalize()'''
+        key = (cwd, path)
+        with self.lock:
+            result = self.components_cache.get(key)
+            if result is not None:
+                self.components_cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return result
+        result = self.normalize(cwd, path)
+        with self.lock:
+            self.stats['misses'] += 1
+            self.components_cache[key] = result
+            if len(self.components_cache) > self.maxsize:
+                self.components_cache.popitem(last=False)
+        return result
+
+    def lookup(self, path, walk):
+        '''
+        Node at the absolute path; walk(path) is called on a cache miss
+        The walk runs outside the lock, so its node is only cached if the
+        tree wasn't restructured meanwhile (it may have been detached)
+        '''
+        with self.lock:
+            node = self.nodes_cache.get(path)
+            if node is not None:
+                self.nodes_cache.move_to_end(path)
+                self.stats['node_hits'] += 1
+                return node
+            generation = self.generation
+        node = walk(path)
+        with self.lock:
+            self.stats['node_misses'] += 1
+            if node is not None and generation == self.generation:
+                self.nodes_cache[path] = node
+                if len(self.nodes_cache) > self.maxsize:
+                    self.nodes_cache.popitem(last=False)
+        return node
+
+    def invalidate(self):
+        '''forget every cached node after the tree was restructured'''
+        with self.lock:
+            self.generation += 1
+            self.nodes_cache.clear()
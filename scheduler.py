@@ -0,0 +1,186 @@
+'''
+Cooperative scheduler that runs input scripts as coroutines
+
+Every script is a task on one event loop instead of an OS thread. It
+yields to the other scripts after each command, and while it waits for a
+file range that another script has open for writing it is suspended
+on a future (session.FileLocks) and gives up its worker slot. At most
+`workers` scripts run commands at the same time, so thousands of scripts
+can be replayed with a bounded amount of work in flight.
+
+The output of each script is the one thread_runner writes.
+'''
+import asyncio
+
+from commands import INVALID, compile_script
+from edit_buffer import span
+from lock_manager import covers
+from output import OutputSink
+from session import FileLocks
+from thread_runner import DISPATCH, Runner
+from util import write2file
+
+
+class AsyncRunner(Runner):
+    '''
+    Runner whose writers wait for files without blocking the thread
+    Edits of files opened in p mode are coroutines, so they can wait
+    for the bytes they touch as well
+    '''
+
+    def __init__(self, name, fs, out, tree_output, locks, slots):
+        '''
+        locks: FileLocks shared by all scripts
+        slots: asyncio.Semaphore of the worker slots
+        '''
+        super().__init__(name, fs, out, tree_output)
+        self.locks = locks
+        self.slots = slots
+        # absolute path -> mode it is open in
+        self.modes = {}
+
+    async def open(self, fname, mode, start=None, end=None):
+        file = self._check_open(fname, mode, start, end)
+        if file is None:
+            return
+        path = self._path(fname)
+        result = True
+        # readers never wait (snapshot isolation)
+        if mode != 'r':
+            self.slots.release()
+            try:
+                result = await self.locks.acquire(
+                    path, self.thread_id, *self._lock_request(mode, start, end))
+            finally:
+                await self.slots.acquire()
+        if result is True:
+            self.modes[path] = self._lock_request(mode, start, end)[0]
+        self._opened(fname, mode, file, result)
+
+    def _held(self, fname):
+        return self.modes.get(self._path(fname))
+
+    def _ranges(self, fname):
+        return self.locks.ranges(self._path(fname), self.thread_id)
+
+    def _lock_range(self, fname, start, end):
+        # edits of files opened in p mode wait for their bytes in _infer
+        # first; getting here means that wait timed out
+        return False
+
+    async def _infer(self, fname, op, *args):
+        '''lock the bytes an edit of a file opened in p mode touches before it runs'''
+        path = self._path(fname)
+        if path not in self.inferred or self.modes.get(path) != 'w':
+            return
+        start, end = span(len(self.cache[path][1]), op, *args)
+        if covers(self._ranges(fname), start, end):
+            return
+        self.slots.release()
+        try:
+            result = await self.locks.acquire(
+                path, self.thread_id, 'w', [(start, end)])
+        finally:
+            await self.slots.acquire()
+        if result:
+            file, contents = self.cache[path]
+            contents.reload(file, start, end)
+
+    async def append(self, fname, text):
+        await self._infer(fname, 'append', text)
+        super().append(fname, text)
+
+    async def write_at(self, fname, text, pos):
+        await self._infer(fname, 'write_at', text, pos)
+        super().write_at(fname, text, pos)
+
+    async def move(self, fname, start, size, target):
+        await self._infer(fname, 'move', start, size, target)
+        super().move(fname, start, size, target)
+
+    async def tr(self, fname, size):
+        await self._infer(fname, 'tr', size)
+        super().tr(fname, size)
+
+    def _release(self, fname):
+        path = self._path(fname)
+        self.inferred.discard(path)
+        mode = self.modes.pop(path, None)
+        if mode in ('w', 'a'):
+            self.locks.release(path, self.thread_id)
+        return mode is not None
+
+    def _available(self, fname, permission):
+        path = self._path(fname)
+        if path not in self.cache:
+            write2file(self.out, f"{fname} is not open / doesn't exist")
+            return False
+        held = self.modes[path]
+        if held != permission and not (permission == 'a' and held == 'w'):
+            permission = {'r': 'reading', 'a': 'appending'}.get(permission, 'writing')
+            write2file(
+                self.out, f"Thread does not have {permission} permission for {fname}")
+            return False
+        return True
+
+    def close_all(self):
+        '''release the files a script left open'''
+        for fname in list(self.modes):
+            self._release(fname)
+        self.release_snapshots()
+        self.cache = {}
+
+
+# op -> AsyncRunner method
+DISPATCH = dict(DISPATCH, open=AsyncRunner.open, append=AsyncRunner.append,
+                write_at=AsyncRunner.write_at, move=AsyncRunner.move,
+                tr=AsyncRunner.tr)
+
+
+async def run_script(runner, commands):
+    '''run the commands of one script; stops at an invalid command'''
+    await runner.slots.acquire()
+    try:
+        for op in compile_script(commands):
+            if op[0] == INVALID:
+                break
+            result = DISPATCH[op[0]](runner, *op[1:])
+            if asyncio.iscoroutine(result):
+                await result
+            # let the other scripts run
+            runner.slots.release()
+            await asyncio.sleep(0)
+            await runner.slots.acquire()
+    finally:
+        runner.slots.release()
+        runner.close_all()
+        runner.out.close()
+
+
+async def run_scripts(fs, scripts, outfiles, workers=8, tree_output='full',
+                      lock_timeout=None):
+    '''
+    Run every script concurrently
+    scripts: iterables of command lines (e.g. commands.read_script)
+    outfiles: output file path of each script
+    workers: scripts that run commands at the same time
+    lock_timeout: seconds a writer waits for a file (None waits forever)
+    '''
+    locks = FileLocks(lock_timeout)
+    slots = asyncio.Semaphore(workers)
+    tasks = []
+    for i, (commands, outfile) in enumerate(zip(scripts, outfiles)):
+        # a small buffer and no open file per idle script
+        out = OutputSink(outfile, max_bytes=1 << 12, keep_open=False)
+        runner = AsyncRunner(i, fs, out, tree_output, locks, slots)
+        tasks.append(asyncio.create_task(run_script(runner, commands)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def schedule(fs, scripts, outfiles, **kwargs):
+    '''run_scripts on a new event loop; see run_scripts for the arguments'''
+    asyncio.run(run_scripts(fs, scripts, outfiles, **kwargs))
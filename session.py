@@ -0,0 +1,544 @@
+'''
+Client sessions for the HTTP API (api.py) and FileSystem.batch
+
+A Session is one client's view of the file system: its own current
+directory and its own transaction cache of open files, like a thread in
+thread_runner. Sessions run on the event loop, so writers of overlapping
+byte ranges of a file wait on a future (FileLocks) instead of blocking a
+thread.
+Messages are the ones thread_runner writes to its output file.
+'''
+import asyncio
+import weakref
+from time import monotonic, perf_counter_ns
+
+from commands import compile_command
+from edit_buffer import EditBuffer, span
+from lock_manager import WHOLE, conflicts, covers, merge
+from util import COPY_ERRORS
+
+
+class FileLocks:
+    '''
+    Per-file byte-range writer locks shared by all sessions
+    Writers hold byte ranges of a file (all of it by default) and wait
+    for the writers of overlapping ranges; appenders only wait for the
+    writers that hold the end of the file (see lock_manager.conflicts).
+    Readers never wait; they read the version committed when they opened
+    the file (see versions.py)
+    '''
+
+    def __init__(self, timeout=None):
+        '''timeout: default seconds a writer waits for a file (None waits forever)'''
+        self.timeout = timeout
+        # path -> [{owner: [mode, ranges]}, waiting requests in arrival order]
+        # a request is [owner, mode, ranges, future set when it is granted]
+        self.locks = {}
+        # (path, owner) -> when it got the lock (perf_counter_ns)
+        self.granted = {}
+        # path -> wait and hold time statistics (nanoseconds), as
+        # LockManager.get_stats reports them
+        self.stats = {}
+
+    async def acquire(self, path, owner, mode='w', ranges=None, timeout=-1):
+        '''
+        Wait until owner holds path in mode ('w' or 'a')
+        ranges: byte ranges a writer locks, [(start, end), ...];
+                None locks the whole file
+        If owner already holds path, ranges are added to the ones it holds
+        Returns True, or False if the wait timed out
+        '''
+        if timeout == -1:
+            timeout = self.timeout
+        if ranges is None:
+            ranges = [WHOLE] if mode == 'w' else []
+        entry = self.locks.setdefault(path, [{}, []])
+        stats = self._stats(path)
+        request = [owner, mode, ranges, None]
+        if not self._blocked(entry, request):
+            self._grant(path, entry, request)
+            return True
+        request[3] = asyncio.get_running_loop().create_future()
+        entry[1].append(request)
+        t0 = perf_counter_ns()
+        try:
+            await asyncio.wait_for(request[3], timeout)
+        except asyncio.TimeoutError:
+            # granted just as the wait timed out
+            if request[3].done() and not request[3].cancelled():
+                return True
+            stats['timeouts'] += 1
+            return False
+        finally:
+            elapsed = perf_counter_ns() - t0
+            stats['waits'] += 1
+            stats['wait_ns'] += elapsed
+            stats['max_wait_ns'] = max(stats['max_wait_ns'], elapsed)
+            if request in entry[1]:
+                # leaving the queue may unblock the requests behind this one
+                entry[1].remove(request)
+                self._wake(path, entry)
+        return True
+
+    def release(self, path, owner):
+        entry = self.locks[path]
+        del entry[0][owner]
+        stats = self.stats[path]
+        held = perf_counter_ns() - self.granted.pop((path, owner))
+        stats['hold_ns'] += held
+        stats['max_hold_ns'] = max(stats['max_hold_ns'], held)
+        self._wake(path, entry)
+
+    def ranges(self, path, owner):
+        '''byte ranges owner holds of path'''
+        entry = self.locks.get(path)
+        held = entry[0].get(owner) if entry else None
+        return list(held[1]) if held else []
+
+    def _blocked(self, entry, request):
+        '''whether a holder or an earlier request conflicts with request'''
+        holders, queue = entry
+        owner, mode, ranges, _ = request
+        for holder, (held, held_ranges) in holders.items():
+            if holder != owner and conflicts(mode, ranges, held, held_ranges):
+                return True
+        # a holder adding ranges doesn't queue behind new requests
+        if owner in holders:
+            return False
+        for waiting in queue:
+            if waiting is request:
+                break
+            if conflicts(mode, ranges, waiting[1], waiting[2]):
+                return True
+        return False
+
+    def _grant(self, path, entry, request):
+        owner, mode, ranges, _ = request
+        held = entry[0].get(owner)
+        if held is None:
+            entry[0][owner] = [mode, list(ranges)]
+            self.granted[(path, owner)] = perf_counter_ns()
+        else:
+            held[1].extend(ranges)
+        self.stats[path]['acquired'] += 1
+
+    def _wake(self, path, entry):
+        '''grant the waiting requests nothing blocks anymore'''
+        for request in list(entry[1]):
+            if not request[3].done() and not self._blocked(entry, request):
+                entry[1].remove(request)
+                self._grant(path, entry, request)
+                request[3].set_result(True)
+        # forget the lock of path once nobody holds or waits for it
+        if not entry[0] and not entry[1]:
+            del self.locks[path]
+
+    def _stats(self, path):
+        stats = self.stats.get(path)
+        if stats is None:
+            stats = self.stats[path] = {
+                'acquired': 0, 'waits': 0, 'wait_ns': 0, 'max_wait_ns': 0,
+                'timeouts': 0, 'hold_ns': 0, 'max_hold_ns': 0}
+        return stats
+
+    def get_stats(self):
+        '''path -> wait and hold time statistics (nanoseconds)'''
+        return {path: dict(stats) for path, stats in self.stats.items()}
+
+
+class ThreadLocks:
+    '''
+    FileLocks interface over the LockManager of thread_runner
+    For a session whose event loop runs alone in its thread
+    (FileSystem.batch): a writer waits by blocking that thread, and it
+    excludes the writers of thread_runner threads and of other batches
+    '''
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    async def acquire(self, path, owner, mode='w', ranges=None, timeout=-1):
+        '''see FileLocks.acquire; False also if waiting would deadlock'''
+        return self.manager.acquire(path, owner, mode, timeout, ranges) is True
+
+    def release(self, path, owner):
+        self.manager.release(path, owner)
+
+    def ranges(self, path, owner):
+        return self.manager.ranges(path, owner)
+
+    def get_stats(self):
+        return self.manager.get_stats()
+
+
+class Session:
+    def __init__(self, sid, fs, locks):
+        '''
+        sid: id of the session
+        fs: FileSystem object shared by all sessions
+        locks: FileLocks shared by all sessions
+        '''
+        self.id = sid
+        self.fs = fs
+        self.locks = locks
+        self.cwd = fs.resolver.root_path
+        # absolute path -> (file, mode, EditBuffer in w mode / None in r mode)
+        self.cache = {}
+        # when a request last used the session; api.py ends idle sessions
+        self.last_used = monotonic()
+
+    def path(self, name):
+        '''absolute path of name relative to the session's directory'''
+        return self.fs.resolver.components(self.cwd, name)[2]
+
+    async def _call(self, method, *args):
+        '''
+        Run a FileSystem method
+        With a journal attached it waits for fsync, so it runs on a
+        worker thread instead of blocking the event loop
+        '''
+        if self.fs.journal is None:
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+    # File System and Directory related Commands
+
+    def cd(self, name):
+        path = self.path(name)
+        if not self.fs.isdir(path):
+            return "No such directory exists!"
+        self.cwd = path
+        return self.cwd
+
+    def pwd(self):
+        return self.cwd
+
+    async def mkdir(self, name, parents=False):
+        result = await self._call(self.fs.mkdir, self.path(name), parents)
+        if result == 0:
+            return "Duplicate directory. Operation ignored."
+        if result == 1:
+            return "No such parent directory exists!"
+        return result
+
+    async def mkdirs(self, name):
+        '''mkdir -p: make the missing parent directories too'''
+        return await self.mkdir(name, True)
+
+    async def mv(self, src, dst):
+        result = await self._call(self.fs.mv, self.path(src), self.path(dst))
+        if result == 0:
+            return "Source file doesn't exist!"
+        if result == 1:
+            return "Destination directory doesn't exist!"
+        return result
+
+    async def cp(self, src, dst):
+        result = await self._call(self.fs.cp, self.path(src), self.path(dst))
+        if type(result) == int:
+            return COPY_ERRORS[result]
+        return result
+
+    # File I/O
+
+    async def create(self, name):
+        result = await self._call(self.fs.create, self.path(name))
+        if result == 0:
+            return "No such directory exists!"
+        if result == 1:
+            return "Duplicate file. Operation ignored."
+        return result
+
+    async def delete(self, name, recursive=False):
+        result = await self._call(self.fs.delete, self.path(name), recursive)
+        if result == 0:
+            return "No such file exists!"
+        if result == 1:
+            return "Directory not empty. Operation ignored."
+        return result
+
+    async def rmtree(self, name):
+        '''rm -r: delete a directory with everything below it'''
+        return await self.delete(name, True)
+
+    async def open(self, name, mode, start=None, end=None):
+        '''
+        mode: 'r', 'w' (the whole file, or bytes [start, end) of it),
+        'p' (each edit locks the bytes it touches) or 'a' (append only);
+        see thread_runner.Runner.open
+        '''
+        if mode == 'r':
+            mode_msg = 'reading'
+        elif mode in ('w', 'p'):
+            mode_msg = 'writing'
+        elif mode == 'a':
+            mode_msg = 'appending'
+        else:
+            return f"Invalid mode {mode}"
+        if start is not None and (mode != 'w' or start < 0 or
+                                  (end is not None and end <= start)):
+            return f"Invalid byte range {start} {end}"
+        path = self.path(name)
+        file = self.fs.open(path)
+        if file == False:
+            return f"{name} doesn't exist"
+        if path in self.cache:
+            return f"{name} must be closed before opening it again"
+        if mode == 'r':
+            # readers read the version committed when they opened the file
+            contents = self.fs.snapshot()
+        else:
+            if mode == 'a':
+                request = ('a', [])
+            elif mode == 'p':
+                request = ('w', [])
+            else:
+                request = ('w', [WHOLE] if start is None else [(start, end)])
+            if not await self.locks.acquire(path, self.id, *request):
+                return f"Timed out waiting to open {name}"
+            # appenders only keep the text they add
+            contents = EditBuffer('' if mode == 'a' else file.get_contents())
+        self.cache[path] = (file, mode, contents)
+        return f"{name} opened for {mode_msg}"
+
+    async def close(self, name):
+        path = self.path(name)
+        file, mode, contents = self.cache.pop(path, (None, None, None))
+        if file is None:
+            return f"{name} has not been opened / doesn't exist"
+        if mode == 'r':
+            contents.close()
+            return f"{name} has been closed and any changes made were saved."
+        try:
+            if mode == 'a':
+                result = await self._call(self.fs.append, path, contents.getvalue())
+            else:
+                ranges = merge(self.locks.ranges(path, self.id))
+                if ranges != [WHOLE]:
+                    # only the bytes this session holds are committed
+                    contents = contents.edits_in(ranges)
+                result = await self._call(self.fs.close, path, contents)
+        finally:
+            self.locks.release(path, self.id)
+        if result == 0:
+            return f"{name} doesn't exist!"
+        # close returns True when it saved, so 1 can't be told apart with ==
+        if result is not True:
+            return f"Not enough frames available to save changes made to {name}"
+        return f"{name} has been closed and any changes made were saved."
+
+    def close_all(self):
+        '''drop every open file without saving (session ended)'''
+        for path, (_, mode, contents) in self.cache.items():
+            if mode == 'r':
+                contents.close()
+            else:
+                self.locks.release(path, self.id)
+        self.cache = {}
+
+    def _opened(self, name, mode):
+        '''
+        (file, contents) of name if it is open in mode
+        otherwise the message to return
+        '''
+        entry = self.cache.get(self.path(name))
+        if entry is None:
+            return f"{name} is not open / doesn't exist"
+        file, held, contents = entry
+        if held != mode and not (mode == 'w' and held == 'p') and \
+                not (mode == 'a' and held in ('w', 'p')):
+            permission = {'r': 'reading', 'a': 'appending'}.get(mode, 'writing')
+            return f"Thread does not have {permission} permission for {name}"
+        return file, contents
+
+    async def _editable(self, name, op, *args):
+        '''
+        (file, contents) of name if this session can run edit op on it,
+        with the bytes it touches locked (see Runner._editable)
+        otherwise the message to return
+        '''
+        entry = self.cache.get(self.path(name))
+        if op == 'append' and entry is not None and entry[1] == 'a':
+            return self._opened(name, 'a')
+        opened = self._opened(name, 'w')
+        if isinstance(opened, str):
+            return opened
+        path = self.path(name)
+        start, end = span(len(opened[1]), op, *args)
+        if covers(self.locks.ranges(path, self.id), start, end):
+            return opened
+        last = 'the end' if end is None else end
+        if entry[1] != 'p':
+            return f"{name} is not locked from {start} to {last}. Operation ignored."
+        if not await self.locks.acquire(path, self.id, 'w', [(start, end)]):
+            return f"Timed out waiting to lock {name} from {start} to {last}"
+        opened[1].reload(opened[0], start, end)
+        return opened
+
+    def read(self, name):
+        result = self._read(name, 0, None)
+        if isinstance(result, str):
+            return result
+        return f'Contents of {name}: {str(result, "utf-8")}'
+
+    def read_chunks(self, name, chunk_size=1 << 16):
+        '''
+        Contents of name as of its open in chunks of chunk_size bytes
+        Returns the message instead if name is not open for reading or
+        its first chunk can't be read
+        '''
+        opened = self._opened(name, 'r')
+        if isinstance(opened, str):
+            return opened
+        file, snapshot = opened
+        # the stream keeps its own pin, so closing the file doesn't free
+        # the frames it is still reading
+        stream = snapshot.copy()
+        layout = stream.layout(file)
+        length = layout[2]
+        # read before the response starts, while the error can still be returned
+        first = self._read(name, 0, chunk_size, layout)
+        if isinstance(first, str):
+            stream.close()
+            return first
+
+        def chunks():
+            # a later chunk that can't be read ends the stream with the error
+            try:
+                if first:
+                    yield first
+                for start in range(chunk_size, length, chunk_size):
+                    yield bytes(file.read_from(start, chunk_size, layout))
+            finally:
+                stream.close()
+        generator = chunks()
+        # also released if the stream is dropped before it ends
+        weakref.finalize(generator, stream.close)
+        return generator
+
+    def read_from(self, name, start, size):
+        result = self._read(name, start, size)
+        if isinstance(result, str):
+            return result
+        return f'Contents of {name}: {str(result, "utf-8", "replace")}'
+
+    def _read(self, name, start, size, layout=None):
+        '''
+        size bytes (None: all) of name from start as of its open,
+        otherwise the message to return
+        If swapped pages can't be brought back into frames, name is
+        closed and its snapshot released (see Runner._read)
+        '''
+        opened = self._opened(name, 'r')
+        if isinstance(opened, str):
+            return opened
+        file, snapshot = opened
+        if layout is None:
+            layout = snapshot.layout(file)
+        try:
+            return bytes(file.read_from(start, layout[2] if size is None else size, layout))
+        except MemoryError:
+            del self.cache[self.path(name)]
+            snapshot.close()
+            return f"Not enough frames available to read {name}. {name} has been closed."
+
+    async def append(self, name, text):
+        opened = await self._editable(name, 'append', text)
+        if isinstance(opened, str):
+            return opened
+        opened[1].append(text)
+        return f'Append text {text} to {name} committed as transaction.'
+
+    async def write_at(self, name, text, pos):
+        opened = await self._editable(name, 'write_at', text, pos)
+        if isinstance(opened, str):
+            return opened
+        opened[1].write_at(pos, text)
+        return f'Append text {text} to {name} committed as transaction.'
+
+    async def move(self, name, start, size, target):
+        opened = await self._editable(name, 'move', start, size, target)
+        if isinstance(opened, str):
+            return opened
+        opened[1].move(start, size, target)
+        return f'Move text in {name} from {start} till {start + size} to {target} committed as transaction.'
+
+    async def truncate(self, name, size):
+        opened = await self._editable(name, 'tr', size)
+        if isinstance(opened, str):
+            return opened
+        opened[1].truncate(size)
+        return f'Truncate contents of {name} to {size} committed as transaction.'
+
+    # Scripts
+
+    def print(self):
+        return self.fs.render()
+
+    def show_memory_map(self):
+        return '\n'.join(f'{path} {pages} {size}'
+                         for path, pages, size in self.fs.memory_map())
+
+    async def save(self, dst):
+        if await asyncio.to_thread(self.fs.save, dst) == 1:
+            return 'Cannot save while pages are swapped out'
+        return f'Filesystem saved at {dst}'
+
+    async def execute(self, command):
+        '''
+        Run one command of the thread_runner command language,
+        as a line or as a compiled opcode tuple
+        Returns its output, or None for an invalid command
+        '''
+        op = command if isinstance(command, tuple) else compile_command(command)
+        method = DISPATCH.get(op[0]) if op else None
+        if method is None:
+            return None
+        result = method(self, *op[1:])
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    async def run(self, commands):
+        '''
+        Run a script of commands in this session
+        Returns [command, output] for every command that was run;
+        like thread_runner, the script stops at an invalid command
+        '''
+        results = []
+        for command in commands:
+            op = compile_command(command)
+            if op is None:
+                continue
+            output = await self.execute(op)
+            if output is None:
+                results.append([command, "Invalid command. Script stopped."])
+                break
+            results.append([command, output])
+        self.last_used = monotonic()
+        return results
+
+
+# op -> Session method
+DISPATCH = {
+    'mkdir': Session.mkdir,
+    'mkdirs': Session.mkdirs,
+    'cd': Session.cd,
+    'mv': Session.mv,
+    'cp': Session.cp,
+    'pwd': Session.pwd,
+    'print': Session.print,
+    'show_memory_map': Session.show_memory_map,
+    'save': Session.save,
+    'create': Session.create,
+    'delete': Session.delete,
+    'rmtree': Session.rmtree,
+    'open': Session.open,
+    'close': Session.close,
+    'read': Session.read,
+    'read_from': Session.read_from,
+    'append': Session.append,
+    'write_at': Session.write_at,
+    'move': Session.move,
+    'tr': Session.truncate,
+}
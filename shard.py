@@ -0,0 +1,592 @@
+'''
+Sharded file system: the namespace is split across worker processes
+
+Every top-level name (a directory or a file in the root) belongs to one
+shard, chosen by hashing the name, and everything below it lives in that
+shard's process. ShardedFileSystem is the router: it resolves paths,
+forwards every FileSystem call to the owning shard over a pipe and merges
+the answers of calls that concern all shards (print, memory map, du of
+the root).
+
+The frames of all shards live in one multiprocessing.shared_memory block
+(SharedPool), together with the allocation bitmap. Each shard allocates
+from its own range of frames, so shards never contend for a frame, while
+the router and the other shards can read any frame directly. The ranges
+are fixed: everything below one top-level name fits in num_frames /
+num_shards frames, even while the other shards are empty (see
+ShardedFileSystem.stats). A cross-shard
+mv therefore sends only page tables: the destination shard copies the
+pages straight out of the source shard's frames.
+'''
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import zlib
+from multiprocessing import shared_memory
+
+from directory import Directory
+from edit_buffer import EditBuffer
+from file import File
+from filesystem import FileSystem
+from memory import PhysicalMemory
+from allocator import PageAllocator
+from path_resolver import PathResolver
+from tree_view import TreeView
+from util import NUM_FRAMES, PAGE_SIZE, SEP
+from versions import Snapshot
+
+
+class SharedPool:
+    '''
+    Allocation bitmap followed by the frames, in shared memory
+    Frame numbers are global; a shard's frame n is global frame base + n
+    '''
+
+    def __init__(self, num_frames=NUM_FRAMES, page_size=PAGE_SIZE, shm=None):
+        '''shm: existing block to attach to (in a shard process)'''
+        self.num_frames = num_frames
+        self.page_size = page_size
+        if shm is None:
+            shm = shared_memory.SharedMemory(
+                create=True, size=num_frames * (page_size + 1))
+        self.shm = shm
+        self.bitmap = shm.buf[:num_frames]
+        self.data = shm.buf[num_frames:num_frames * (page_size + 1)]
+
+    def partition(self, n):
+        '''(base, count) of the frame range of each of n shards'''
+        count = self.num_frames // n
+        ranges = [(i * count, count) for i in range(n)]
+        base, _ = ranges[-1]
+        ranges[-1] = (base, self.num_frames - base)
+        return ranges
+
+    def memory(self, base=0, count=None):
+        '''PhysicalMemory of the frames base till base + count'''
+        if count is None:
+            count = self.num_frames - base
+        ps = self.page_size
+        return PhysicalMemory(count, ps, self.data[base * ps:(base + count) * ps])
+
+    def allocator(self, base, count):
+        '''PageAllocator of the frames base till base + count'''
+        return PageAllocator(count, self.bitmap[base:base + count])
+
+    def close(self, unlink=True):
+        self.bitmap.release()
+        self.data.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class Shard:
+    '''The FileSystem of one shard; runs in the shard's process'''
+
+    def __init__(self, pool, base, count):
+        self.pool = pool
+        self.base = base
+        self.fs = FileSystem()
+        # like volume.mount: the frames come from somewhere else
+        self.fs.memory = pool.memory(base, count)
+        self.fs.allocator = pool.allocator(base, count)
+        self.fs._index()
+        # id -> Snapshot pinned for the router
+        self.snapshots = {}
+        self.snapshot_ids = itertools.count()
+
+    def call(self, method, *args):
+        '''FileSystem method'''
+        return getattr(self.fs, method)(*args)
+
+    def tree(self):
+        '''the shard's tree as parsed JSON'''
+        return json.loads(self.fs.view.to_json())
+
+    def memory_map(self):
+        return [[path, [self.base + page for page in pages], size]
+                for path, pages, size in self.fs.memory_map()]
+
+    def frames(self, path):
+        '''
+        File.get_layout of the file at path with global frames, or None
+        The tail is sent as bytes; it is never longer than a slot
+        '''
+        file = self.fs._lookup_file(path)
+        if file is None:
+            return None
+        pages, tail, length = file.get_layout()
+        return [self.base + page for page in pages], tail, length
+
+    def pin(self, snapshot_id=None, tree=False):
+        '''
+        Pin the committed contents of the shard (FileSystem.snapshot), or
+        those of the pinned snapshot snapshot_id again
+        Returns the id of the new snapshot
+        '''
+        if snapshot_id is None:
+            snapshot = self.fs.snapshot(tree)
+        else:
+            snapshot = self.snapshots[snapshot_id][0].copy()
+        snapshot_id = next(self.snapshot_ids)
+        # the files found by path, so they are still read once moved or deleted
+        self.snapshots[snapshot_id] = [snapshot, {}]
+        return snapshot_id
+
+    def unpin(self, snapshot_id):
+        self.snapshots.pop(snapshot_id)[0].close()
+
+    def snapshot_frames(self, snapshot_id, path):
+        '''frames, like frames(), of the file at path in a pinned snapshot'''
+        snapshot, files = self.snapshots[snapshot_id]
+        file = files.get(path) or snapshot.lookup(path)
+        if file is None:
+            return None
+        files[path] = file
+        pages, tail, length = snapshot.layout(file)
+        return [self.base + page for page in pages], tail, length
+
+    def export(self, path):
+        '''
+        Description of the subtree at path for import_nodes
+        [relative path, length, global frames, tail] per file and
+        [relative path] per directory, parents first
+        Returns None if path doesn't exist
+        '''
+        node = self.fs._lookup(path)
+        if node is None or node is self.fs.root:
+            return None
+        nodes = []
+        for child in self.fs._walk(node):
+            relative = child.get_path()[len(path):]
+            if isinstance(child, File):
+                pages, tail, length = child.get_layout()
+                frames = [self.base + page for page in pages]
+                nodes.append([relative, length, frames, tail])
+            else:
+                nodes.append([relative])
+        return nodes
+
+    def import_nodes(self, path, nodes):
+        '''
+        Recreate the subtree exported by another shard at path,
+        copying the file pages from their frames in the pool
+        An existing node at path is replaced, as mv does
+        Returns path, 1 if the parent of path is missing, or
+        2 if the shard doesn't have enough free frames
+        '''
+        fs = self.fs
+        _, parent, _ = fs.resolver.normalize(fs.cwd, path)
+        if not fs.isdir(parent):
+            return 1
+        # a file may need a frame for its tail besides its pages
+        needed = sum(len(node[2]) + 1 for node in nodes if len(node) > 1)
+        if needed > fs.allocator.get_free_count():
+            return 2
+        if fs._lookup(path) is not None:
+            fs.delete(path, True)
+        ps = self.pool.page_size
+        data = self.pool.data
+        for node in nodes:
+            node_path = path + node[0]
+            if len(node) == 1:
+                fs.mkdir(node_path)
+                continue
+            _, length, frames, tail = node
+            fs.create(node_path)
+            contents = b''.join(data[frame * ps:(frame + 1) * ps] for frame in frames)
+            contents = contents[:length - len(tail)] + tail
+            fs.close(node_path, (length, [(0, contents)]))
+        return path
+
+    def remove(self, path):
+        '''delete the subtree at path and reclaim its frames (it was moved)'''
+        self.fs.delete(path, True)
+
+
+def _serve(conn, shm, num_frames, page_size, base, count):
+    '''request loop of a shard process: (method, args) -> result'''
+    shard = Shard(SharedPool(num_frames, page_size, shm), base, count)
+    while True:
+        method, args = conn.recv()
+        if method is None:
+            break
+        try:
+            result = getattr(shard, method)(*args)
+        except Exception as e:
+            result = e
+        conn.send(result)
+    conn.close()
+
+
+class SharedFile:
+    '''
+    Read-only handle to a file of a shard, as returned by
+    ShardedFileSystem.open; contents are read straight from the pool
+    '''
+
+    def __init__(self, router, path):
+        self.router = router
+        self.path = path
+        # reads a layout from the shard out of the whole pool
+        self.file = File(path, memory=router.memory)
+
+    def get_path(self):
+        return self.path
+
+    # copies, not views: the frames may be reused once the shard commits
+
+    def read(self):
+        layout = self.router._frames(self.path)
+        return bytes(self.file.read_from(0, layout[2], layout))
+
+    def read_from(self, start, size, layout=None):
+        '''layout: the one of a SharedSnapshot (default: the committed one)'''
+        if layout is None:
+            layout = self.router._frames(self.path)
+        return bytes(self.file.read_from(start, size, layout))
+
+    def get_contents(self):
+        return str(self.read(), 'utf-8')
+
+
+class SharedSnapshot(Snapshot):
+    '''
+    Snapshot of every shard, as returned by ShardedFileSystem.snapshot
+    Each shard pins its own committed contents, so the frames stay in the
+    pool until close(); shards are pinned one after the other
+    The version is the list of the snapshot ids of the shards
+    '''
+
+    def layout(self, file):
+        '''(pages, tail, length) of a SharedFile; empty if it was deleted'''
+        path = file.get_path()
+        shard = self.fs._shard_of(path)
+        layout = self.fs._call(shard, 'snapshot_frames', self.version[shard], path)
+        return ([], b'', 0) if layout is None else layout
+
+    def lookup(self, path):
+        shard = self.fs._shard_of(path)
+        if shard is None or self.fs._call(
+                shard, 'snapshot_frames', self.version[shard], path) is None:
+            return None
+        return SharedFile(self.fs, path)
+
+    def copy(self):
+        return SharedSnapshot(self.fs, [self.fs._call(shard, 'pin', snapshot_id)
+                                        for shard, snapshot_id in enumerate(self.version)])
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            for shard, snapshot_id in enumerate(self.version):
+                self.fs._call(shard, 'unpin', snapshot_id)
+
+
+class ShardedFileSystem:
+    '''
+    FileSystem interface over num_shards shard processes
+    Calls for different shards run in parallel; calls for one shard are
+    serialized on its pipe
+    '''
+
+    def __init__(self, num_shards=None, num_frames=NUM_FRAMES, page_size=PAGE_SIZE):
+        '''num_shards: number of shard processes (default: one per CPU)'''
+        self.num_shards = num_shards or os.cpu_count()
+        self.pool = SharedPool(num_frames, page_size)
+        # whole pool, for reading the frames of any shard
+        self.memory = self.pool.memory()
+        root = 'c:' if os.name == 'nt' else SEP
+        self.resolver = PathResolver(root)
+        self.cwd = root
+        # share the pool with the children without pickling it where possible
+        method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        context = multiprocessing.get_context(method)
+        self.conns = []
+        self.locks = []
+        self.processes = []
+        for base, count in self.pool.partition(self.num_shards):
+            conn, child = context.Pipe()
+            process = context.Process(
+                target=_serve, daemon=True,
+                args=(child, self.pool.shm, num_frames, page_size, base, count))
+            process.start()
+            self.conns.append(conn)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+
+    def _call(self, shard, method, *args):
+        with self.locks[shard]:
+            return self._send(shard, method, *args)
+
+    def _send(self, shard, method, *args):
+        '''_call for a shard whose lock is already held'''
+        conn = self.conns[shard]
+        conn.send((method, args))
+        result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _resolve(self, path):
+        return self.resolver.components(self.cwd, path)[2]
+
+    def _shard_of(self, full_path):
+        '''shard that owns full_path; None for the root'''
+        parts = full_path[len(self.resolver.prefix):].split(SEP)
+        top = next((part for part in parts if part), None)
+        if top is None:
+            return None
+        return zlib.crc32(top.encode()) % self.num_shards
+
+    def _frames(self, full_path):
+        return self._call(self._shard_of(full_path), 'frames', full_path)
+
+    def mkdir(self, dirname, parents=False):
+        full_path = self._resolve(dirname)
+        shard = self._shard_of(full_path)
+        if shard is None:
+            print("Duplicate directory. Operation ignored.")
+            return 0
+        return self._call(shard, 'call', 'mkdir', full_path, parents)
+
+    def cd(self, dirname):
+        full_path = self._resolve(dirname)
+        shard = self._shard_of(full_path)
+        if shard is not None and not self._call(shard, 'call', 'isdir', full_path):
+            return 0
+        self.cwd = full_path
+        return self.pwd()
+
+    def pwd(self):
+        return self.cwd
+
+    def abspath(self, path):
+        '''absolute path of path; relative paths start at the current directory'''
+        return self._resolve(path)
+
+    def mv(self, src_fname, dst_fname):
+        '''
+        mv within a shard is that shard's mv
+        Across shards the subtree is copied to the destination shard and
+        then removed from the source shard, with both shards locked, so no
+        other call sees it in both or in neither
+        Returns dst_full_path, 0 if the source doesn't exist, or 1 if the
+        destination directory doesn't exist or can't hold the pages
+        '''
+        src_full_path = self._resolve(src_fname)
+        dst_full_path = self._resolve(dst_fname)
+        src = self._shard_of(src_full_path)
+        dst = self._shard_of(dst_full_path)
+        if src is None:
+            print("Source file doesn't exist!")
+            return 0
+        if dst is None:
+            print("Destination directory doesn't exist!")
+            return 1
+        if src == dst:
+            return self._call(src, 'call', 'mv', src_full_path, dst_full_path)
+        first, second = sorted((src, dst))
+        with self.locks[first], self.locks[second]:
+            nodes = self._send(src, 'export', src_full_path)
+            if nodes is None:
+                print("Source file doesn't exist!")
+                return 0
+            result = self._send(dst, 'import_nodes', dst_full_path, nodes)
+            if result == 1:
+                print("Destination directory doesn't exist!")
+                return 1
+            if result == 2:
+                print("Not enough frames available to move this file.")
+                return 1
+            self._send(src, 'remove', src_full_path)
+        if self.cwd == src_full_path or self.cwd.startswith(src_full_path + SEP):
+            self.cwd = dst_full_path + self.cwd[len(src_full_path):]
+        return dst_full_path
+
+    def cp(self, src_fname, dst_fname):
+        '''
+        cp within a shard is that shard's cp
+        Across shards the file is copied to the destination shard like a
+        cross-shard mv, without removing it from the source shard
+        Returns dst_full_path or the error codes of FileSystem.cp
+        '''
+        src_full_path = self._resolve(src_fname)
+        dst_full_path = self._resolve(dst_fname)
+        src = self._shard_of(src_full_path)
+        dst = self._shard_of(dst_full_path)
+        if src is None:
+            print("Source file doesn't exist!")
+            return 0
+        if dst is None:
+            print("Destination is a directory.")
+            return 2
+        if src == dst:
+            return self._call(src, 'call', 'cp', src_full_path, dst_full_path)
+        first, second = sorted((src, dst))
+        with self.locks[first], self.locks[second]:
+            nodes = self._send(src, 'export', src_full_path)
+            if nodes is None or len(nodes[0]) == 1:
+                print("Source file doesn't exist!")
+                return 0
+            if self._send(dst, 'call', 'isdir', dst_full_path):
+                print("Destination is a directory.")
+                return 2
+            result = self._send(dst, 'import_nodes', dst_full_path, nodes)
+        if result == 1:
+            print("Destination directory doesn't exist!")
+            return 1
+        if result == 2:
+            print("Not enough frames available to copy this file.")
+            return 3
+        return dst_full_path
+
+    def render(self):
+        '''the merged tree of all shards as text'''
+        return self._tree().render()
+
+    def show(self):
+        print(self.render())
+
+    def print(self):
+        self.show()
+        return self._tree().to_json()
+
+    def _tree(self):
+        '''TreeView of the top-level names of every shard'''
+        root = Directory(self.resolver.root_path)
+        for shard in range(self.num_shards):
+            tree = self._call(shard, 'tree')
+            if isinstance(tree, dict):
+                _add_children(root, tree[root.get_name()]['children'])
+        return TreeView(root)
+
+    def show_mm(self, offset=0, limit=None):
+        output = self.memory_map(offset, limit)
+        for path, pages, size in output:
+            print(path, pages, size)
+        return output
+
+    def memory_map(self, offset=0, limit=None):
+        '''memory maps of the shards in shard order, with global frames'''
+        output = []
+        for shard in range(self.num_shards):
+            output.extend(self._call(shard, 'memory_map'))
+        stop = None if limit is None else offset + limit
+        return output[offset:stop]
+
+    def du(self, path):
+        full_path = self._resolve(path)
+        shard = self._shard_of(full_path)
+        if shard is not None:
+            return self._call(shard, 'call', 'du', full_path)
+        usage = [self._call(i, 'call', 'du', full_path)
+                 for i in range(self.num_shards)]
+        return sum(size for size, _ in usage), sum(pages for _, pages in usage)
+
+    def isdir(self, path):
+        full_path = self._resolve(path)
+        shard = self._shard_of(full_path)
+        return shard is None or self._call(shard, 'call', 'isdir', full_path)
+
+    def create(self, fname):
+        full_path = self._resolve(fname)
+        shard = self._shard_of(full_path)
+        if shard is None:
+            print("Duplicate file. Operation ignored.")
+            return 1
+        return self._call(shard, 'call', 'create', full_path)
+
+    def delete(self, fname, recursive=False):
+        full_path = self._resolve(fname)
+        shard = self._shard_of(full_path)
+        if shard is None:
+            print("No such file exists!")
+            return 0
+        return self._call(shard, 'call', 'delete', full_path, recursive)
+
+    def snapshot(self, tree=False):
+        '''
+        Pin the committed contents of every shard (see SharedSnapshot)
+        Without tree, a file is found by its path on its first read in the
+        snapshot and kept from then on
+        '''
+        return SharedSnapshot(self, [self._call(shard, 'pin', None, tree)
+                                     for shard in range(self.num_shards)])
+
+    def open(self, fname):
+        full_path = self._resolve(fname)
+        shard = self._shard_of(full_path)
+        if shard is None or self._call(shard, 'frames', full_path) is None:
+            print("File doesn't exist!")
+            return False
+        return SharedFile(self, full_path)
+
+    def close(self, fname, new_contents):
+        '''
+        Commit new_contents (a string or an EditBuffer) in the owning shard
+        An EditBuffer is sent as its edits, not as the whole contents
+        '''
+        full_path = self._resolve(fname)
+        shard = self._shard_of(full_path)
+        if shard is None:
+            print("File doesn't exist!")
+            return 0
+        if isinstance(new_contents, EditBuffer):
+            edits = new_contents.edits()
+            new_contents = new_contents.getvalue() if edits is None else edits
+        return self._call(shard, 'call', 'close', full_path, new_contents)
+
+    def append(self, fname, data):
+        '''add data to the end of the file in the owning shard (FileSystem.append)'''
+        full_path = self._resolve(fname)
+        shard = self._shard_of(full_path)
+        if shard is None:
+            print("File doesn't exist!")
+            return 0
+        return self._call(shard, 'call', 'append', full_path, data)
+
+    def stats(self):
+        '''
+        FileSystem.stats() of every shard, in shard order, with the
+        (base, count) of the frames it allocates from
+        free_count is the free frames of the whole pool; max_free_count,
+        those of the emptiest shard, is the most a single name can get
+        '''
+        shards = []
+        for shard, frames in enumerate(self.pool.partition(self.num_shards)):
+            stats = self._call(shard, 'call', 'stats')
+            stats['frames'] = frames
+            shards.append(stats)
+        free = [stats['allocator']['free_count'] for stats in shards]
+        return {
+            'shards': shards,
+            'free_count': sum(free),
+            'max_free_count': max(free),
+        }
+
+    def shutdown(self):
+        '''stop the shard processes and free the pool'''
+        for shard, conn in enumerate(self.conns):
+            with self.locks[shard]:
+                conn.send((None, None))
+                conn.close()
+        for process in self.processes:
+            process.join()
+        self.memory.view.release()
+        self.memory.buffer.release()
+        self.pool.close()
+
+
+def _add_children(directory, children):
+    '''add the nodes of a tree_view JSON children list to directory'''
+    for child in children:
+        if isinstance(child, str):
+            directory.add_child(Directory(child))
+            continue
+        (name, node), = child.items()
+        subdirectory = Directory(name)
+        directory.add_child(subdirectory)
+        _add_children(subdirectory, node['children'])
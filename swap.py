@@ -0,0 +1,263 @@
+'''
+Demand paging: a swap file behind the frames
+
+Once swap is enabled (FileSystem.enable_swap), the Pager takes the place
+of the PhysicalMemory of the file system. When a commit needs more frames
+than are free, the coldest pages of files are written to the swap file
+and their frames are freed; the page table entry of an evicted page is
+-1 - its swap slot. A read or write of a swapped page faults it back into
+a free frame, evicting another page if needed.
+
+Cold pages are chosen by LRU (every access moves a page to the back of a
+list) or CLOCK (an access sets a reference bit, and a hand sweeping the
+frames evicts the first page whose bit is clear). Only pages of files are
+evicted; frames holding packed tails or shared by several pages (see
+dedup.py) stay in memory.
+
+All paging runs under the file system's lock. Reads through the Pager
+return copies, since the frame behind a view may be evicted and reused.
+'''
+from collections import OrderedDict
+
+from file import File
+
+
+class SwapFile:
+    '''Page-sized slots in a file on disk'''
+
+    def __init__(self, path, page_size):
+        self.path = path
+        self.page_size = page_size
+        self.file = open(path, 'w+b')
+        # slots freed by faults, reused before the file grows
+        self.free = []
+        self.size = 0
+
+    def allocate(self):
+        if self.free:
+            return self.free.pop()
+        self.size += 1
+        return self.size - 1
+
+    def release(self, slot):
+        self.free.append(slot)
+
+    def write(self, slot, data):
+        self.file.seek(slot * self.page_size)
+        self.file.write(data)
+
+    def read(self, slot):
+        self.file.seek(slot * self.page_size)
+        return self.file.read(self.page_size).ljust(self.page_size, b'\0')
+
+    def get_used_count(self):
+        return self.size - len(self.free)
+
+    def close(self):
+        self.file.close()
+
+
+class LRU:
+    '''least recently used pages first'''
+
+    def __init__(self, num_frames):
+        self.order = OrderedDict()
+
+    def touch(self, frame):
+        self.order[frame] = None
+        self.order.move_to_end(frame)
+
+    def remove(self, frame):
+        self.order.pop(frame, None)
+
+    def candidates(self):
+        yield from list(self.order)
+
+
+class Clock:
+    '''second chance: pages accessed since the hand last passed are skipped'''
+
+    def __init__(self, num_frames):
+        self.num_frames = num_frames
+        self.referenced = bytearray(num_frames)
+        self.resident = bytearray(num_frames)
+        self.hand = 0
+
+    def touch(self, frame):
+        self.referenced[frame] = 1
+        self.resident[frame] = 1
+
+    def remove(self, frame):
+        self.resident[frame] = 0
+
+    def candidates(self):
+        # two sweeps clear every reference bit
+        for _ in range(2 * self.num_frames):
+            frame = self.hand
+            self.hand = (self.hand + 1) % self.num_frames
+            if not self.resident[frame]:
+                continue
+            if self.referenced[frame]:
+                self.referenced[frame] = 0
+                continue
+            yield frame
+
+
+POLICIES = {'lru': LRU, 'clock': Clock}
+
+
+class Pager:
+    '''
+    PhysicalMemory (same interface) whose pages of files can be swapped out
+    '''
+
+    def __init__(self, memory, allocator, lock, path, policy='lru', index=None):
+        '''
+        memory: the PhysicalMemory holding the frames
+        allocator: PageAllocator of the frames
+        lock: the file system's lock
+        path: swap file, created (or truncated) here
+        policy: 'lru' or 'clock'
+        index: PageIndex of deduplicated pages, which evicted frames leave
+        '''
+        self.memory = memory
+        self.allocator = allocator
+        self.index = index
+        self.lock = lock
+        self.page_size = memory.page_size
+        self.num_frames = memory.num_frames
+        self.swap = SwapFile(path, memory.page_size)
+        self.policy = POLICIES[policy](memory.num_frames)
+        # swap slot -> File whose page is in it
+        self.owners = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+        }
+
+    @property
+    def view(self):
+        return self.memory.view
+
+    @property
+    def dirty(self):
+        return self.memory.dirty
+
+    @property
+    def buffer(self):
+        return self.memory.buffer
+
+    def touch(self, frames):
+        for frame in frames:
+            if frame >= 0:
+                self.policy.touch(frame)
+
+    def read(self, pages, start, size):
+        if size <= 0:
+            return self.memory.read(pages, start, size)
+        with self.lock:
+            self.fault(pages, start // self.page_size,
+                       (start + size - 1) // self.page_size)
+            return memoryview(bytes(self.memory.read(pages, start, size)))
+
+    def write(self, pages, data, start=0):
+        with self.lock:
+            if len(data):
+                self.fault(pages, start // self.page_size,
+                           (start + len(data) - 1) // self.page_size)
+            self.memory.write(pages, data, start)
+
+    def copy(self, src, dst):
+        self.memory.copy(src, dst)
+        self.policy.touch(dst)
+
+    def fault(self, pages, first, last):
+        '''
+        Bring pages[first:last + 1] into frames and count them as accessed
+        Raises MemoryError if no frame can be freed for a swapped page
+        '''
+        stats = self.stats
+        for i in range(first, last + 1):
+            if pages[i] >= 0:
+                stats['hits'] += 1
+            else:
+                stats['misses'] += 1
+                if not self.make_room(1, pages):
+                    raise MemoryError('No frame can be freed for a swapped page')
+                slot = -1 - pages[i]
+                file = self.owners.pop(slot)
+                frame = self.allocator.allocate(1, file)[0]
+                start = frame * self.page_size
+                self.memory.view[start:start + self.page_size] = self.swap.read(slot)
+                self.swap.release(slot)
+                pages[i] = frame
+                file.extents = None
+            self.policy.touch(pages[i])
+
+    def fault_all(self, pages):
+        '''bring every page of a page table into frames; False if they don't fit'''
+        try:
+            if pages:
+                self.fault(pages, 0, len(pages) - 1)
+        except MemoryError:
+            return False
+        return True
+
+    def make_room(self, count, protect=()):
+        '''
+        Evict pages until count frames are free, sparing the frames in protect
+        Returns False if there aren't enough pages to evict
+        '''
+        if self.allocator.get_free_count() >= count:
+            return True
+        protect = set(protect)
+        for frame in self.policy.candidates():
+            if frame in protect:
+                continue
+            self._evict(frame)
+            if self.allocator.get_free_count() >= count:
+                return True
+        return False
+
+    def _evict(self, frame):
+        file = self.allocator.get_owner(frame)
+        self.policy.remove(frame)
+        # freed, a packed tail or a frame of a deleted file; the pages of
+        # a file with old versions may be shared with them
+        if not isinstance(file, File) or file.history:
+            return
+        pages = file.get_pages()
+        try:
+            index = pages.index(frame)
+        except ValueError:
+            return
+        slot = self.swap.allocate()
+        start = frame * self.page_size
+        self.swap.write(slot, self.memory.view[start:start + self.page_size])
+        self.owners[slot] = file
+        pages[index] = -1 - slot
+        file.extents = None
+        if self.index is not None:
+            self.index.forget(frame)
+        self.allocator.free([frame])
+        self.stats['evictions'] += 1
+
+    def release(self, pages):
+        '''free the swap slots of a page table; returns the pages in frames'''
+        for page in pages:
+            if page < 0:
+                self.owners.pop(-1 - page, None)
+                self.swap.release(-1 - page)
+        return [page for page in pages if page >= 0]
+
+    def get_swapped_count(self):
+        return len(self.owners)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        accesses = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / accesses if accesses else 0
+        stats['swapped_pages'] = self.get_swapped_count()
+        stats['swap_slots'] = self.swap.size
+        return stats
@@ -1,215 +1,414 @@
+from commands import INVALID, compile_script
+from edit_buffer import EditBuffer, span
+from lock_manager import DEADLOCK, WHOLE, covers, merge
+from output import OutputSink
 from util import *
+from versions import Snapshot
 
 
-def thread_runner(name, outfile, fs, commands):
+class Runner:
     '''
-    name: id of thread (instead of threading.get_ident() for simplicity)
-    outfile: file path of output
-    fs: FileSystem object
-    commands: list of commands to perform
+    State of one thread_runner: the thread's output and its open files
+    Every op of the command language is a method taking the arguments
+    of its opcode tuple (see commands.SIGNATURES)
     '''
-    thread_id = name
-    # filename -> (file, current_contents)
-    # used to store the reference to the file object
-    # and the current contents (possibly modified in w mode)
-    cache = {}
-    for command in commands:
-        print(name, command)
-        tokens = command.split()
-        # empty command
-        if len(tokens) == 0:
-            continue
-        # File System and Directory related Commands
-        if tokens[0] == 'mkdir':
-            dirname = tokens[-1]
-            result = fs.mkdir(dirname)
-            if type(result) != int:
-                print2file(fs, outfile)
-            else:
-                if result == 0:
-                    msg = "Duplicate directory. Operation ignored."
-                else:
-                    msg = "No such parent directory exists!"
-                write2file(outfile, msg)
-        elif tokens[0] == 'chdir':
-            dirname = tokens[-1]
-            result = fs.chdir(dirname)
+
+    def __init__(self, name, fs, out, tree_output):
+        self.thread_id = name
+        self.fs = fs
+        self.out = out
+        self.tree_output = tree_output
+        # filename -> (file, EditBuffer) in w mode, (file, Snapshot) in r mode
+        # used to store the reference to the file object and the edits
+        # made to its contents until it is closed, or the version it reads
+        # (in a mode, the EditBuffer only holds the appended text)
+        self.cache = {}
+        # files opened in p mode: every edit locks the bytes it touches
+        self.inferred = set()
+
+    # File System and Directory related Commands
+
+    def mkdir(self, dirname, parents=False):
+        result = self.fs.mkdir(dirname, parents)
+        if type(result) != int:
+            tree2file(self.fs, self.out, self.tree_output, 'mkdir', result)
+        else:
             if result == 0:
-                write2file(outfile, "No such directory exists!")
-            else:
-                write2file(outfile, fs.pwd())
-        elif tokens[0] == 'mv':
-            f1, f2 = tokens[1:]
-            result = fs.mv(f1, f2)
-            if type(result) == int:
-                if result == 0:
-                    msg = "Source file doesn't exist!"
-                else:
-                    msg = "Destination directory doesn't exist!"
-                write2file(outfile, msg)
-            else:
-                print2file(fs, outfile)
-        elif tokens[0] == 'pwd':
-            write2file(outfile, fs.pwd())
-        elif tokens[0] == 'print':
-            print2file(fs, outfile)
-        elif tokens[0] == 'show_memory_map':
-            showmm2file(fs, outfile)
-        elif tokens[0] == 'save':
-            dst = tokens[-1]
-            fs.save(dst)
-            write2file(outfile, f'Filesystem saved at {dst}')
-        # File I/O
-        elif tokens[0] == 'create':
-            fname = tokens[-1]
-            result = fs.create(fname)
-            if type(result) == int:
-                if result == 0:
-                    msg = "No such directory exists!"
-                else:
-                    msg = "Duplicate file. Operation ignored."
-                write2file(outfile, msg)
+                msg = "Duplicate directory. Operation ignored."
             else:
-                print2file(fs, outfile)
-        elif tokens[0] == 'delete':
-            fname = tokens[-1]
-            result = fs.delete(fname)
-            if result:
-                print2file(fs, outfile)
-            else:
-                write2file(outfile, "No such file exists!")
-        elif tokens[0] == 'open':
-            fname, mode = tokens[1:]
-            if mode == 'r':
-                mode_msg = 'reading'
-            elif mode == 'w':
-                mode_msg = 'writing'
-            else:
-                # invalid mode
-                continue
-            file = fs.open(fname)
-            if file == False:
-                write2file(outfile, f"{fname} doesn't exist")
-                continue
-            if fname in global_file_table:
-                # opening again without closing
-                if thread_id in global_file_table[fname]:
-                    write2file(
-                        outfile, f"{fname} must be closed before opening it again")
-                    continue
-                '''
-                More than one thread cannot open a file for writing
-                The current thread must wait
-                An implementation of locking via busy wait:
-                    If thread wants to write
-                    Then check if another thread is writing to this file
-                    Wait until that thread closes the file
-                In future, this will be replaced with semaphores.
-                '''
-                if mode == 'w':
-                    while 'w' in global_file_table[fname].values():
-                        pass
-                # add this thread to the list of threads who have opened this file
-                global_file_table[fname][thread_id] = mode
+                msg = "No such parent directory exists!"
+            write2file(self.out, msg)
+
+    def mkdirs(self, dirname):
+        '''mkdir -p: make the missing parent directories too'''
+        self.mkdir(dirname, True)
+
+    def cd(self, dirname):
+        result = self.fs.cd(dirname)
+        if result == 0:
+            write2file(self.out, "No such directory exists!")
+        else:
+            write2file(self.out, self.fs.pwd())
+
+    def mv(self, f1, f2):
+        result = self.fs.mv(f1, f2)
+        if type(result) == int:
+            if result == 0:
+                msg = "Source file doesn't exist!"
             else:
-                global_file_table[fname] = {thread_id: mode}
-            cache[fname] = (file, file.get_contents())
-            write2file(outfile, f"{fname} opened for {mode_msg}")
-        elif tokens[0] == 'close':
-            fname = tokens[-1]
-            file, contents = cache.pop(fname, (None, None))
-            if file == None:
-                write2file(
-                    outfile, f"{fname} has not been opened / doesn't exist")
-                continue
-            result = fs.close(fname, contents)
+                msg = "Destination directory doesn't exist!"
+            write2file(self.out, msg)
+        else:
+            tree2file(self.fs, self.out, self.tree_output, 'mv', f1, result)
+
+    def cp(self, f1, f2):
+        result = self.fs.cp(f1, f2)
+        if type(result) == int:
+            write2file(self.out, COPY_ERRORS[result])
+        else:
+            tree2file(self.fs, self.out, self.tree_output, 'cp', f1, result)
+
+    def pwd(self):
+        write2file(self.out, self.fs.pwd())
+
+    def print(self):
+        print2file(self.fs, self.out)
+
+    def show_memory_map(self):
+        showmm2file(self.fs, self.out)
+
+    def save(self, dst):
+        if self.fs.save(dst) == 1:
+            write2file(self.out, 'Cannot save while pages are swapped out')
+        else:
+            write2file(self.out, f'Filesystem saved at {dst}')
+
+    # File I/O
+
+    def create(self, fname):
+        result = self.fs.create(fname)
+        if type(result) == int:
             if result == 0:
-                write2file(outfile, f"{fname} doesn't exist!")
-                continue
-            # remove association of thread with this file from GFT, if it exists
-            if fname not in global_file_table:
-                write2file(outfile,
-                           f"BUG: {fname} exists in thread's cache but not in GFT")
-                continue
-            thread_list = global_file_table[fname]
-            if thread_id not in thread_list:
-                write2file(outfile, f"This thread has not opened {fname}")
-                continue
-            # if this was a writer thread, another writer thread trying to access
-            # this file will not be blocked anymore
-            del global_file_table[fname][thread_id]
-            # remove this file from GFT if no threads have opened it
-            if len(global_file_table[fname]) == 0:
-                pass
-                #del global_file_table[fname]
-            # python thinks 1 and True are the same so I have to use 'is' instead =_=
-            if result is 1:
-                write2file(
-                    outfile, f"Not enough frames available to save changes made to {fname}")
+                msg = "No such directory exists!"
             else:
-                write2file(
-                    outfile, f"{fname} has been closed and any changes made were saved.")
-        elif tokens[0] == 'read':
-            fname = tokens[1]
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'r'):
-                continue
-            file, _ = cache[fname]
-            result = file.read()
-            write2file(outfile, f'Contents of {fname}: {result}')
-        elif tokens[0] == 'read_from':
-            fname = tokens[1]
-            start = int(tokens[2])
-            size = int(tokens[3])
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'r'):
-                continue
-            file, _ = cache[fname]
-            result = file.read_from(start, size)
-            write2file(outfile, f'Contents of {fname}: {result}')
-        elif tokens[0] == 'append':
-            fname = tokens[1]
-            text = ' '.join(tokens[2:])
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'w'):
-                continue
-            file, contents = cache[fname]
-            new_contents = append(contents, text)
-            cache[fname] = (file, new_contents)
+                msg = "Duplicate file. Operation ignored."
+            write2file(self.out, msg)
+        else:
+            tree2file(self.fs, self.out, self.tree_output, 'create', result)
+
+    def delete(self, fname, recursive=False):
+        result = self.fs.delete(fname, recursive)
+        if type(result) != int:
+            tree2file(self.fs, self.out, self.tree_output, 'delete', result)
+        elif result == 0:
+            write2file(self.out, "No such file exists!")
+        else:
+            write2file(self.out, "Directory not empty. Operation ignored.")
+
+    def rmtree(self, fname):
+        '''rm -r: delete a directory with everything below it'''
+        self.delete(fname, True)
+
+    def open(self, fname, mode, start=None, end=None):
+        file = self._check_open(fname, mode, start, end)
+        if file is None:
+            return
+        '''
+        Writers of overlapping byte ranges cannot have a file open at once
+        The current thread sleeps in the lock manager until
+        the writers holding these bytes close the file
+        '''
+        lock_mode, ranges = self._lock_request(mode, start, end)
+        result = lock_manager.acquire(
+            self._path(fname), self.thread_id, lock_mode, ranges=ranges)
+        self._opened(fname, mode, file, result)
+
+    def _lock_request(self, mode, start, end):
+        '''
+        (lock mode, byte ranges) of an open
+        w    -> the whole file, or bytes [start, end) (end None: to the end)
+        p    -> no bytes yet; each edit locks the bytes it touches
+        a    -> appending, which never conflicts with other appenders
+        '''
+        if mode == 'w':
+            return 'w', [WHOLE] if start is None else [(start, end)]
+        if mode == 'p':
+            return 'w', []
+        return mode, []
+
+    def _check_open(self, fname, mode, start=None, end=None):
+        '''the file to open, or None (after writing why) if it can't be opened'''
+        if mode not in ('r', 'w', 'p', 'a'):
+            # invalid mode
+            return None
+        if start is not None and (mode != 'w' or start < 0 or
+                                  (end is not None and end <= start)):
+            # invalid byte range
+            return None
+        file = self.fs.open(fname)
+        if file == False:
+            write2file(self.out, f"{fname} doesn't exist")
+            return None
+        # opening again without closing
+        if self._held(fname) is not None:
             write2file(
-                outfile, f'Append text {text} to {fname} committed as transaction.')
-        elif tokens[0] == 'write_at':
-            fname = tokens[1]
-            text = ' '.join(tokens[2:-1])
-            pos = int(tokens[-1])
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'w'):
-                continue
-            file, contents = cache[fname]
-            new_contents = write_at(contents, pos, text)
-            cache[fname] = (file, mode, new_contents)
+                self.out, f"{fname} must be closed before opening it again")
+            return None
+        return file
+
+    def _opened(self, fname, mode, file, result):
+        '''cache the file once the lock request returned result'''
+        if result is not True:
+            if result == DEADLOCK:
+                msg = f"Opening {fname} would deadlock. Operation ignored."
+            else:
+                msg = f"Timed out waiting to open {fname}"
+            write2file(self.out, msg)
+            return
+        path = self._path(fname)
+        if mode == 'r':
+            # readers pin the committed version instead of copying it
+            self.cache[path] = (file, self.fs.snapshot())
+        elif mode == 'a':
+            # appended text is added to the end as it is at close
+            self.cache[path] = (file, EditBuffer(''))
+        else:
+            self.cache[path] = (file, EditBuffer(file.get_contents()))
+        if mode == 'p':
+            self.inferred.add(path)
+        mode_msg = {'r': 'reading', 'a': 'appending'}.get(mode, 'writing')
+        write2file(self.out, f"{fname} opened for {mode_msg}")
+
+    def _path(self, fname):
+        '''
+        absolute path of fname: open files are cached and locked by it,
+        so every name of a file refers to the same lock
+        '''
+        return self.fs.abspath(fname)
+
+    def _held(self, fname):
+        '''mode this thread has fname open in, or None'''
+        return lock_manager.mode(self._path(fname), self.thread_id)
+
+    def _ranges(self, fname):
+        '''byte ranges this thread holds of fname'''
+        return lock_manager.ranges(self._path(fname), self.thread_id)
+
+    def _lock_range(self, fname, start, end):
+        '''add bytes [start, end) of fname to the ones this thread holds'''
+        path = self._path(fname)
+        result = lock_manager.acquire(
+            path, self.thread_id, 'w', ranges=[(start, end)])
+        if result is True:
+            file, contents = self.cache[path]
+            contents.reload(file, start, end)
+        return result
+
+    def _release(self, fname):
+        path = self._path(fname)
+        self.inferred.discard(path)
+        return lock_manager.release(path, self.thread_id)
+
+    def _commit(self, fname, contents):
+        '''
+        Commit the edits of a writer or appender
+        Writers of byte ranges only commit the bytes they hold, so the
+        changes other writers made to the rest of the file are kept
+        '''
+        if self._held(fname) == 'a':
+            return self.fs.append(fname, contents.getvalue())
+        ranges = merge(self._ranges(fname))
+        if ranges == [WHOLE]:
+            return self.fs.close(fname, contents)
+        return self.fs.close(fname, contents.edits_in(ranges))
+
+    def close(self, fname):
+        out = self.out
+        file, contents = self.cache.pop(self._path(fname), (None, None))
+        if file == None:
             write2file(
-                outfile, f'Append text {text} to {fname} committed as transaction.')
-        elif tokens[0] == 'move':
-            fname = tokens[1]
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'w'):
-                continue
-            # read tokens from position 2 onwards
-            # map the items in the list to integers
-            # cast to tuple and unpack it
-            start, size, target = tuple(map(int, tokens[2:]))
-            file, contents = cache[fname]
-            new_contents = move(contents, start, size, target)
-            cache[fname] = (file, mode, new_contents)
-            write2file(outfile,
-                       f'Move text in {fname} from {start} till {start + size} to {target} committed as transaction.')
-        elif tokens[0] == 'tr':
-            fname = tokens[1]
-            size = int(tokens[2])
-            if not assert_file_availability(fname, thread_id, cache, outfile, 'w'):
-                continue
-            file, contents = cache[fname]
-            new_contents = truncate(contents, size)
-            cache[fname] = (file, mode, new_contents)
-            write2file(outfile,
-                       f'Truncate contents of {fname} to {result} committed as transaction.')
-        # break on encounter of invalid command
-        # not ignoring because other commands may depend on this
+                out, f"{fname} has not been opened / doesn't exist")
+            return
+        if isinstance(contents, Snapshot):
+            contents.close()
+            result = 0 if self.fs.open(fname) == False else True
         else:
-            break
+            result = self._commit(fname, contents)
+        # if this was a writer thread, another writer thread waiting
+        # for this file is woken up
+        released = self._release(fname)
+        if result == 0:
+            write2file(out, f"{fname} doesn't exist!")
+            return
+        if not released:
+            write2file(out, f"This thread has not opened {fname}")
+            return
+        # close returns True when it saved, so 1 can't be told apart with ==
+        if result is not True:
+            write2file(
+                out, f"Not enough frames available to save changes made to {fname}")
+        else:
+            write2file(
+                out, f"{fname} has been closed and any changes made were saved.")
+
+    def release_snapshots(self):
+        '''release the snapshots of the files left open for reading'''
+        for _, contents in self.cache.values():
+            if isinstance(contents, Snapshot):
+                contents.close()
+
+    def _available(self, fname, permission):
+        return assert_file_availability(
+            fname, self.thread_id, self.cache, self.out, permission,
+            self._path(fname))
+
+    def _editable(self, fname, op, *args):
+        '''
+        Check that this thread can run edit op on fname: the file is open
+        for writing (or appending, for append) and the bytes the edit
+        touches are locked; files opened in p mode lock them now
+        Writes why not if it can't
+        '''
+        if op == 'append' and self._held(fname) == 'a':
+            return self._available(fname, 'a')
+        if not self._available(fname, 'w'):
+            return False
+        path = self._path(fname)
+        start, end = span(len(self.cache[path][1]), op, *args)
+        if covers(self._ranges(fname), start, end):
+            return True
+        last = 'the end' if end is None else end
+        if path not in self.inferred:
+            msg = f"{fname} is not locked from {start} to {last}. Operation ignored."
+        else:
+            result = self._lock_range(fname, start, end)
+            if result is True:
+                return True
+            if result == DEADLOCK:
+                msg = f"Locking {fname} from {start} to {last} would deadlock. Operation ignored."
+            else:
+                msg = f"Timed out waiting to lock {fname} from {start} to {last}"
+        write2file(self.out, msg)
+        return False
+
+    def read(self, fname):
+        if not self._available(fname, 'r'):
+            return
+        result = self._read(fname, 0, None)
+        if result is not None:
+            write2file(self.out, f'Contents of {fname}: {str(result, "utf-8")}')
+
+    def read_from(self, fname, start, size):
+        if not self._available(fname, 'r'):
+            return
+        result = self._read(fname, start, size)
+        if result is not None:
+            write2file(self.out, f'Contents of {fname}: {str(result, "utf-8", "replace")}')
+
+    def _read(self, fname, start, size):
+        '''
+        size bytes (None: all) of fname from start as of its open
+        If swapped pages can't be brought back into frames, fname is
+        closed (its snapshot and lock released) and None is returned
+        '''
+        path = self._path(fname)
+        file, snapshot = self.cache[path]
+        layout = snapshot.layout(file)
+        try:
+            return file.read_from(start, layout[2] if size is None else size, layout)
+        except MemoryError:
+            del self.cache[path]
+            snapshot.close()
+            self._release(fname)
+            write2file(
+                self.out, f"Not enough frames available to read {fname}. {fname} has been closed.")
+
+    def append(self, fname, text):
+        if not self._editable(fname, 'append', text):
+            return
+        _, contents = self.cache[self._path(fname)]
+        contents.append(text)
+        write2file(
+            self.out, f'Append text {text} to {fname} committed as transaction.')
+
+    def write_at(self, fname, text, pos):
+        if not self._editable(fname, 'write_at', text, pos):
+            return
+        _, contents = self.cache[self._path(fname)]
+        contents.write_at(pos, text)
+        write2file(
+            self.out, f'Append text {text} to {fname} committed as transaction.')
+
+    def move(self, fname, start, size, target):
+        if not self._editable(fname, 'move', start, size, target):
+            return
+        _, contents = self.cache[self._path(fname)]
+        contents.move(start, size, target)
+        write2file(self.out,
+                   f'Move text in {fname} from {start} till {start + size} to {target} committed as transaction.')
+
+    def tr(self, fname, size):
+        if not self._editable(fname, 'tr', size):
+            return
+        _, contents = self.cache[self._path(fname)]
+        contents.truncate(size)
+        write2file(self.out,
+                   f'Truncate contents of {fname} to {size} committed as transaction.')
+
+
+# op -> Runner method
+DISPATCH = {
+    'mkdir': Runner.mkdir,
+    'mkdirs': Runner.mkdirs,
+    'cd': Runner.cd,
+    'mv': Runner.mv,
+    'cp': Runner.cp,
+    'pwd': Runner.pwd,
+    'print': Runner.print,
+    'show_memory_map': Runner.show_memory_map,
+    'save': Runner.save,
+    'create': Runner.create,
+    'delete': Runner.delete,
+    'rmtree': Runner.rmtree,
+    'open': Runner.open,
+    'close': Runner.close,
+    'read': Runner.read,
+    'read_from': Runner.read_from,
+    'append': Runner.append,
+    'write_at': Runner.write_at,
+    'move': Runner.move,
+    'tr': Runner.tr,
+}
+
+
+def thread_runner(name, outfile, fs, commands, echo=False, tree_output='full'):
+    '''
+    name: id of thread (instead of threading.get_ident() for simplicity)
+    outfile: file path of output, or an OutputSink to write to
+    fs: FileSystem object
+    commands: iterable of command lines or of compiled opcode tuples
+              (see commands.compile_script); lines are compiled as
+              they are read
+    echo: print every command to stdout before running it
+    tree_output: after mkdir/create/mv/delete, write the whole tree ('full')
+                 or only the change ('delta')
+    '''
+    # output is buffered in memory and written by the sink's flusher
+    if isinstance(outfile, str):
+        out = OutputSink(outfile)
+    else:
+        out = outfile
+    runner = Runner(name, fs, out, tree_output)
+    try:
+        for op in compile_script(commands):
+            if echo:
+                print(name, *op)
+            # break on encounter of invalid command
+            # not ignoring because other commands may depend on this
+            if op[0] == INVALID:
+                break
+            DISPATCH[op[0]](runner, *op[1:])
+    finally:
+        runner.release_snapshots()
+        if out is not outfile:
+            out.close()
@@ -0,0 +1,139 @@
+'''
+Read-only views of the directory tree used by FileSystem.print
+The text and JSON layouts are the ones treelib produced:
+children are sorted by name, and a node without children is a bare
+name in the JSON
+
+TreeView keeps both renderings cached per directory and patches them when
+a child is added or removed, so printing after a mutation only re-renders
+the directories on the path to the root that changed.
+'''
+import json
+from bisect import bisect_left
+
+from directory import Directory
+
+
+class DirView:
+    '''Cached rendering of one directory's children'''
+
+    def __init__(self, directory):
+        # child names in sorted order, with one text and JSON part each
+        self.names = sorted(directory.children)
+        self.text_parts = [None] * len(self.names)
+        self.json_parts = [None] * len(self.names)
+        # children whose parts must be re-rendered
+        self.stale = set(self.names)
+        # joined parts (without the directory's own name); None when a part changed
+        self.text = None
+        self.json = None
+
+
+class TreeView:
+    def __init__(self, root):
+        self.root = root
+
+    def _view(self, directory):
+        if directory.view is None:
+            directory.view = DirView(directory)
+        return directory.view
+
+    def _touch(self, directory, name):
+        '''mark the part of child name and every ancestor's part as stale'''
+        node = directory
+        while node is not None:
+            view = node.view
+            if view is None:
+                # never rendered; its parent still has to re-render it
+                name = node.get_name()
+                node = node.parent
+                continue
+            if view.text is None and name in view.stale:
+                # the rest of the path is already stale
+                return
+            view.stale.add(name)
+            view.text = view.json = None
+            name = node.get_name()
+            node = node.parent
+
+    def added(self, directory, node):
+        '''node was added to directory'''
+        view = directory.view
+        if view is not None:
+            name = node.get_name()
+            i = bisect_left(view.names, name)
+            if i < len(view.names) and view.names[i] == name:
+                # replaced an existing child of the same name
+                view.stale.add(name)
+            else:
+                view.names.insert(i, name)
+                view.text_parts.insert(i, None)
+                view.json_parts.insert(i, None)
+                # the previous last child loses its corner connector
+                if i == len(view.names) - 1 and i > 0:
+                    view.stale.add(view.names[i - 1])
+        self._touch(directory, node.get_name())
+
+    def removed(self, directory, name):
+        '''the child name was removed from directory'''
+        view = directory.view
+        if view is not None:
+            i = bisect_left(view.names, name)
+            del view.names[i]
+            del view.text_parts[i]
+            del view.json_parts[i]
+            view.stale.discard(name)
+            # the new last child gets the corner connector
+            if i == len(view.names) and i > 0:
+                view.stale.add(view.names[i - 1])
+            view.text = view.json = None
+        if directory.parent is not None:
+            self._touch(directory.parent, directory.get_name())
+
+    def _refresh(self, directory):
+        '''re-render the stale parts of directory and join them'''
+        view = self._view(directory)
+        if view.text is not None:
+            return view
+        last = len(view.names) - 1
+        for name in view.stale:
+            i = bisect_left(view.names, name)
+            child = directory.children[name]
+            if i == last:
+                line, lead = '└── ', '    '
+            else:
+                line, lead = '├── ', '│   '
+            text = line + name
+            child_json = json.dumps(name)
+            if isinstance(child, Directory) and child.children:
+                child_view = self._refresh(child)
+                text += '\n' + lead + child_view.text.replace('\n', '\n' + lead)
+                child_json = _json_node(name, child_view)
+            view.text_parts[i] = text
+            view.json_parts[i] = child_json
+        view.stale.clear()
+        view.text = '\n'.join(view.text_parts)
+        view.json = ', '.join(view.json_parts)
+        return view
+
+    def render(self):
+        '''the tree as text, one node per line'''
+        view = self._refresh(self.root)
+        if not view.names:
+            return self.root.get_name() + '\n'
+        return self.root.get_name() + '\n' + view.text + '\n'
+
+    def to_json(self):
+        return _json_node(self.root.get_name(), self._refresh(self.root))
+
+
+def _json_node(name, view):
+    '''
+    JSON of a directory from its cached children
+    Names live in the parent's part, so renaming a directory
+    does not invalidate its own view
+    '''
+    if not view.names:
+        return json.dumps(name)
+    return '{%s: {"children": [%s]}}' % (json.dumps(name), view.json)
+
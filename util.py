@@ -1,22 +1,27 @@
 import os
-# redirect output of printing
-from contextlib import redirect_stdout
 from pathlib import Path
 
+from lock_manager import LockManager
+
 # file/directory separator for cross-platform usability
 SEP = os.path.sep
+# number of physical frames and the size of each frame in bytes
+NUM_FRAMES = 10000
+PAGE_SIZE = 64
 '''
-Global File Table that keeps track of which threads have opened what file and in which mode
-Structure:
-{
-    filename:
-    {
-        thread_id: mode
-    }
-}
-For every file, only 1 thread can open a file in w mode at one time
+Lock manager that keeps track of which threads have opened what file and in which mode
+For every file, only 1 thread can open a file in w mode at one time;
+other writers block (without spinning) until it is closed
 '''
-global_file_table = dict()
+lock_manager = LockManager()
+
+# messages for the failure codes of FileSystem.cp
+COPY_ERRORS = {
+    0: "Source file doesn't exist!",
+    1: "Destination directory doesn't exist!",
+    2: "Destination is a directory.",
+    3: "Not enough frames available to copy this file.",
+}
 
 
 def get_name(path):
@@ -34,71 +39,88 @@ def get_parent(path):
     return str(parent)
 
 
-def print2file(fs, fn):
+def print2file(fs, out):
     '''
     fs -> FileSystem object
-    fn -> file name
+    out -> OutputSink of the thread
     '''
-    with open(fn, 'a') as f:
-        with redirect_stdout(f):
-            fs.print()
-            print()
+    out.write(fs.render() + '\n')
 
 
-def showmm2file(fs, fn):
+def showmm2file(fs, out):
     '''
     fs -> FileSystem object
-    fn -> file name
+    out -> OutputSink of the thread
+    '''
+    lines = [f'{path} {pages} {size}\n' for path, pages, size in fs.memory_map()]
+    out.write(''.join(lines))
+
+
+def tree2file(fs, out, tree_output, op, *paths):
+    '''
+    Report a change to the tree after a successful op
+    tree_output -> 'full' writes the whole tree
+                   'delta' writes one line describing the change
+    paths -> path created/deleted, or source and destination of mv/cp
     '''
-    with open(fn, 'a') as f:
-        with redirect_stdout(f):
-            fs.show_mm()
-            print()
+    if tree_output == 'full':
+        print2file(fs, out)
+    elif op in ('mkdir', 'create'):
+        out.write(f'+ {paths[0]}')
+    elif op == 'delete':
+        out.write(f'- {paths[0]}')
+    elif op == 'cp':
+        out.write(f'+ {paths[1]}')
+    else:
+        out.write(f'~ {paths[0]} -> {paths[1]}')
 
 
-def write2file(fn, txt):
-    '''write text to file 'fn'''
-    with open(fn, 'a') as f:
-        with redirect_stdout(f):
-            print(txt)
+def write2file(out, txt):
+    '''write text to the thread's OutputSink 'out'''
+    out.write(txt)
 
 
 def is_file_open(fname, thread_id, cache):
     if fname not in cache:
         return False
-    if fname not in global_file_table:
-        return False
-    return thread_id in global_file_table[fname]
+    return lock_manager.mode(fname, thread_id) is not None
 
 
 def can_write_to_file(fname, thread_id):
-    '''
-    Must always be preceded by is_file_open()
-    Otherwise, it can throw a KeyError
-    '''
-    return global_file_table[fname][thread_id] == 'w'
+    return lock_manager.mode(fname, thread_id) == 'w'
+
+
+def can_append_to_file(fname, thread_id):
+    return lock_manager.mode(fname, thread_id) in ('w', 'a')
 
 
 def can_read_file(fname, thread_id):
-    return global_file_table[fname][thread_id] == 'r'
+    return lock_manager.mode(fname, thread_id) == 'r'
 
 
-def assert_file_availability(fname, thread_id, cache, outfile, permission):
+def assert_file_availability(fname, thread_id, cache, out, permission, path=None):
     # checks if a file is open / exists
     # checks if thread has a permission
     # writes error message in case checks fail
-    if not is_file_open(fname, thread_id, cache):
-        write2file(outfile, f"{fname} is not open / doesn't exist")
+    # path: absolute path the file is cached and locked by (default fname)
+    key = fname if path is None else path
+    if not is_file_open(key, thread_id, cache):
+        write2file(out, f"{fname} is not open / doesn't exist")
         return False
     if permission == 'r':
-        if not can_read_file(fname, thread_id):
+        if not can_read_file(key, thread_id):
             write2file(
-                outfile, f"Thread does not have reading permission for {fname}")
+                out, f"Thread does not have reading permission for {fname}")
             return False
     if permission == 'w':
-        if not can_write_to_file(fname, thread_id):
+        if not can_write_to_file(key, thread_id):
+            write2file(
+                out, f"Thread does not have writing permission for {fname}")
+            return False
+    if permission == 'a':
+        if not can_append_to_file(key, thread_id):
             write2file(
-                outfile, f"Thread does not have writing permission for {fname}")
+                out, f"Thread does not have appending permission for {fname}")
             return False
     return True
 
@@ -0,0 +1,168 @@
+'''
+Multi-version files: snapshot reads that never wait for writers
+
+Every commit of a file (FileSystem.close) publishes a new version of it,
+numbered by a counter shared by the whole file system. A Snapshot pins
+the counter when it is taken and reads each file as of its newest
+version at or before that number, however many commits follow.
+
+Versions are the layouts of File.get_layout(). While no snapshot is
+pinned, a commit frees the frames of the old version right away. If a
+snapshot is older than the commit, the old layout is kept in the file's
+history and its frames are retired instead; both are collected once the
+last snapshot that can see them is released.
+'''
+from collections import Counter, deque
+
+# layout of a file that didn't exist yet
+EMPTY = ([], b'', 0)
+
+
+class Snapshot:
+    '''
+    Committed contents of the file system as of one version
+    A snapshot of the tree also keeps the paths of that moment, so files
+    moved or deleted later are still read at their old paths
+    '''
+
+    def __init__(self, fs, version, files=None):
+        self.fs = fs
+        self.version = version
+        # path -> File, for tree snapshots
+        self.files = files
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def layout(self, file):
+        '''(pages, tail, length) of file in this snapshot'''
+        # a commit updates the layout before the version of the file
+        with self.fs.lock:
+            return self.fs.versions.layout(file, self.version)
+
+    def lookup(self, path):
+        '''the File at an absolute path in this snapshot, or None'''
+        if self.files is not None:
+            return self.files.get(path)
+        return self.fs._lookup_file(path)
+
+    def read(self, path, start=0, size=None):
+        '''
+        Bytes of the file at an absolute path in this snapshot
+        Returns None if there was no file there
+        '''
+        file = self.lookup(path)
+        if file is None:
+            return None
+        layout = self.layout(file)
+        if size is None:
+            size = layout[2]
+        return bytes(file.read_from(start, size, layout))
+
+    def copy(self):
+        '''another pin of the same version, released on its own'''
+        with self.fs.lock:
+            return Snapshot(self.fs, self.fs.versions.pin(self.version), self.files)
+
+    def close(self):
+        '''release the snapshot; versions only it could see are collected'''
+        if not self.closed:
+            self.closed = True
+            self.fs.release_snapshot(self)
+
+
+class VersionManager:
+    '''Version numbers, pinned snapshots and the versions kept for them'''
+
+    def __init__(self):
+        # number of the last committed version
+        self.version = 0
+        # version -> snapshots pinning it
+        self.pinned = Counter()
+        # (version of the commit, file, frames it replaced), oldest first
+        self.retired = deque()
+        # id -> File with old versions in its history
+        self.kept = {}
+        self.stats = {
+            'snapshots': 0,
+            'kept': 0,
+            'retired': 0,
+        }
+
+    def is_pinned(self):
+        return bool(self.pinned)
+
+    def pin(self, version=None):
+        '''
+        pin the last version, or an older one that is still pinned
+        (its versions haven't been collected yet)
+        '''
+        if version is None:
+            version = self.version
+        self.pinned[version] += 1
+        self.stats['snapshots'] += 1
+        return version
+
+    def unpin(self, version):
+        self.pinned[version] -= 1
+        if not self.pinned[version]:
+            del self.pinned[version]
+
+    def commit(self, file, old, frames):
+        '''
+        Publish a new version of file
+        old: layout of the version it replaces (None if nothing is pinned)
+        frames: frames the old version no longer shares with the new one
+        Returns the frames that can be released now
+        '''
+        self.version += 1
+        if self.pinned:
+            file.history.append((file.version, old))
+            self.kept[id(file)] = file
+            self.retired.append((self.version, file, frames))
+            self.stats['kept'] += 1
+            self.stats['retired'] += len(frames)
+            frames = []
+        file.version = self.version
+        return frames
+
+    def layout(self, file, version):
+        '''layout of file as of version; call it with the file system locked'''
+        if file.version <= version:
+            return file.get_layout()
+        for committed, layout in reversed(file.history):
+            if committed <= version:
+                return layout
+        return EMPTY
+
+    def collect(self):
+        '''
+        Drop the versions no pinned snapshot can see
+        Returns the frames to release, as (file, frames) per commit
+        '''
+        # a version replaced at v is only seen by snapshots older than v
+        oldest = min(self.pinned) if self.pinned else self.version + 1
+        frames = []
+        while self.retired and self.retired[0][0] <= oldest:
+            frames.append(self.retired.popleft()[1:])
+        for key, file in list(self.kept.items()):
+            history = file.history
+            # entry i was replaced by the version of entry i + 1 (or the current one)
+            replaced = [committed for committed, _ in history[1:]] + [file.version]
+            keep = next((i for i, v in enumerate(replaced) if v > oldest), len(history))
+            del history[:keep]
+            if not history:
+                del self.kept[key]
+        return frames
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['version'] = self.version
+        stats['pinned'] = sum(self.pinned.values())
+        stats['history'] = sum(len(file.history) for file in self.kept.values())
+        stats['retired_frames'] = sum(len(frames) for _, _, frames in self.retired)
+        return stats
@@ -0,0 +1,248 @@
+'''
+On-disk volume image
+
+Layout (little endian):
+    superblock     -> SUPERBLOCK struct at offset 0
+    metadata       -> inode table followed by the bitmap
+    data pages     -> num_frames * page_size bytes, aligned so that the region
+                      can be mapped on its own; unused frames are left as holes
+
+The inode table has one record per directory/file, parents before children:
+INODE struct + name (utf-8) + page table (uint32 each), and for a file
+(since version 3) the TAIL struct of its tail (see File.tail), followed
+by the tail itself if it is inline.
+The bitmap has one byte per frame; 0 -> free / 1 -> occupied.
+
+Metadata lives in one of two slots: slot 0 sits between the superblock and
+the data pages, slot 1 after the data pages. A checkpoint writes the new
+metadata into the slot that is not in use and only then rewrites the
+superblock, so a crash during a checkpoint leaves the previous one intact.
+
+A volume is mounted by mapping the image copy-on-write: only the superblock,
+inode table and bitmap are parsed, and the data pages fault in from the file
+the first time a frame is read. Changes stay private to the process until
+the volume is saved or checkpointed.
+'''
+import mmap
+import os
+import struct
+
+from allocator import PageAllocator
+from directory import Directory
+from file import File
+from memory import PhysicalMemory
+
+MAGIC = b'ZOSVOL\x00\x00'
+VERSION = 3
+# magic, version, page size, frames, inodes,
+# inode table offset, inode table size, bitmap offset, data offset
+SUPERBLOCK_V1 = struct.Struct('<8sIIIIQQQQ')
+# version 2 appends the lsn of the last journal record folded into the image
+SUPERBLOCK = struct.Struct('<8sIIIIQQQQQ')
+# inode number, parent inode number, type, name length, size, length, pages
+INODE = struct.Struct('<IIBHQQI')
+DIRECTORY, FILE = 0, 1
+# kind of tail, frame and offset of its slot
+TAIL = struct.Struct('<BIH')
+NO_TAIL, INLINE, PACKED = 0, 1, 2
+
+
+def _align(offset):
+    granularity = mmap.ALLOCATIONGRANULARITY
+    return (offset + granularity - 1) // granularity * granularity
+
+
+def _encode_table(fs):
+    '''Serialize the tree as inode records in depth-first order'''
+    records = []
+    inode_numbers = {}
+    for node in fs._walk():
+        inode = len(inode_numbers)
+        inode_numbers[id(node)] = inode
+        parent = node.parent
+        parent_inode = inode if parent is None else inode_numbers[id(parent)]
+        name = node.get_name().encode()
+        if isinstance(node, File):
+            pages = node.get_pages()
+            header = INODE.pack(inode, parent_inode, FILE, len(name),
+                                node.get_size(), node.get_length(), len(pages))
+            tail = node.get_tail()
+            if tail is None:
+                tail = TAIL.pack(NO_TAIL, 0, 0)
+            elif isinstance(tail, bytes):
+                tail = TAIL.pack(INLINE, 0, 0) + tail
+            else:
+                tail = TAIL.pack(PACKED, *tail)
+            records.append(header + name + struct.pack(f'<{len(pages)}I', *pages)
+                           + tail)
+        else:
+            records.append(INODE.pack(inode, parent_inode, DIRECTORY,
+                                      len(name), 0, 0, 0) + name)
+    return b''.join(records), len(inode_numbers)
+
+
+def _superblock(fs, num_inodes, table_offset, table_size, data_offset, lsn):
+    return SUPERBLOCK.pack(MAGIC, VERSION, fs.memory.page_size,
+                           fs.allocator.num_frames, num_inodes, table_offset,
+                           table_size, table_offset + table_size, data_offset,
+                           lsn)
+
+
+def save(fs, name, lsn=0):
+    '''
+    Write fs as a volume image to name
+    lsn: last journal record reflected in fs
+    The image is written next to name and renamed over it,
+    so a crash never leaves a half-written volume behind
+    '''
+    allocator = fs.allocator
+    memory = fs.memory
+    table, num_inodes = _encode_table(fs)
+    metadata_size = len(table) + allocator.num_frames
+    table_offset = SUPERBLOCK.size
+    # leave room for the metadata to double before it has to move to slot 1
+    data_offset = _align(table_offset + 2 * metadata_size)
+    ps = memory.page_size
+    tmp = name + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_superblock(fs, num_inodes, table_offset, len(table),
+                            data_offset, lsn))
+        f.write(table)
+        f.write(allocator.bitmap)
+        # only occupied frames are written; free frames stay as holes
+        used_start = 0
+        for start, length in allocator.get_extents() + [(allocator.num_frames, 0)]:
+            if start > used_start:
+                f.seek(data_offset + used_start * ps)
+                f.write(memory.view[used_start * ps:start * ps])
+            used_start = start + length
+        f.truncate(data_offset + allocator.num_frames * ps)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, name)
+    # a copy written elsewhere does not replace the image being checkpointed
+    if fs.image is None or fs.image['path'] == name:
+        memory.dirty.clear()
+        fs.image = {'path': name, 'data_offset': data_offset, 'slot': 0}
+        fs.checkpoint_lsn = lsn
+
+
+def checkpoint(fs, lsn):
+    '''
+    Fold the changes made since the image was last written into it
+    Only frames written since then are copied, followed by the metadata
+    Falls back to a full save() if the image has no room for the metadata
+    '''
+    image = fs.image
+    allocator = fs.allocator
+    memory = fs.memory
+    ps = memory.page_size
+    data_offset = image['data_offset']
+    data_end = data_offset + allocator.num_frames * ps
+    table, num_inodes = _encode_table(fs)
+    if image['slot'] == 1:
+        if SUPERBLOCK.size + len(table) + allocator.num_frames > data_offset:
+            save(fs, image['path'], lsn)
+            return
+        table_offset, slot = SUPERBLOCK.size, 0
+    else:
+        table_offset, slot = data_end, 1
+
+    dirty = sorted(memory.dirty)
+    memory.dirty.clear()
+    with open(image['path'], 'r+b') as f:
+        # write dirty frames as runs of consecutive frames
+        i = 0
+        while i < len(dirty):
+            j = i + 1
+            while j < len(dirty) and dirty[j] == dirty[j - 1] + 1:
+                j += 1
+            f.seek(data_offset + dirty[i] * ps)
+            f.write(memory.view[dirty[i] * ps:(dirty[j - 1] + 1) * ps])
+            i = j
+        f.seek(table_offset)
+        f.write(table)
+        f.write(allocator.bitmap)
+        f.flush()
+        os.fsync(f.fileno())
+        # switching the superblock commits the checkpoint
+        f.seek(0)
+        f.write(_superblock(fs, num_inodes, table_offset, len(table),
+                            data_offset, lsn))
+        f.flush()
+        os.fsync(f.fileno())
+        # slot 1 is no longer referenced
+        if slot == 0:
+            f.truncate(data_end)
+    image['slot'] = slot
+    fs.checkpoint_lsn = lsn
+
+
+def mount(fs, name):
+    '''
+    Load the volume image name into the empty FileSystem fs
+    Returns fs, or 1 if name is not a volume of a supported version
+    '''
+    with open(name, 'rb') as f:
+        image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(image) < SUPERBLOCK.size:
+        return 1
+    magic, version = struct.unpack_from('<8sI', image, 0)
+    if magic != MAGIC:
+        return 1
+    if version == 1:
+        fields = SUPERBLOCK_V1.unpack_from(image, 0) + (0,)
+    elif version in (2, VERSION):
+        fields = SUPERBLOCK.unpack_from(image, 0)
+    else:
+        return 1
+    (_, _, page_size, num_frames, num_inodes, table_offset, table_size,
+     bitmap_offset, data_offset, lsn) = fields
+
+    view = memoryview(image)
+    fs.allocator = PageAllocator(
+        num_frames, bytearray(view[bitmap_offset:bitmap_offset + num_frames]))
+    fs.memory = PhysicalMemory(
+        num_frames, page_size,
+        view[data_offset:data_offset + num_frames * page_size])
+    fs.image = {
+        'path': name,
+        'data_offset': data_offset,
+        'slot': 0 if table_offset < data_offset else 1,
+    }
+    fs.checkpoint_lsn = lsn
+
+    # inode number -> Directory
+    directories = {}
+    offset = table_offset
+    for _ in range(num_inodes):
+        (inode, parent_inode, kind, name_len, size, length,
+         num_pages) = INODE.unpack_from(image, offset)
+        offset += INODE.size
+        node_name = bytes(view[offset:offset + name_len]).decode()
+        offset += name_len
+        # root directory was created by FileSystem()
+        if inode == parent_inode:
+            directories[inode] = fs.root
+            continue
+        parent = directories[parent_inode]
+        if kind == FILE:
+            obj = File(node_name, memory=fs.memory)
+            obj.set_length(length)
+            obj.set_pages(list(struct.unpack_from(f'<{num_pages}I', image, offset)))
+            offset += 4 * num_pages
+            # before version 3 the pages hold all of the contents
+            if version >= 3:
+                tail_kind, frame, slot = TAIL.unpack_from(image, offset)
+                offset += TAIL.size
+                if tail_kind == INLINE:
+                    end = offset + length - num_pages * page_size
+                    obj.set_tail(bytes(view[offset:end]))
+                    offset = end
+                elif tail_kind == PACKED:
+                    obj.set_tail((frame, slot))
+        else:
+            obj = directories[inode] = Directory(node_name, parent.get_path())
+        parent.add_child(obj)
+    fs._index()
+    return fs